@@ -7,15 +7,18 @@ by sequence similarity using vsearch
 
 from __future__ import print_function
 try:
-    from itertools import izip, islice, chain
+    from itertools import izip, chain
 except ImportError:
-    from itertools import islice, chain
+    from itertools import chain
     izip = zip
 
 import os
 import gzip
 import glob
 import time
+import heapq
+import datetime
+import tempfile
 import shutil
 import warnings
 import subprocess as sps
@@ -23,7 +26,10 @@ import subprocess as sps
 import numpy as np
 import pysam
 import ipyrad as ip
-from .utils import IPyradError, bcomp, comp
+from numba import njit
+from .utils import (
+    IPyradError, SeqStore, ClusterStore, MuscleAligner, bcomp, comp, 
+    detect_cpus)
 
 
 class Step3:
@@ -49,135 +55,126 @@ class Step3:
 
     def run(self):
         "Run the assembly functions for this step"
+        stages = self.get_stages()
+        self.nchunks = self.get_align_chunks()
+        if self.data.params.assembly_method == "reference":
+            self.remote_index_refs()
+        self.remote_run_dag(stages)
+        self.cleanup()
+
+
+    def get_align_chunks(self):
+        """
+        Returns the number of chunks to split the clusters (or mapped regions)
+        of each sample into for aligning (or building), in proportion to the sample's share of all reads and to
+        the number of engines, such that there are about ALIGNCHUNKS chunks 
+        per engine in total.
+        """
+        nengines = len(self.ipyclient.ids)
+        nreads = {i.name: i.stats.reads_passed_filter for i in self.samples}
+        total = float(max(1, sum(nreads.values())))
+        nchunks = {}
+        for sname, reads in nreads.items():
+            share = ALIGNCHUNKS * nengines * reads / total
+            nchunks[sname] = int(min(MAXALIGNCHUNKS, max(1, np.ceil(share))))
+        return nchunks
+
+
+    def get_stages(self):
+        """
+        Returns the list of tasks run on each sample in order as tuples of 
+        (printstr, function, args, threaded). Each sample runs through its 
+        tasks independently of other samples (see remote_run_dag).
+        """
+        # denovo clustering, building, and aligning tasks
+        clustering = [
+            (("clustering/mapping  ", "s3"), cluster, 
+                (self.nthreads, self.force), True),
+            (("building clusters   ", "s3"), build_clusters, 
+                (self.maxindels,), False),
+            (("chunking clusters   ", "s3"), muscle_chunker, (), False),
+            (("aligning clusters   ", "s3"), align_and_parse, 
+                (self.maxindels, self.gbs), False),
+            (("concat clusters     ", "s3"), reconcat, (), False),
+        ]
+        depths = [
+            (("calc cluster stats  ", "s3"), get_quick_depths, (), False),
+        ]
 
         # paired-end data methods ------------------------------
         if "pair" in self.data.params.datatype:
 
-            # Filter out by mapping to alt reference
-            # if self.data.params.reference_as_filter:
-            #     self.remote_index_refs("alt")
-            #     self.remote_run(
-            #         function=map_alt_reference,
-            #         printstr=("filter map to alt ref", "s3"),
-            #         args=(),
-            #         threaded=True,
-            #     )
-
             # DENOVO ----
             if self.data.params.assembly_method == "denovo":
-                self.remote_run(
-                    function=concat_multiple_edits,
-                    printstr=("concatenating       ", "s3"),
-                    args=(),
-                )
-                self.remote_run(
-                    function=merge_pairs_with_vsearch,
-                    printstr=("join merged pairs   ", "s3"),
-                    args=(True,),
-                )
-                self.remote_run(
-                    function=merge_end_to_end,
-                    printstr=("join unmerged pairs ", "s3"),
-                    args=(True, True,),
-                )
-                self.remote_run(
-                    function=dereplicate,
-                    printstr=("dereplicating       ", "s3"),
-                    args=(self.nthreads,),
-                    threaded=True,
-                )
-                self.remote_run_cluster_build()
-                self.remote_run_align_cleanup()
-
+                stages = [
+                    (("concatenating       ", "s3"), concat_multiple_edits, 
+                        (), False),
+                    (("join merged pairs   ", "s3"), merge_pairs_with_vsearch,
+                        (True,), False),
+                    (("join unmerged pairs ", "s3"), merge_end_to_end, 
+                        (True, True,), False),
+                    (("dereplicating       ", "s3"), dereplicate, 
+                        (self.nthreads,), True),
+                ] + clustering
 
             # REFERENCE ----
             elif self.data.params.assembly_method == "reference":
-                self.remote_index_refs()
-                self.remote_run(
-                    function=concat_multiple_edits,
-                    printstr=("concatenating       ", "s3"),
-                    args=(),
-                    threaded=True,
-                )
-                self.remote_run(
-                    function=merge_end_to_end,
-                    printstr=("join unmerged pairs ", "s3"),
-                    args=(False, False,),
-                    threaded=True,
-                )
+                stages = [
+                    (("concatenating       ", "s3"), concat_multiple_edits, 
+                        (), True),
+                    (("join unmerged pairs ", "s3"), merge_end_to_end, 
+                        (False, False,), True),
+                ]
                 if self.data.hackersonly.declone_PCR_duplicates:
-                    self.remote_run(
-                        function=declone_3rad,
-                        printstr=("declone 3RAD        ", "s3"),
-                        args=(self.nthreads, self.force),
-                    )
-                self.remote_run(
-                    function=dereplicate,
-                    printstr=("dereplicating       ", "s3"),
-                    args=(self.nthreads,),
-                    threaded=True,
-                )
-                self.remote_run(
-                    function=split_endtoend_reads,
-                    printstr=("splitting dereps    ", "s3"),
-                    args=(),
-                )
-                self.remote_run(
-                    function=mapping_reads,
-                    printstr=("mapping reads       ", "s3"),
-                    args=(self.nthreads,),
-                    threaded=True,
-                )
-                self.remote_run(
-                    function=build_clusters_from_cigars,
-                    printstr=("building clusters   ", "s3"),
-                    args=(),
-                )
+                    stages.append(
+                        (("declone 3RAD        ", "s3"), declone_3rad, 
+                            (self.nthreads, self.force), False))
+                stages += [
+                    (("dereplicating       ", "s3"), dereplicate, 
+                        (self.nthreads,), True),
+                    (("splitting dereps    ", "s3"), split_endtoend_reads,
+                        (), False),
+                    (("mapping reads       ", "s3"), mapping_reads, 
+                        (self.nthreads,), True),
+                    (("chunking regions    ", "s3"), region_chunker, 
+                        (), False),
+                    (("building clusters   ", "s3"), build_clusters_from_cigars,
+                        (), False),
+                    (("concat clusters     ", "s3"), concat_region_clusters,
+                        (), False),
+                ]
 
+            else:
+                raise NotImplementedError(
+                    "datatype + assembly_method combo not yet supported")
 
         ## single-end methods ------------------------------------
         else:
             # DENOVO
             if self.data.params.assembly_method == "denovo":
-                self.remote_run(
-                    function=concat_multiple_edits,
-                    printstr=("concatenating       ", "s3"),
-                    args=(),
-                )
-                self.remote_run(
-                    function=dereplicate,
-                    printstr=("dereplicating       ", "s3"),
-                    args=(self.nthreads,),
-                    threaded=True,
-                )
-                self.remote_run_cluster_build()
-                self.remote_run_align_cleanup()
+                stages = [
+                    (("concatenating       ", "s3"), concat_multiple_edits, 
+                        (), False),
+                    (("dereplicating       ", "s3"), dereplicate, 
+                        (self.nthreads,), True),
+                ] + clustering
 
             # REFERENCE
             elif self.data.params.assembly_method == "reference":
-                self.remote_index_refs()
-                self.remote_run(
-                    function=concat_multiple_edits,
-                    printstr=("concatenating       ", "s3"),
-                    args=(),
-                )
-                self.remote_run(
-                    function=dereplicate,
-                    printstr=("dereplicating       ", "s3"),
-                    args=(self.nthreads,),
-                    threaded=True,
-                )
-                self.remote_run(
-                    function=mapping_reads,
-                    printstr=("mapping reads       ", "s3"),
-                    args=(self.nthreads,),
-                    threaded=True,
-                )
-                self.remote_run(
-                    function=build_clusters_from_cigars,
-                    printstr=("building clusters   ", "s3"),
-                    args=(),
-                )
+                stages = [
+                    (("concatenating       ", "s3"), concat_multiple_edits, 
+                        (), False),
+                    (("dereplicating       ", "s3"), dereplicate, 
+                        (self.nthreads,), True),
+                    (("mapping reads       ", "s3"), mapping_reads, 
+                        (self.nthreads,), True),
+                    (("chunking regions    ", "s3"), region_chunker, 
+                        (), False),
+                    (("building clusters   ", "s3"), build_clusters_from_cigars,
+                        (), False),
+                    (("concat clusters     ", "s3"), concat_region_clusters,
+                        (), False),
+                ]
 
             # DENOVO MINUS
             elif self.data.params.assembly_method == "denovo-reference":
@@ -187,9 +184,7 @@ class Step3:
             else:
                 raise NotImplementedError(
                     "datatype + assembly_method combo not yet supported")
-
-        self.remote_run_sample_cleanup()
-        self.cleanup()
+        return stages + depths
 
 
     def print_headers(self):
@@ -294,20 +289,29 @@ class Step3:
 
         # if nthreads then scale thview to use threads
         eids = self.ipyclient.ids
+        width = 1
         if self.nthreads:
             if self.nthreads <= len(self.ipyclient.ids):
+                width = self.nthreads
                 self.thview = self.ipyclient.load_balanced_view(
                     targets=eids[::self.nthreads])
 
         # else try auto-tuning to 2 or 4 threaded
         else:
             if len(self.ipyclient) >= 40:
+                width = 4
                 self.thview = self.ipyclient.load_balanced_view(
                     targets=eids[::4])
             else:
+                width = 2
                 self.thview = self.ipyclient.load_balanced_view(
                     targets=eids[::2])
 
+        # groups of engines whose cores are used by a threaded task that
+        # runs on the first engine of the group (a thview target).
+        self.thgroups = [
+            eids[i:i + width] for i in range(0, len(eids), width)]
+
 
     def cleanup(self):
         "cleanup / statswriting function for Assembly obj"
@@ -359,193 +363,180 @@ class Step3:
                 job.get()
 
 
-    def remote_run_cluster_build(self):
-        # submit clustering/mapping job
-        start = time.time()
-        casyncs = {}
-        for sample in self.samples:
-            casyncs[sample.name] = self.thview.apply(
-                cluster,
-                *(self.data, sample, self.nthreads, self.force)
-            )
-
-        # submit cluster building job
-        basyncs = {}
-        for sample in self.samples:
-            with self.lbview.temp_flags(after=casyncs[sample.name]):
-                basyncs[sample.name] = self.lbview.apply(
-                    build_clusters,
-                    *(self.data, sample, self.maxindels)
-                )
-
-        # submit cluster chunking job
-        hasyncs = {}
-        for sample in self.samples:
-            with self.lbview.temp_flags(after=basyncs[sample.name]):
-                hasyncs[sample.name] = self.lbview.apply(
-                    muscle_chunker,
-                    *(self.data, sample)
-                )
-
-        # track job progress
-        printstr = ("clustering/mapping  ", "s3")
-        while 1:
-            ready = [casyncs[i].ready() for i in casyncs]
-            self.data._progressbar(len(ready), sum(ready), start, printstr)
-            time.sleep(0.1)
-            if len(ready) == sum(ready):
-                break
-        self.data._print("")
-        for job in casyncs:            
-            if not casyncs[job].successful():
-                casyncs[job].get()
-
-        # track job progress
-        start = time.time()
-        printstr = ("building clusters   ", "s3")
-        while 1:
-            ready = [basyncs[i].ready() for i in basyncs]
-            self.data._progressbar(len(ready), sum(ready), start, printstr)
-            time.sleep(0.1)
-            if len(ready) == sum(ready):
-                break
-        self.data._print("")
-        for job in basyncs:
-            if not basyncs[job].successful():
-                basyncs[job].get()
-
-        # track job progress
-        start = time.time()
-        printstr = ("chunking clusters   ", "s3")
-        while 1:
-            ready = [hasyncs[i].ready() for i in hasyncs]
-            self.data._progressbar(len(ready), sum(ready), start, printstr)
-            time.sleep(0.1)
-            if len(ready) == sum(ready):
-                break
-        self.data._print("")
-        for job in hasyncs:
-            if not hasyncs[job].successful():
-                hasyncs[job].get()
-
-
-    def remote_run_align_cleanup(self):
-
-        # submit ten aligning jobs for each sample
-        start = time.time()
-        aasyncs = {}
-        for sample in self.samples:
-            aasyncs[sample.name] = []
-            for idx in range(10):
-                handle = os.path.join(
-                    self.data.tmpdir,
-                    "{}_chunk_{}.ali".format(sample.name, idx))
-                rasync = self.lbview.apply(
-                    align_and_parse,
-                    *(handle, self.maxindels, self.gbs)
-                )
-                aasyncs[sample.name].append(rasync)
-
-        # a list with all aasyncs concatenated
-        allasyncs = list(chain(*[aasyncs[i] for i in aasyncs]))
-
-        # submit cluster building job for each sample *after* all align jobs
-        basyncs = {}
-        for sample in self.samples:
-            with self.lbview.temp_flags(after=aasyncs[sample.name]):
-                basyncs[sample.name] = self.lbview.apply(
-                    reconcat,
-                    *(self.data, sample)
-                )
-
-        # track job 1 progress
-        printstr = ("aligning clusters   ", "s3")
-        while 1:
-            ready = [i.ready() for i in allasyncs]
-            self.data._progressbar(len(ready), sum(ready), start, printstr)
-            time.sleep(0.1)
-            if len(ready) == sum(ready):
-                break
-        self.data._print("")
-        for job in allasyncs:
-            if not job.successful():
-                job.get()
-
-        # track job 2 progress
-        start = time.time()
-        printstr = ("concat clusters     ", "s3")
-        while 1:
-            ready = [basyncs[i].ready() for i in basyncs]
-            self.data._progressbar(len(ready), sum(ready), start, printstr)
-            time.sleep(0.1)
-            if len(ready) == sum(ready):
-                break
-        self.data._print("")
-        for job in basyncs:
-            if not basyncs[job].successful():
-                basyncs[job].get()
-
-
-    def remote_run_sample_cleanup(self):
-        # submit job
-        printstr = ("calc cluster stats  ", "s3")
-        start = time.time()
-        rasyncs = {}
-        njobs = len(self.samples)
+    def remote_run_dag(self, stages):
+        """
+        Run all tasks of all samples at once, where each task of a sample
+        depends only on the previous task of the same sample, so that samples
+        move through the step independently (e.g., one sample can be aligning
+        while another is still dereplicating). Tasks are scheduled on engines
+        from here, in sample order (largest first): a threaded task holds a 
+        whole group of engines (see tune_threads) while it runs, so that it
+        never shares cores with other tasks, and an unthreaded task holds 
+        one engine. While a threaded task waits for a free group, the group
+        with the most free engines is reserved for it. Progress is tracked 
+        for each task in order, and the idle time of engines is reported.
+        """
+        # all tasks in the order they are to be scheduled
+        tasks = []
         for sample in self.samples:
-            args = [self.data, sample]
-            rasyncs[sample.name] = self.lbview.apply(get_quick_depths, *args)
-
-        # enter result stats as the jobs finish
-        finished = 0       
-        while 1:
-            samplelist = list(rasyncs.keys())
-            for sname in samplelist:
-                if rasyncs[sname].ready():
-
-                    # enter results to sample object and checks for errors
-                    maxlens, depths = rasyncs[sname].get()
-                    store_sample_stats(
-                        self.data, self.data.samples[sname], maxlens, depths)
-                    finished += 1
-
-                    # remove sample from todo list, and del from rasyncs mem
-                    rasyncs.pop(sname)
-
-            # progress bar
-            self.data._progressbar(njobs, finished, start, printstr)
-            time.sleep(0.1)
-            if finished == njobs:
-                break
-        self.data._print("")
-
-
-    def remote_run(self, printstr, function, args, threaded=False):
-        # submit job
+            after = []
+            for sidx, (_, function, args, threaded) in enumerate(stages):
+                tidxs = []
+                for fargs in self.get_task_args(sample, function, args):
+                    tidxs.append(len(tasks))
+                    tasks.append({
+                        "sname": sample.name,
+                        "stage": sidx,
+                        "function": function,
+                        "args": fargs,
+                        "threaded": threaded,
+                        "after": after,
+                    })
+                after = tidxs
+
+        # schedule tasks as engines come free and track progress of stages
+        rasyncs = [{i.name: [] for i in self.samples} for j in stages]
+        waiting = list(range(len(tasks)))
+        running = {}
+        finished = set()
+        free = set(self.ipyclient.ids)
+        sidx = 0
         start = time.time()
-        rasyncs = {}
-        for sample in self.samples:
-            fargs = [self.data, sample] + list(args)
-            if threaded:
-                rasyncs[sample.name] = self.thview.apply(function, *fargs)
-            else:
-                rasyncs[sample.name] = self.lbview.apply(function, *fargs)
-
-        # track job
-        while 1:
-            ready = [rasyncs[i].ready() for i in rasyncs]
-            self.data._progressbar(len(ready), sum(ready), start, printstr)
-            time.sleep(0.1)
-            if len(ready) == sum(ready):
-                break
+        while sidx < len(stages):
+
+            # free the engines of finished tasks, will raise ipp.RemoteError
+            for tidx in list(running):
+                rasync, engines = running[tidx]
+                if rasync.ready():
+                    if not rasync.successful():
+                        rasync.get()
+                    del running[tidx]
+                    free.update(engines)
+                    finished.add(tidx)
+
+            # start tasks that are ready on free engines
+            reserved = set()
+            for tidx in list(waiting):
+                task = tasks[tidx]
+                if not finished.issuperset(task["after"]):
+                    continue
+                if task["threaded"]:
+                    groups = [i for i in self.thgroups if not reserved & set(i)]
+                    ready = [i for i in groups if free.issuperset(i)]
+                    if not ready:
+                        if groups:
+                            reserved.update(max(
+                                groups, key=lambda x: len(free & set(x))))
+                        continue
+                    engines = ready[0]
+                else:
+                    ready = sorted(free - reserved)
+                    if not ready:
+                        continue
+                    engines = ready[:1]
+                rasync = self.ipyclient[engines[0]].apply_async(
+                    task["function"], *task["args"])
+                rasyncs[task["stage"]][task["sname"]].append(rasync)
+                running[tidx] = (rasync, engines)
+                free.difference_update(engines)
+                waiting.remove(tidx)
+
+            # track progress of the current stage across samples
+            printstr, function, _, _ = stages[sidx]
+            ntasks = sum(1 for i in tasks if i["stage"] == sidx)
+            ndone = sum(1 for i in finished if tasks[i]["stage"] == sidx)
+            self.data._progressbar(ntasks, ndone, start, printstr)
+            if ndone < ntasks:
+                time.sleep(0.1)
+                continue
+            self.data._print("")
+            start = time.time()
+            sidx += 1
+
+            # report how clusters were aligned
+            if function is align_and_parse:
+                self.data._print(
+                    MuscleAligner.summary(
+                        [i.get() for i in chain(*rasyncs[sidx - 1].values())]))
+
+        # enter depth results to sample objects
+        for sname, jobs in rasyncs[-1].items():
+            maxlens, depths = jobs[0].get()
+            store_sample_stats(
+                self.data, self.data.samples[sname], maxlens, depths)
+
+        # report engine idle time and clean up to free any RAM
+        self.report_idle_time(stages, rasyncs)
+        self.ipyclient.purge_everything()
 
-        # check for errors, will raise ipp.RemoteError
-        self.data._print("")
-        for job in rasyncs:
-            rasyncs[job].get()
 
-        # clean up to free any RAM
-        self.ipyclient.purge_everything()
+    def get_task_args(self, sample, function, args):
+        "returns a list of the args of each task of a stage for a sample"
+        # align and ref build tasks run on separate chunks of clusters
+        if function in (muscle_chunker, region_chunker):
+            return [[self.data, sample, self.nchunks[sample.name]]]
+        if function is build_clusters_from_cigars:
+            return [
+                [self.data, sample, idx] 
+                for idx in range(self.nchunks[sample.name])
+            ]
+        if function is align_and_parse:
+            return [
+                [os.path.join(
+                    self.data.tmpdir, 
+                    "{}_chunk_{}.ali".format(sample.name, idx))]
+                + list(args) 
+                for idx in range(self.nchunks[sample.name])
+            ]
+        return [[self.data, sample] + list(args)]
+
+
+    def report_idle_time(self, stages, rasyncs):
+        """
+        Print the percent of engine time that was idle while running tasks.
+        The busy time of each engine is the union of the times it ran a task
+        or was held by a threaded task run on its group of engines.
+        """
+        groups = {i[0]: i for i in self.thgroups}
+        intervals = {i: [] for i in self.ipyclient.ids}
+        for sidx, (_, _, _, threaded) in enumerate(stages):
+            for job in chain(*rasyncs[sidx].values()):
+                meta = job.metadata
+                if not (meta.get("started") and meta.get("completed")):
+                    continue
+                eid = meta["engine_id"]
+                engines = (groups.get(eid, [eid]) if threaded else [eid])
+                for engine in engines:
+                    intervals[engine].append(
+                        (meta["started"], meta["completed"]))
+        allints = list(chain(*intervals.values()))
+        if not allints:
+            return
+
+        # sum the merged (non-overlapping) busy intervals of each engine
+        busy = 0.
+        for ints in intervals.values():
+            lastend = None
+            for istart, iend in sorted(ints):
+                if lastend is not None:
+                    istart = max(istart, lastend)
+                if iend > istart:
+                    busy += (iend - istart).total_seconds()
+                lastend = (iend if lastend is None else max(lastend, iend))
+
+        nengines = len(intervals)
+        walltime = (
+            max(i[1] for i in allints) - min(i[0] for i in allints)
+        ).total_seconds()
+        if walltime > 0:
+            idle = 1 - (busy / (walltime * nengines))
+            self.data._print(
+                "engines idle {:.1f}% of {} x {} engines"
+                .format(
+                    100 * idle, 
+                    datetime.timedelta(seconds=int(walltime)), 
+                    nengines)
+            )
 
 
 def dereplicate(data, sample, nthreads):
@@ -897,14 +888,10 @@ def build_clusters(data, sample, maxindels):
     proc = sps.Popen(cmd, close_fds=True)
     proc.communicate()[0]
 
-    ## load ALL derep reads into a dictionary (this can be a few GB of RAM)
-    ## and is larger if names are larger. We are grabbing two lines at a time.
-    alldereps = {}
-    with open(derepfile, 'rt') as ioderep:
-        dereps = izip(*[iter(ioderep)] * 2)
-        for namestr, seq in dereps:
-            nnn, sss = [i.strip() for i in (namestr, seq)]  
-            alldereps[nnn[1:]] = sss
+    ## index ALL derep reads in a disk-backed store that is accessed by name
+    ## like a dict, but without loading reads into memory.
+    alldereps = SeqStore(
+        derepfile, os.path.join(data.tmpdir, sample.name + "_derep"))
 
     ## store observed seeds (this could count up to >million in bad data sets)
     seedsseen = set()
@@ -995,56 +982,70 @@ def build_clusters(data, sample, maxindels):
 
     ## close the file handle
     clustsout.close()
-    del alldereps
+    alldereps.close()
 
 
-def muscle_chunker(data, sample):
+def muscle_chunker(data, sample, nchunks=10):
     """
-    Splits the muscle alignment into chunks. Each chunk is run on a separate
-    computing core. Because the largest clusters are at the beginning of the 
-    clusters file, assigning equal clusters to each file would put all of the 
-    large cluster, that take longer to align, near the top. So instead we 
-    randomly distribute the clusters among the files. If assembly method is
-    reference then this step is just a placeholder and nothing happens. 
+    Splits the clusters into nchunks files that are each aligned on a 
+    separate computing core, streaming through the clusters file once. Each
+    cluster is put in the chunk with the lowest total estimated alignment 
+    cost so far, where the cost of a cluster is its number of sequences (up 
+    to the number that are aligned) times the length of its longest read, 
+    such that chunks take about the same time to align. If assembly method 
+    is reference then this step is just a placeholder and nothing happens. 
     """
-
     ## only chunk up denovo data, refdata has its own chunking method which 
     ## makes equal size chunks, instead of uneven chunks like in denovo
-    if data.params.assembly_method != "reference":
-        ## get the number of clusters
-        clustfile = os.path.join(data.dirs.clusts, sample.name + ".clust.txt")
-        with iter(open(clustfile, 'rt')) as clustio:
-            nloci = sum(1 for i in clustio if "//" in i) // 2
-            optim = (nloci // 20) + (nloci % 20)
-
-        ## write optim clusters to each tmp file
-        clustio = open(clustfile, 'rt')
-        inclusts = iter(clustio.read().strip().split("//\n//\n"))
-        
-        ## splitting loci so first file is smaller and last file is bigger
-        inc = optim // 10
-        for idx in range(10):
-            ## how big is this chunk?
-            this = optim + (idx * inc)
-            left = nloci - this
-            if idx == 9:
-                ## grab everything left
-                grabchunk = list(islice(inclusts, int(1e9)))
-            else:
-                ## grab next chunks-worth of data
-                grabchunk = list(islice(inclusts, this))
-                nloci = left
+    if data.params.assembly_method == "reference":
+        return
+
+    ## open all chunk files, a chunk can be empty if there are few clusters
+    clustfile = os.path.join(data.dirs.clusts, sample.name + ".clust.txt")
+    outs = [
+        open(os.path.join(
+            data.tmpdir, sample.name + "_chunk_{}.ali".format(idx)), 'w')
+        for idx in range(nchunks)
+    ]
+
+    ## a heap of (cost, chunk index) to find the least loaded chunk
+    loads = [(0, idx) for idx in range(nchunks)]
+    try:
+        with open(clustfile, 'rt') as clustio:
+            for clust in iter_clusters(clustio):
+                nseqs = len(clust) // 2
+                cost = 1
+                if nseqs > 1:
+                    cost = min(nseqs, MAXALIGNSEQS) * max(
+                        len(i) for i in clust[1::2])
+                load, idx = heapq.heappop(loads)
+                outs[idx].write("".join(clust) + "//\n//\n")
+                heapq.heappush(loads, (load + cost, idx))
+    finally:
+        for out in outs:
+            out.close()
 
-            ## write the chunk to file
-            tmpfile = os.path.join(
-                data.tmpdir, sample.name + "_chunk_{}.ali".format(idx))
-            with open(tmpfile, 'wb') as out:
-                out.write(str.encode("//\n//\n".join(grabchunk)))
-        clustio.close()
+
+
+def iter_clusters(clustio):
+    "Yields clusters as lists of lines from an open clust file"
+    clust = []
+    for line in clustio:
+        if line.startswith("//"):
+            if clust:
+                yield clust
+                clust = []
+        else:
+            clust.append(line if line.endswith("\n") else line + "\n")
+    if clust:
+        yield clust
 
 
 def align_and_parse(handle, max_internal_indels=5, is_gbs=False):
-    """ much faster implementation for aligning chunks """
+    """ 
+    much faster implementation for aligning chunks. Returns a dict with the
+    aligner stats and the number of clusters filtered for too many indels.
+    """
 
     # CHECK: data are already chunked, read in the whole thing. bail if no data.
     clusts = []
@@ -1053,23 +1054,20 @@ def align_and_parse(handle, max_internal_indels=5, is_gbs=False):
             clusts = infile.read().decode().split("//\n//\n")
             # remove any empty spots
             clusts = [i for i in clusts if i]
-            # Skip entirely empty chunks
-            if not clusts:
-                raise IPyradError("no clusters in file: {}".format(handle))
 
-    # return 0 if file not read for some reason...
+    # return empty stats if file not read for some reason...
     except IOError:
-        return 0
+        return {}
 
-    # return 0 if no clusters in file
+    # return empty stats if no clusters in file
     if not clusts:
-        return 0
+        return {}
 
     ## count discarded clusters for printing to stats later
     highindels = 0
 
     ## iterate over clusters sending each to muscle, splits and aligns pairs
-    aligned = persistent_popen_align3(clusts, 200, is_gbs)
+    aligned, stats = align_clusters(clusts, MAXALIGNSEQS, is_gbs)
 
     ## store good alignments to be written to file
     refined = []
@@ -1090,182 +1088,129 @@ def align_and_parse(handle, max_internal_indels=5, is_gbs=False):
                 outfile.write("\n//\n//\n".join(refined) + "\n")
             except TypeError:
                 outfile.write(("\n//\n//\n".join(refined) + "\n").encode())
-    return highindels
+    stats["highindels"] = highindels
+    return stats
 
 
 def reconcat(data, sample):
-    """ takes aligned chunks (usually 10) and concatenates them """
+    """ takes aligned chunks and concatenates them """
 
     ## get chunks
     chunks = glob.glob(os.path.join(data.tmpdir,
-             sample.name + "_chunk_[0-9].aligned"))
+             sample.name + "_chunk_[0-9]*.aligned"))
 
     ## sort by chunk number, cuts off last 8 =(aligned)
     chunks.sort(key=lambda x: int(x.rsplit("_", 1)[-1][:-8]))
 
-    ## concatenate finished reads
-    sample.files.clusters = os.path.join(
-        data.dirs.clusts, sample.name + ".clustS.gz")
+    ## write aligned clusters to the sample's ClusterStore
+    write_cluster_store(data, sample, chunks)
 
-    ## reconcats aligned clusters
-    with gzip.open(sample.files.clusters, 'wb') as out:
-        for fname in chunks:
-            with open(fname) as infile:
-                dat = infile.read().strip()
-                dat += "\n//\n//\n"
-                try:
-                    out.write(dat)
-                except TypeError:
-                    out.write(dat.encode())
-            os.remove(fname)
 
+def align_clusters(clusts, maxseqs=200, is_gbs=False):
+    """
+    Aligns clusters with a pool of muscle processes. Paired clusters (with 
+    an nnnn separator in every sequence) are aligned as separate read1 and 
+    read2 alignments that are joined back together in order. Returns the 
+    aligned clusters and the aligner stats.
+    """
+    # build fasta inputs (read1s and read2s of pairs are separate jobs)
+    jobs = []
+    fastas = []
+    for clust in clusts:
 
-def persistent_popen_align3(clusts, maxseqs=200, is_gbs=False):
-    "keeps a persistent bash shell open and feeds it muscle alignments"
+        ## don't bother aligning if only one seq
+        if clust.count(">") == 1:
+            jobs.append(None)
+            continue
 
-    # create a separate shell for running muscle in, this is much faster
-    # than spawning a separate subprocess for each muscle call
-    proc = sps.Popen(
-        ["bash"],
-        stdin=sps.PIPE,
-        stdout=sps.PIPE,
-        bufsize=0,
-    )
+        # make into list (only read maxseqs lines, 2X cuz names)
+        lclust = clust.split()[:maxseqs * 2]
+
+        # do we need to split the alignment? (is there a PE insert?)
+        try:
+            # try to split cluster list at nnnn separator for each read
+            lclust1 = list(chain(*zip(
+                lclust[::2], [i.split("nnnn")[0] for i in lclust[1::2]])))
+            lclust2 = list(chain(*zip(
+                lclust[::2], [i.split("nnnn")[1] for i in lclust[1::2]])))
+            jobs.append((len(fastas), len(fastas) + 1))
+            fastas.append("\n".join(lclust1) + "\n")
+            fastas.append("\n".join(lclust2) + "\n")
+
+        ## Either reads are SE, or at least some pairs are merged.
+        except IndexError:
+            jobs.append((len(fastas), ))
+            fastas.append("\n".join(lclust) + "\n")
+
+    # align all fastas with several muscle processes running at once
+    with MuscleAligner() as aligner:
+        alignments = aligner.align(fastas)
+        stats = aligner.stats
 
     ## iterate over clusters in this file until finished
     aligned = []
-    for clust in clusts:
-
-        ## new alignment string for read1s and read2s
-        align1 = []
-        align2 = []
-
-        ## don't bother aligning if only one seq
-        if clust.count(">") == 1:
+    for clust, job in zip(clusts, jobs):
+        if job is None:
             aligned.append(clust.replace(">", "").strip())
-        else:
 
-            # do we need to split the alignment? (is there a PE insert?)
+        elif len(job) == 2:
+            # join up aligned read1 and read2 and ensure names order match
+            lines1 = alignments[job[0]][1:].split("\n>")
+            lines2 = alignments[job[1]][1:].split("\n>")
             try:
-                # make into list (only read maxseqs lines, 2X cuz names)
-                lclust = clust.split()[:maxseqs * 2]
-
-                # try to split cluster list at nnnn separator for each read
-                lclust1 = list(chain(*zip(
-                    lclust[::2], [i.split("nnnn")[0] for i in lclust[1::2]])))
-                lclust2 = list(chain(*zip(
-                    lclust[::2], [i.split("nnnn")[1] for i in lclust[1::2]])))
-
-                # put back into strings
-                clust1 = "\n".join(lclust1)
-                clust2 = "\n".join(lclust2)
-
-                # Align the first reads.
-                # The muscle command with alignment as stdin and // as split
-                cmd1 = ("echo -e '{}' | {} -quiet -in - ; echo {}"
-                        .format(clust1, ip.bins.muscle, "//\n"))
-
-                # send cmd1 to the bash shell
-                proc.stdin.write(cmd1.encode())
-
-                # read the stdout by line until splitter is reached
-                # meaning that the alignment is finished.
-                for line in iter(proc.stdout.readline, b'//\n'):
-                    align1.append(line.decode())
-
-                # Align the second reads.
-                # The muscle command with alignment as stdin and // as split
-                cmd2 = ("echo -e '{}' | {} -quiet -in - ; echo {}"
-                        .format(clust2, ip.bins.muscle, "//\n"))
-
-                # send cmd2 to the bash shell
-                proc.stdin.write(cmd2.encode())
-
-                # read the stdout by line until splitter is reached
-                # meaning that the alignment is finished.
-                for line in iter(proc.stdout.readline, b'//\n'):
-                    align2.append(line.decode())
-
-                # join up aligned read1 and read2 and ensure names order match
-                lines1 = "".join(align1)[1:].split("\n>")
-                lines2 = "".join(align2)[1:].split("\n>")
                 dalign1 = dict([i.split("\n", 1) for i in lines1])
                 dalign2 = dict([i.split("\n", 1) for i in lines2])
 
-                # sort the first reads
-                keys = list(dalign1.keys())
-                seed = [i for i in keys if i[-1] == "*"][0]
-                keys.pop(keys.index(seed))
-                order = [seed] + sorted(
-                    keys, key=get_derep_num, reverse=True)                
-
-                # combine in order
-                alignpe = []                
-                for key in order:
-                    alignpe.append("\n".join([
-                        key, 
-                        dalign1[key].replace("\n", "") + "nnnn" + \
-                        dalign2[key].replace("\n", "")]))
-
-                ## append aligned cluster string
-                aligned.append("\n".join(alignpe).strip())
-
             # Malformed clust. Dictionary creation with only 1 element 
-            except ValueError as inst:
+            except ValueError:
                 print("Bad PE cluster - {}\nla1 - {}\nla2 - {}"
                       .format(clust, lines1, lines2)
                       )
+                continue
+
+            # sort the first reads
+            keys = list(dalign1.keys())
+            seed = [i for i in keys if i[-1] == "*"][0]
+            keys.pop(keys.index(seed))
+            order = [seed] + sorted(
+                keys, key=get_derep_num, reverse=True)                
+
+            # combine in order
+            alignpe = []                
+            for key in order:
+                alignpe.append("\n".join([
+                    key, 
+                    dalign1[key].replace("\n", "") + "nnnn" + \
+                    dalign2[key].replace("\n", "")]))
+
+            ## append aligned cluster string
+            aligned.append("\n".join(alignpe).strip())
 
-            ## Either reads are SE, or at least some pairs are merged.
-            except IndexError:
-                    
-                # limit the number of input seqs
-                # use lclust already built before checking pairs
-                lclust = "\n".join(clust.split()[:maxseqs * 2])
-
-                # the muscle command with alignment as stdin and // as splitter
-                cmd = ("echo -e '{}' | {} -quiet -in - ; echo {}"
-                       .format(lclust, ip.bins.muscle, "//\n"))
-
-                ## send cmd to the bash shell (TODO: PIPE could overflow here!)
-                proc.stdin.write(cmd.encode())
-
-                ## read the stdout by line until // is reached. This BLOCKS.
-                for line in iter(proc.stdout.readline, b'//\n'):
-                    align1.append(line.decode())
-
-                ## remove '>' from names, and '\n' from inside long seqs                
-                lines = "".join(align1)[1:].split("\n>")
-
-                ## find seed of the cluster and put it on top.
-                #seed = [i for i in lines if i.split(";")[-1][0] == "*"][0]
-                seed = [i for i in lines if i.split('\n')[0][-1] == "*"][0]
-                lines.pop(lines.index(seed))
-                lines = [seed] + sorted(
-                    lines, key=get_derep_num, reverse=True)
+        else:
+            ## remove '>' from names, and '\n' from inside long seqs                
+            lines = alignments[job[0]][1:].split("\n>")
 
-                ## format remove extra newlines from muscle
-                aa = [i.split("\n", 1) for i in lines]
-                align1 = [i[0] + '\n' + "".join([j.replace("\n", "")
-                          for j in i[1:]]) for i in aa]
+            ## find seed of the cluster and put it on top.
+            seed = [i for i in lines if i.split('\n')[0][-1] == "*"][0]
+            lines.pop(lines.index(seed))
+            lines = [seed] + sorted(
+                lines, key=get_derep_num, reverse=True)
 
-                # trim edges in sloppy gbs/ezrad data.
-                # Maybe relevant to other types too...
-                if is_gbs:
-                    align1 = gbs_trim(align1)
+            ## format remove extra newlines from muscle
+            aa = [i.split("\n", 1) for i in lines]
+            align1 = [i[0] + '\n' + "".join([j.replace("\n", "")
+                      for j in i[1:]]) for i in aa]
 
-                ## append to aligned
-                aligned.append("\n".join(align1))
+            # trim edges in sloppy gbs/ezrad data.
+            # Maybe relevant to other types too...
+            if is_gbs:
+                align1 = gbs_trim(align1)
 
-    # cleanup
-    proc.stdout.close()
-    if proc.stderr:
-        proc.stderr.close()
-    proc.stdin.close()
-    proc.wait()
+            ## append to aligned
+            aligned.append("\n".join(align1))
 
     ## return the aligned clusters
-    return aligned
+    return aligned, stats
 
 
 def aligned_indel_filter(clust, max_internal_indels):
@@ -1394,15 +1339,13 @@ def mapping_reads(data, sample, nthreads):
     """
     Map reads to reference sequence. This reads in the fasta files
     (samples.files.edits), and maps each read to the reference. Unmapped reads
-    are dropped right back in the de novo pipeline.
-    Mapped reads end up in a sam file.
+    are dropped right back in the de novo pipeline. The output of bwa is 
+    streamed through samtools view, which writes unmapped reads to a bam 
+    file, into samtools sort, which writes mapped reads to a sorted bam file,
+    such that no SAM text is written to disk.
     """
 
     # outfiles
-    samout = os.path.join(
-        data.dirs.refmapping,
-        "{}.sam".format(sample.name))
-
     bamout = os.path.join(
         data.dirs.refmapping,
         "{}-mapped-sorted.bam".format(sample.name))
@@ -1434,6 +1377,7 @@ def mapping_reads(data, sample, nthreads):
     #  -M           : Mark split alignments as secondary.
 
     # (cmd2) samtools view [options] <in.bam>|<in.sam>|<in.cram> [region ...]
+    #  -  = read SAM from stdin (piped from bwa)
     #  -b = write to .bam
     #  -q = Only keep reads with mapq score >= 30 (seems to be pretty standard)
     #  -F = Select all reads that DON'T have these flags.
@@ -1450,6 +1394,8 @@ def mapping_reads(data, sample, nthreads):
     #       Here we hack it to be samhandle.tmp cuz samtools cleans it up
     #  -O = Output file format, in this case bam
     #  -o = Output file name
+    #  -@ = Number of threads
+    #  -m = Max memory per thread (set from the engine's share of memory)
 
     # (cmd5) samtools bam2fq -v 45 [in.bam]
     #   -v45 set the default qscore arbirtrarily high
@@ -1468,19 +1414,13 @@ def mapping_reads(data, sample, nthreads):
     for arg in bwa_args:
         cmd1.insert(2, arg)
 
-    with open(samout, 'wb') as outfile:
-        proc1 = sps.Popen(cmd1, stderr=None, stdout=outfile)
-        error1 = proc1.communicate()[0]
-        if proc1.returncode:
-            raise IPyradError("bwa error: {}".format(error1))
-
     # sends unmapped reads to a files and will PIPE mapped reads to cmd3
     cmd2 = [
         ip.bins.samtools, "view",
         "-b",
         "-F", "0x904",
         "-U", ubamout,
-        samout,
+        "-",
     ]
 
     # this is gonna catch mapped bam output from cmd2 and write to file
@@ -1488,6 +1428,8 @@ def mapping_reads(data, sample, nthreads):
         ip.bins.samtools, "sort",
         "-T", os.path.join(data.dirs.refmapping, sample.name + ".sam.tmp"),
         "-O", "bam",
+        "-@", str(max(1, nthreads)),
+        "-m", get_sort_mem(nthreads),
         "-o", bamout]
 
     # Later we're gonna use samtools to grab out regions using 'view'
@@ -1522,16 +1464,36 @@ def mapping_reads(data, sample, nthreads):
         cmd5.insert(2, "-0")
 
 
-    # cmd2 writes to sname.unmapped.bam and fills pipe with mapped BAM data
-    proc2 = sps.Popen(cmd2, stderr=sps.STDOUT, stdout=sps.PIPE)
-
-    # cmd3 pulls mapped BAM from pipe and writes to sname.mapped-sorted.bam
-    proc3 = sps.Popen(
-        cmd3, stderr=sps.STDOUT, stdout=sps.PIPE, stdin=proc2.stdout)
-    error3 = proc3.communicate()[0]
-    if proc3.returncode:
-        raise IPyradError(error3)
-    proc2.stdout.close()
+    # cmd1 pipes SAM to cmd2, which writes to sname.unmapped.bam and fills 
+    # pipe with mapped BAM data. cmd3 pulls mapped BAM from pipe and writes 
+    # to sname.mapped-sorted.bam. stderr of each goes to a tmp file.
+    errors = [tempfile.TemporaryFile() for i in range(3)]
+    try:
+        proc1 = sps.Popen(cmd1, stderr=errors[0], stdout=sps.PIPE)
+        proc2 = sps.Popen(
+            cmd2, stderr=errors[1], stdout=sps.PIPE, stdin=proc1.stdout)
+        proc1.stdout.close()
+        proc3 = sps.Popen(
+            cmd3, stderr=errors[2], stdout=sps.PIPE, stdin=proc2.stdout)
+        proc2.stdout.close()
+        proc3.communicate()
+        proc2.wait()
+        proc1.wait()
+
+        # report errors of all failed commands, since a failure in one
+        # can break the pipe of others.
+        messages = []
+        for proc, error, cmd in zip((proc1, proc2, proc3), errors, 
+                                    (cmd1, cmd2, cmd3)):
+            if proc.returncode:
+                error.seek(0)
+                messages.append("{}\n{}".format(
+                    " ".join(cmd[:2]), error.read().decode()))
+        if messages:
+            raise IPyradError("error in mapping:\n" + "\n".join(messages))
+    finally:
+        for error in errors:
+            error.close()
 
     # cmd4 indexes the bam file
     proc4 = sps.Popen(cmd4, stderr=sps.STDOUT, stdout=sps.PIPE)
@@ -1548,6 +1510,21 @@ def mapping_reads(data, sample, nthreads):
         raise IPyradError(error5)
 
 
+def get_sort_mem(nthreads):
+    """
+    Returns the max memory per thread for samtools sort (e.g., '768M') as 
+    half of the memory share of an engine using nthreads of the cpus.
+    """
+    try:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return "768M"
+    share = total * max(1, nthreads) / float(detect_cpus()) / 2.
+    perthread = share / max(1, nthreads) / 1e6
+    return "{}M".format(int(min(4000, max(100, perthread))))
+
+
+
 def check_insert_size(data, sample):
     """
     check mean insert size for this sample and update 
@@ -1616,6 +1593,7 @@ def bedtools_merge(data, sample):
     bedtools bamtobed -i 1A_0.sorted.bam | bedtools merge [-d 100]
         -i <input_bam>  :   specifies the input file to bed'ize
         -d <int>        :   For PE set max distance between reads
+        -c 1 -o count   :   Report the number of reads in each region
     """
     mappedreads = os.path.join(
         data.dirs.refmapping,
@@ -1625,7 +1603,7 @@ def bedtools_merge(data, sample):
     # Usage:   bedtools bamtobed [OPTIONS] -i <bam>
     # Usage:   bedtools merge [OPTIONS] -i <bam>
     cmd1 = [ip.bins.bedtools, "bamtobed", "-i", mappedreads]
-    cmd2 = [ip.bins.bedtools, "merge", "-i", "-"]
+    cmd2 = [ip.bins.bedtools, "merge", "-i", "-", "-c", "1", "-o", "count"]
 
     # If PE the -d flag to tell bedtools how far apart to allow mate pairs.
     # If SE the -d flag is negative, specifying that SE reads need to
@@ -1656,16 +1634,50 @@ def bedtools_merge(data, sample):
     return result
 
 
-def build_clusters_from_cigars(data, sample):
+def region_chunker(data, sample, nchunks=10):
     """
-    Directly building clusters relative to reference. Uses the function 
-    cigared() to impute indels relative to reference. This means add - for 
-    insertion and skip* deletions. Skipping is not a good final solution.
+    Splits the merged regions of mapped reads into nchunks blocks of 
+    consecutive regions (in the sorted order of the bam file) that each
+    have about the same number of reads, and writes each block to a bed
+    file, such that clusters can be built from blocks on separate cores 
+    and concatenated back in order.
     """
-    # get all regions with reads. Generator to yield (str, int, int)
-    fullregions = bedtools_merge(data, sample).strip().split("\n")
-    regions = (i.split("\t") for i in fullregions)
-    regions = ((i, int(j), int(k)) for (i, j, k) in regions)
+    result = bedtools_merge(data, sample).strip()
+    regions = [i.split("\t") for i in result.split("\n") if i]
+
+    # cut blocks where the cumulative read count crosses each 1/nchunks
+    counts = np.array([int(i[3]) for i in regions], dtype=np.int64)
+    cumsum = np.cumsum(counts)
+    total = (cumsum[-1] if cumsum.size else 0)
+    bounds = np.searchsorted(
+        cumsum, np.arange(1, nchunks) * total / float(nchunks)) + 1
+    bounds = np.clip(
+        np.concatenate([[0], bounds, [len(regions)]]), 0, len(regions))
+
+    for idx in range(nchunks):
+        bedfile = os.path.join(
+            data.tmpdir, "{}_regions_{}.bed".format(sample.name, idx))
+        with open(bedfile, 'w') as out:
+            out.write("".join(
+                "{}\t{}\t{}\n".format(*i[:3]) 
+                for i in regions[bounds[idx]:bounds[idx + 1]]))
+
+
+
+def build_clusters_from_cigars(data, sample, chunk=0):
+    """
+    Directly building clusters relative to reference for one block of
+    regions written by region_chunker. The reads of each region are filled
+    into a uint8 array at their mapped positions using their cigar strings,
+    where deletions relative to the reference are filled with "-" and 
+    insertions are skipped. Paired reads are joined into a single row.
+    """
+    # regions of this block as (str, int, int)
+    bedfile = os.path.join(
+        data.tmpdir, "{}_regions_{}.bed".format(sample.name, chunk))
+    with open(bedfile, 'r') as infile:
+        regions = [i.split("\t") for i in infile.read().split("\n") if i]
+    regions = [(i, int(j), int(k)) for (i, j, k) in regions]
 
     # access reads from bam file using pysam
     bamfile = pysam.AlignmentFile(
@@ -1674,125 +1686,186 @@ def build_clusters_from_cigars(data, sample):
             "{}-mapped-sorted.bam".format(sample.name)),
         'rb')
 
-    # output path 
+    # output path for this block
     opath = os.path.join(
-        data.dirs.clusts, "{}.clustS.gz".format(sample.name))
-    out = gzip.open(opath, 'wt')
-    idx = 0
+        data.tmpdir, "{}_regions_{}.clust".format(sample.name, chunk))
+    out = open(opath, 'w')
+    ispair = bool("pair" in data.params.datatype)
 
     # iterate over all regions to build clusters
     clusters = []
     for reg in regions:
-        # uncomment and compare against ref sequence when testing
-        # ref = get_ref_region(data.paramsdict["reference_sequence"], *reg)
-        reads = bamfile.fetch(*reg)
-
-        # store reads in a dict
-        rdict = {}
-
-        # paired-end data cluster building
-        if "pair" in data.params.datatype:
-
-            # match paired reads together in a dictionary
-            for read in reads:
-                if read.qname not in rdict:
-                    rdict[read.qname] = [read, None]
-                else:
-                    rdict[read.qname][1] = read
-
-            # sort keys by derep number
-            keys = sorted(
-                rdict.keys(),
-                key=lambda x: int(x.split("=")[-1]), reverse=True)
-
-            # build the cluster based on map positions, orientation, cigar
-            clust = []
-            for key in keys:
-                r1, r2 = rdict[key]
-                if r1 and r2:
-
-                    #lref = len(ref[1])
-                    lref = reg[2] - reg[1]
-                    arr1 = np.zeros(lref, dtype="U1")
-                    arr2 = np.zeros(lref, dtype="U1")
-                    arr1.fill("-")
-                    arr2.fill("-")
-
-                    # how far ahead of the start does this read begin
-                    seq = cigared(r1.seq, r1.cigar)
-                    start = r1.reference_start - reg[1] 
-                    arr1[start:start + len(seq)] = list(seq)
-                    
-                    seq = cigared(r2.seq, r2.cigar)
-                    start = r2.reference_start - reg[1] 
-                    arr2[start:start + len(seq)] = list(seq)
-                    
-                    arr3 = join_arrays(arr1, arr2)
-                    pairseq = "".join(arr3)
-
-                    ori = "+"
-                    if r1.is_reverse:
-                        ori = "-"
-                    derep = r1.qname.split("=")[-1]
-                    rname = "{}:{}-{};size={};{}".format(
-                        reg[0], reg[1], reg[2], derep, ori)
-                    # *reg, derep, ori)
-                    clust.append("{}\n{}".format(rname, pairseq))
-
-        # single-end data cluster building
-        else:   
-            mstart = int(9e12)
-            mend = 0
-
-            for read in reads:
-                rdict[read.qname] = read
-                mstart = min(mstart, read.aend - read.alen)
-                mend = max(mend, read.aend)
-        
-            # sort keys by derep number
-            keys = sorted(
-                rdict.keys(),
-                key=lambda x: int(x.split("=")[-1]), reverse=True)
-
-            # build the cluster based on map positions, orientation, cigar
-            clust = []
-            for key in keys:
-                r1 = rdict[key]
-
-                #aref = np.array(list(ref[1]))
-                lref = mend - mstart
-                arr1 = np.zeros(lref, dtype="U1")
-                arr1.fill("-")
-
-                # how far ahead of the start does this read begin
-                seq = cigared(r1.seq, r1.cigar)
-                rstart = (r1.aend - r1.alen) - mstart
-                arr1[rstart:rstart + len(seq)] = list(seq)
-                aseq = "".join(arr1)
-
-                ori = "+"
-                if r1.is_reverse:
-                    ori = "-"
-                derep = r1.qname.split("=")[-1]
-                rname = "{}:{}-{};size={};{}".format(
-                    reg[0], mstart, mend, derep, ori)
-                clust.append("{}\n{}".format(rname, aseq))
-
-        # store this cluster
+        if ispair:
+            clust = build_pair_cluster(bamfile.fetch(*reg), reg)
+        else:
+            clust = build_single_cluster(bamfile.fetch(*reg), reg)
         if clust:
-            clusters.append("\n".join(clust))
-            idx += 1
+            clusters.append(clust)
+
+        # if 10000 clusters stored then write to disk
+        if len(clusters) == 10000:
+            out.write("\n//\n//\n".join(clusters) + "\n//\n//\n")
+            clusters = []
 
-        # if 1000 clusters stored then write to disk
-        if not idx % 10000:
-            if clusters:
-                out.write("\n//\n//\n".join(clusters) + "\n//\n//\n")
-                clusters = []
- 
     # write final remaining clusters to disk
     if clusters:
         out.write("\n//\n//\n".join(clusters) + "\n//\n//\n")
     out.close()
+    bamfile.close()
+
+
+
+def build_pair_cluster(reads, reg):
+    """
+    Returns a cluster string for the paired reads in a region where the 
+    rows are ordered by derep size and read1 and read2 are joined.
+    """
+    # match paired reads together in a dictionary (in order of first read)
+    rdict = {}
+    for read in reads:
+        if read.qname not in rdict:
+            rdict[read.qname] = [read, None]
+        else:
+            rdict[read.qname][1] = read
+    pairs = [i for i in rdict.values() if i[1] is not None]
+    if not pairs:
+        return ""
+
+    # fill read1s and read2s into separate arrays and join them
+    lref = reg[2] - reg[1]
+    arr1 = fill_reads([i[0] for i in pairs], reg[1], lref)
+    arr2 = fill_reads([i[1] for i in pairs], reg[1], lref)
+    arr = join_arrays(arr1, arr2)
+
+    names = [
+        "{}:{}-{};size={};{}".format(
+            reg[0], reg[1], reg[2], 
+            r1.qname.split("=")[-1], "-" if r1.is_reverse else "+")
+        for (r1, _) in pairs
+    ]
+    return cluster_string(arr, names)
+
+
+
+def build_single_cluster(reads, reg):
+    """
+    Returns a cluster string for the single reads in a region, where the
+    rows are ordered by derep size and span from the leftmost start to the 
+    rightmost end of the reads.
+    """
+    rdict = {}
+    mstart = int(9e12)
+    mend = 0
+    for read in reads:
+        rdict[read.qname] = read
+        mstart = min(mstart, read.reference_start)
+        mend = max(mend, read.reference_end)
+    if not rdict:
+        return ""
+
+    reads = list(rdict.values())
+    arr = fill_reads(reads, mstart, mend - mstart)
+    names = [
+        "{}:{}-{};size={};{}".format(
+            reg[0], mstart, mend, 
+            r1.qname.split("=")[-1], "-" if r1.is_reverse else "+")
+        for r1 in reads
+    ]
+    return cluster_string(arr, names)
+
+
+
+def fill_reads(reads, offset, lref):
+    """
+    Returns a uint8 array of shape (nreads, lref) with the query sequence
+    of each read filled in at its mapped position relative to offset.
+    """
+    seqs = [i.query_sequence for i in reads]
+    cigars = [i.cigartuples for i in reads]
+    seqidx = np.zeros(len(reads) + 1, dtype=np.int64)
+    seqidx[1:] = np.cumsum([len(i) for i in seqs])
+    cigidx = np.zeros(len(reads) + 1, dtype=np.int64)
+    cigidx[1:] = np.cumsum([len(i) for i in cigars])
+    starts = np.array(
+        [i.reference_start - offset for i in reads], dtype=np.int64)
+
+    arr = np.full((len(reads), lref), 45, dtype=np.uint8)
+    fill_cigar_rows(
+        arr, 
+        starts,
+        np.frombuffer("".join(seqs).encode(), dtype=np.uint8),
+        seqidx,
+        np.array(list(chain(*cigars)), dtype=np.int64).reshape(-1, 2),
+        cigidx,
+    )
+    return arr
+
+
+
+@njit
+def fill_cigar_rows(arr, starts, seqs, seqidx, cigars, cigidx):
+    "fill each read into a row of arr by walking over its cigar operations"
+    for row in range(starts.size):
+        rpos = starts[row]
+        qpos = seqidx[row]
+        for cidx in range(cigidx[row], cigidx[row + 1]):
+            flag = cigars[cidx, 0]
+            add = cigars[cidx, 1]
+            # match (M, =, X): copy bases
+            if flag == 0 or flag == 7 or flag == 8:
+                for pos in range(add):
+                    arr[row, rpos + pos] = seqs[qpos + pos]
+                rpos += add
+                qpos += add
+            # insertion or softclip: skip query bases
+            elif flag == 1 or flag == 4:
+                qpos += add
+            # deletion or skip: leave "-" in the row
+            elif flag == 2 or flag == 3:
+                rpos += add
+
+
+
+def join_arrays(arr1, arr2):
+    """
+    join read1 and read2 arrays and resolve overlaps. Where one read has
+    data and the other a gap the base is kept, and where bases conflict 
+    they are set to N.
+    """
+    arr3 = np.full(arr1.shape, 78, dtype=np.uint8)
+    same = arr1 == arr2
+    arr3[same] = arr1[same]
+    mask = (arr1 == 45) & ~same
+    arr3[mask] = arr2[mask]
+    mask = (arr2 == 45) & ~same
+    arr3[mask] = arr1[mask]
+    mask = (arr1 == 78) & (arr2 != 45)
+    arr3[mask] = arr2[mask]
+    mask = (arr2 == 78) & (arr1 != 45)
+    arr3[mask] = arr1[mask]
+    return arr3
+
+
+
+def cluster_string(arr, names):
+    "returns rows of arr as a cluster string with rows sorted by derep size"
+    sizes = np.array([int(i.split("=")[-1].split(";")[0]) for i in names])
+    order = np.argsort(-sizes, kind="mergesort")
+    seqs = arr.view("S{}".format(arr.shape[1])).ravel()
+    return "\n".join(
+        "{}\n{}".format(names[i], seqs[i].decode()) for i in order)
+
+
+
+def concat_region_clusters(data, sample):
+    "concatenates cluster blocks built from regions in order"
+    chunks = glob.glob(os.path.join(
+        data.tmpdir, sample.name + "_regions_[0-9]*.clust"))
+    chunks.sort(key=lambda x: int(x.rsplit("_", 1)[-1][:-6]))
+
+    write_cluster_store(data, sample, chunks)
+    for fname in chunks:
+        os.remove(fname[:-6] + ".bed")
 
 
 def split_endtoend_reads(data, sample):
@@ -1862,111 +1935,145 @@ def split_endtoend_reads(data, sample):
 #     return listseq
 
 
-def join_arrays(arr1, arr2):
-    "join read1 and read2 arrays and resolve overlaps"
-    arr3 = np.zeros(arr1.size, dtype="U1")
-    for i in range(arr1.size):
+def get_quick_depths(data, sample, force=False):
+    """
+    Returns arrays of the max length and depth of each cluster of a sample,
+    read from the cluster index if it is up to date, or else by indexing 
+    the clustS file (see index_clusters), e.g., of an older assembly.
+    """
+    ## use existing sample cluster path if it exists, since this
+    ## func can be used in step 4 and that can occur after merging
+    ## assemblies after step3, and if we then referenced by data.dirs.clusts
+    ## the path would be broken.
+    if not sample.files.clusters:
+        sample.files.clusters = os.path.join(
+            data.dirs.clusts,
+            "{}.clustS.gz".format(sample.name))
 
-        if arr1[i] == arr2[i]:
-            arr3[i] = arr1[i]
+    index = load_cluster_index(sample)
+    if force or index is None:
+        index = index_clusters(sample)
+    return index["maxlens"], index["depths"]
 
-        elif arr1[i] == "N":
-            if arr2[i] == "-":
-                arr3[i] = "N"
-            else:
-                arr3[i] = arr2[i]
 
-        elif arr2[i] == "N":
-            if arr1[i] == "-":
-                arr3[i] = "N"
-            else:
-                arr3[i] = arr1[i]
 
-        elif arr1[i] == "-":
-            if arr2[i] == "N":
-                arr3[i] = "N"
-            else:
-                arr3[i] = arr2[i]
+def get_cluster_index_path(sample):
+    "returns the path to the cluster index (.npz) next to the clustS file"
+    return sample.files.clusters.rsplit(".gz", 1)[0] + ".npz"
 
-        elif arr2[i] == "-":
-            if arr1[i] == "N":
-                arr3[i] = "N"
-            else:
-                arr3[i] = arr1[i]
 
-        else:
-            arr3[i] = "N"
-    return arr3
 
+def get_cluster_store_path(sample):
+    "returns the path to the ClusterStore (.hdf5) next to the clustS file"
+    return sample.files.clusters.rsplit(".gz", 1)[0] + ".hdf5"
 
-def cigared(sequence, cigartups):
-    "modify sequence based on its cigar string"
-    start = 0
-    seq = ""
-    for tup in cigartups:
-        flag, add = tup
-        if flag == 0:
-            seq += sequence[start:start + add]
-        if flag == 1:
-            pass
-        if flag == 2:
-            seq += "-" * add
-            start -= add
-        if flag == 4:
-            pass
-        start += add
-    return seq
 
 
-def get_quick_depths(data, sample):
-    "iterate over clustS files to get data"
+def load_cluster_index(sample):
+    """
+    Returns the cluster index of a sample as a dict of arrays, or None if 
+    there is no index or ClusterStore. The index is written last, after the
+    ClusterStore and any clustS export, so it is also None if the index is
+    older than a clustS file (e.g., written by an older version).
+    """
+    ipath = get_cluster_index_path(sample)
+    for path in (ipath, get_cluster_store_path(sample)):
+        if not os.path.exists(path):
+            return None
+    if os.path.exists(sample.files.clusters):
+        if os.path.getmtime(ipath) < os.path.getmtime(sample.files.clusters):
+            return None
+    with np.load(ipath) as index:
+        return {i: index[i] for i in index.files}
 
-    ## use existing sample cluster path if it exists, since this
-    ## func can be used in step 4 and that can occur after merging
-    ## assemblies after step3, and if we then referenced by data.dirs.clusts
-    ## the path would be broken.
-    if not sample.files.clusters:
-        sample.files.clusters = os.path.join(
-            data.dirs.clusts,
-            "{}.clustS.gz".format(sample.name))
 
+
+def save_cluster_index(sample, depths, maxlens):
+    "write the depth and max length of each cluster to the cluster index"
+    index = {
+        "depths": np.array(depths, dtype=np.int64),
+        "maxlens": np.array(maxlens, dtype=np.int64),
+    }
+    with open(get_cluster_index_path(sample), 'wb') as out:
+        np.savez(out, **index)
+    return index
+
+
+
+def write_cluster_store(data, sample, chunks):
+    """
+    Writes the clusters in text chunk files, in order, to the ClusterStore
+    of the sample, and the depth and max length (of the last read, with a 
+    newline, as in the clustS format) of each to the cluster index. Chunk 
+    files are removed. The clusters are also exported as a clustS file 
+    unless hackersonly.write_clustS is False, in which case an old clustS 
+    file is left as is (load_cluster_index uses the newer of the two).
+    """
+    sample.files.clusters = os.path.join(
+        data.dirs.clusts, sample.name + ".clustS.gz")
+
+    depths = []
+    maxlens = []
+    with ClusterStore(get_cluster_store_path(sample), 'w') as store:
+        for fname in chunks:
+            with open(fname, 'rb') as infile:
+                dat = infile.read()
+            os.remove(fname)
+            for clust in dat.split(b"//\n//\n"):
+                lines = clust.strip().split(b"\n")
+                if not lines[0]:
+                    continue
+                store.add_text(lines)
+                depths.append(sum(
+                    int(i.split(b"=")[-1][:-2]) for i in lines[::2]))
+                maxlens.append(len(lines[-1]) + 1)
+
+    # optional text export
+    if data.hackersonly.write_clustS:
+        with ClusterStore(get_cluster_store_path(sample)) as store:
+            store.to_text(sample.files.clusters)
+    save_cluster_index(sample, depths, maxlens)
+
+
+
+def index_clusters(sample):
+    """
+    Iterates over the clustS file once to write its clusters to a binary 
+    ClusterStore, and to get the depth and max length of each cluster, 
+    which are saved to the cluster index of the sample. 
+    """
+    depths = []
+    maxlens = []
+    store = ClusterStore(get_cluster_store_path(sample), 'w')
     try:
-        # get new clustered loci
-        with gzip.open(sample.files.clusters, 'rt') as infile:
+        with gzip.open(sample.files.clusters, 'rb') as infile:
             pairdealer = izip(*[iter(infile)] * 2)
 
-            ## storage
-            depths = []
-            maxlen = []
-
             ## start with cluster 0
             tdepth = 0
             tlen = 0
+            clust = []
+            for name, seq in pairdealer:
 
-            ## iterate until empty
-            while 1:
-                ## grab next
-                try:
-                    name, seq = next(pairdealer)
-                except StopIteration:
-                    break
-
-                # if not the end of a cluster
+                # if the end of a cluster
                 if name.strip() == seq.strip():
                     depths.append(tdepth)
-                    maxlen.append(tlen)
+                    maxlens.append(tlen)
+                    store.add_text(clust)
                     tlen = 0
                     tdepth = 0
+                    clust = []
 
                 else:
-                    tdepth += int(name.strip().split("=")[-1][:-2])
+                    tdepth += int(name.strip().split(b"=")[-1][:-2])
                     tlen = len(seq)
-    except TypeError:
+                    clust.extend((name, seq))
+    except (TypeError, ValueError):
         raise IPyradError(
             "error in get_quick_depths(): {}".format(sample.files.clusters))
-
-    # return
-    return np.array(maxlen), np.array(depths)
+    finally:
+        store.close()
+    return save_cluster_index(sample, depths, maxlens)
 
 
 def store_sample_stats(data, sample, maxlens, depths):
@@ -2137,6 +2244,12 @@ def declone_3rad(data, sample):
 
 
 # globals
+# max number of sequences aligned in a cluster, the number of align chunks 
+# per engine across samples, and the max number of chunks for one sample.
+MAXALIGNSEQS = 200
+ALIGNCHUNKS = 4
+MAXALIGNCHUNKS = 200
+
 NO_ZIP_BINS = """
   Reference sequence must be de-compressed fasta or bgzip compressed,
   your file is probably gzip compressed. The simplest fix is to gunzip
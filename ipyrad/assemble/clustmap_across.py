@@ -6,9 +6,8 @@
 from __future__ import print_function
 try:
     from builtins import range
-    from itertools import izip, chain
+    from itertools import izip
 except ImportError:
-    from itertools import chain
     izip = zip
 
 import os
@@ -25,7 +24,8 @@ import subprocess as sps
 import numpy as np
 from pysam import AlignmentFile, FastaFile
 import ipyrad
-from .utils import IPyradError, fullcomp, chroms2ints
+from .utils import (
+    IPyradError, SeqStore, MuscleAligner, fullcomp, chroms2ints)
 
 
 class Step6:
@@ -366,42 +366,58 @@ class Step6:
             buildfunc = build_single_denovo_clusters
         usort = uhandle + ".sort"
 
-        # sort utemp files, count seeds.
+        # sort utemp files, count seeds, and index all consens in a store
         start = time.time()
         printstr = ("building clusters   ", "s6")
+        prefix = os.path.join(
+            self.data.tmpdir, "{}-catcons".format(self.data.name))
         async1 = self.lbview.apply(sort_seeds, uhandle)
-        while 1:
-            ready = [async1.ready()]
-            self.data._progressbar(3, sum(ready), start, printstr)
-            time.sleep(0.1)
-            if all(ready):
-                break
-
         async2 = self.lbview.apply(count_seeds, uhandle)
+        async3 = self.lbview.apply(
+            build_consens_store, 
+            *(prefix, get_consens_handles(self.samples)))
+        prejobs = [async1, async2, async3]
         while 1:
-            ready = [async1.ready(), async2.ready()]
-            self.data._progressbar(3, sum(ready), start, printstr)
+            ready = [i.ready() for i in prejobs]
+            self.data._progressbar(len(ready) + 1, sum(ready), start, printstr)
             time.sleep(0.1)
             if all(ready):
                 break
+        for job in prejobs:
+            if not job.successful():
+                job.get()
         nseeds = async2.get()
 
-        # send the clust bit building job to work and track progress
-        async3 = self.lbview.apply(
-            buildfunc, *(self.data, usort, nseeds, list(self.cgroups.keys())))
+        # set optim to approximately 4 chunks per core. Smaller allows for a 
+        # bit cleaner looking progress bar. 40 cores will make 160 files.
+        # The sorted hits are split into as many partitions by seed, and 
+        # clusters of each are built on a separate engine.
+        nparts = self.data.ncpus * 4
+        optim = max(1, (nseeds // nparts) + (nseeds % nparts))
+        spans = get_seed_partitions(usort, nparts)
+        jobids = list(self.cgroups.keys())
+        jobs = [
+            self.lbview.apply(
+                buildfunc, *(self.data, usort, span, optim, prefix, jobids))
+            for span in spans
+        ]
+        alljobs = prejobs + jobs
         while 1:
-            ready = [async1.ready(), async2.ready(), async3.ready()]
-            self.data._progressbar(3, sum(ready), start, printstr)
+            ready = [i.ready() for i in alljobs]
+            self.data._progressbar(len(ready), sum(ready), start, printstr)
             time.sleep(0.1)
             if all(ready):
                 break
         self.data._print("")
 
         # check for errors
-        for job in [async1, async2, async3]:
+        for job in jobs:
             if not job.successful():
                 job.get()
 
+        # remove the consens store
+        SeqStore(None, prefix).close()
+
 
     def remote_align_denovo_clusters(self):
         "align denovo clusters built from vsearch clustering"
@@ -429,11 +445,14 @@ class Step6:
 
         # check for errors in muscle_align_across
         keys = list(jobs.keys())
+        stats = []
         for idx in keys:
             if not jobs[idx].successful():
                 jobs[idx].get()
+            stats.append(jobs[idx].get())
             del jobs[idx]
         self.data._print("")
+        self.data._print(MuscleAligner.summary(stats))
 
 
     def concat_alignments(self):
@@ -850,93 +869,59 @@ def build_concat_two(data, jobids, randomseed):
     proc1.stdout.close()
 
 
+def get_consens_handles(samples):
+    "sorted consens files of samples that have consens reads"
+    return sorted(
+        sample.files.consens for sample in samples if 
+        sample.stats.reads_consens)
+
+
+# hetero sites are replaced by one of their bases (a pseudo-haplotype) in the
+# input to across-sample clustering to avoid mismatches at hetero sites. The
+# read data with hetero sites is put back into clustered data later. This is
+# a translation table for bytes.translate()
+PSEUDOHAPLOS = np.arange(256, dtype=np.uint8)
+PSEUDOHAPLOS[np.frombuffer(b"WwRrMmKkSsYy", dtype=np.uint8)] = (
+    np.frombuffer(b"AAAAAATTCCCC", dtype=np.uint8))
+PSEUDOHAPLOS = PSEUDOHAPLOS.tobytes()
+
+
 def build_concat_files(data, jobid, samples, randomseed):
     """
     [This is returnn on an ipengine]
     Make a concatenated consens file with sampled alleles (no RSWYMK/rswymk).
-    Orders reads by length and shuffles randomly within length classes
+    Orders reads by length and shuffles randomly within length classes. 
+    Each consens file is read once, with reads bucketed by length in memory,
+    and the shuffled buckets are written as the vsearch input.
     """
-    conshandles = [
-        sample.files.consens for sample in samples if 
-        sample.stats.reads_consens]
-    conshandles.sort()
+    conshandles = get_consens_handles(samples)
     assert conshandles, "no consensus files found"
 
-    ## concatenate all of the gzipped consens files
-    cmd = ['cat'] + conshandles
-    groupcons = os.path.join(
-        data.dirs.across, 
-        "{}-{}-catcons.gz".format(data.name, jobid))
-    with open(groupcons, 'w') as output:
-        call = sps.Popen(cmd, stdout=output, close_fds=True)
-        call.communicate()
-
-    ## a string of sed substitutions for temporarily replacing hetero sites
-    ## skips lines with '>', so it doesn't affect taxon names
-    subs = ["/>/!s/W/A/g", "/>/!s/w/A/g", "/>/!s/R/A/g", "/>/!s/r/A/g",
-            "/>/!s/M/A/g", "/>/!s/m/A/g", "/>/!s/K/T/g", "/>/!s/k/T/g",
-            "/>/!s/S/C/g", "/>/!s/s/C/g", "/>/!s/Y/C/g", "/>/!s/y/C/g"]
-    subs = ";".join(subs)
-
-    ## impute pseudo-haplo information to avoid mismatch at hetero sites
-    ## the read data with hetero sites is put back into clustered data later.
-    ## pipe passed data from gunzip to sed.
-    cmd1 = ["gunzip", "-c", groupcons]
-    cmd2 = ["sed", subs]
-
-    proc1 = sps.Popen(cmd1, stdout=sps.PIPE, close_fds=True)
-    allhaps = groupcons.replace("-catcons.gz", "-cathaps.fa")
-    with open(allhaps, 'w') as output:
-        proc2 = sps.Popen(cmd2, stdin=proc1.stdout, stdout=output, close_fds=True)
-        proc2.communicate()
-    proc1.stdout.close()
-
-    ## now sort the file using vsearch
-    allsort = groupcons.replace("-catcons.gz", "-catsort.fa")
-    cmd1 = [ipyrad.bins.vsearch,
-            "--sortbylength", allhaps,
-            "--fasta_width", "0",
-            "--output", allsort]
-    proc1 = sps.Popen(cmd1, close_fds=True)
-    proc1.communicate()
+    # bucket 2-line fasta records by length with hetero sites replaced
+    buckets = {}
+    for handle in conshandles:
+        with gzip.open(handle, 'rb') as infile:
+            for name, seq in izip(*[iter(infile)] * 2):
+                seq = seq.rstrip().translate(PSEUDOHAPLOS)
+                record = name.rstrip() + b"\n" + seq + b"\n"
+                if len(seq) in buckets:
+                    buckets[len(seq)].append(record)
+                else:
+                    buckets[len(seq)] = [record]
 
     ## shuffle sequences within size classes. Tested seed (8/31/2016)
     ## shuffling works repeatably with seed.
     random.seed(randomseed)
 
-    ## open an iterator to lengthsorted file and grab two lines at at time
-    allshuf = groupcons.replace("-catcons.gz", "-catshuf.fa")
-    outdat = open(allshuf, 'wt')
-    indat = open(allsort, 'r')
-    idat = izip(iter(indat), iter(indat))
-    done = 0
-
-    chunk = [next(idat)]
-    while not done:
-        ## grab 2-lines until they become shorter (unless there's only one)
-        oldlen = len(chunk[-1][-1])
-        while 1:
-            try:
-                dat = next(idat)
-            except StopIteration:
-                done = 1
-                break
-            if len(dat[-1]) == oldlen:
-                chunk.append(dat)
-            else:
-                ## send the last chunk off to be processed
-                random.shuffle(chunk)
-                outdat.write("".join(chain(*chunk)))
-                ## start new chunk
-                chunk = [dat]
-                break
-
-    ## do the last chunk
-    random.shuffle(chunk)
-    outdat.write("".join(chain(*chunk)))
-
-    indat.close()
-    outdat.close()
+    ## write size classes from longest to shortest
+    allshuf = os.path.join(
+        data.dirs.across, 
+        "{}-{}-catshuf.fa".format(data.name, jobid))
+    with open(allshuf, 'wb') as outdat:
+        for length in sorted(buckets, reverse=True):
+            chunk = buckets.pop(length)
+            random.shuffle(chunk)
+            outdat.write(b"".join(chunk))
 
 
 def cluster(data, jobid, nthreads, print_progress=False):
@@ -1044,120 +1029,133 @@ def sort_seeds(uhandle):
     proc.communicate()
 
 
-def build_single_denovo_clusters(data, usort, nseeds, *args):
-    "use this function when not hierarchical clustering"
-    # load all concat fasta files into a dictionary (memory concerns here...)
-    conshandle = os.path.join(
-        data.dirs.across, 
-        "{}-0-catcons.gz".format(data.name),
-    )
-    allcons = {}
-    with gzip.open(conshandle, 'rt') as iocons:
-        cons = izip(*[iter(iocons)] * 2)
-        for namestr, seq in cons:
-            nnn, sss = [i.strip() for i in (namestr, seq)]
-            allcons[nnn[1:]] = sss
-
-    # load all utemp files into a dictionary
-    usortfile = os.path.join(
-        data.dirs.across,
-        "{}-0.utemp.sort".format(data.name)
-    )
-
-    # set optim to approximately 4 chunks per core. Smaller allows for a bit
-    # cleaner looking progress bar. 40 cores will make 160 files.
-    optim = ((nseeds // (data.ncpus * 4)) + (nseeds % (data.ncpus * 4)))
-
-    # iterate through usort grabbing seeds and matches
-    with open(usortfile, 'rt') as insort:
-        # iterator, seed null, and seqlist null
-        isort = iter(insort)
-        loci = 0
-        lastseed = 0
-        fseqs = []
-        seqlist = []
-        seqsize = 0
+def build_consens_store(prefix, conshandles):
+    "index all consens fasta files in a disk-backed store shared by engines"
+    SeqStore(conshandles, prefix).close(remove=False)
 
-        while 1:
-            try:
-                hit, seed, ori = next(isort).strip().split()
-            except StopIteration:
+
+def get_seed_partitions(usort, npartitions):
+    """
+    Returns (start, end) byte spans of the sorted utemp file that split it 
+    into about npartitions parts of equal size, where all hits to a seed 
+    are in the same part, so that clusters can be built from each part on
+    separate engines.
+    """
+    size = os.path.getsize(usort)
+    bounds = [0]
+    with open(usort, 'rb') as insort:
+        for pidx in range(1, npartitions):
+            # skip to the start of the next full line after the split
+            pos = max(bounds[-1], size * pidx // npartitions)
+            insort.seek(pos)
+            if pos:
+                insort.readline()
+
+            # advance to the first line of the next seed
+            line = insort.readline()
+            if not line:
                 break
-        
-            # store hit if still matching to same seed
-            if seed == lastseed:
-                if ori == "-":
-                    seq = fullcomp(allcons[hit])[::-1]
-                else:
-                    seq = allcons[hit]
-                fseqs.append(">{}\n{}".format(hit, seq))
-
-            # store seed and hit (to a new cluster) if new seed.
-            else:  
-                # store the last fseq, count it, and clear it
-                if fseqs:
-                    seqlist.append("\n".join(fseqs))
-                    seqsize += 1
-                    fseqs = []
-
-                # occasionally write to file
-                if seqsize >= optim:
-                    if seqlist:
-                        loci += seqsize
-                        pathname = os.path.join(
-                            data.tmpdir, 
-                            "{}.chunk_{}".format(data.name, loci))
-                        with open(pathname, 'wt') as clustout:
-                            clustout.write(
-                                "\n//\n//\n".join(seqlist) + "\n//\n//\n")
-                        # reset counter and list
-                        seqlist = []
-                        seqsize = 0
-
-                # store the new seed on top of fseqs
-                fseqs.append(">{}\n{}".format(seed, allcons[seed]))
-                lastseed = seed
-
-                # store the first hit to the seed
+            seed = line.split()[1]
+            while line and line.split()[1] == seed:
+                line = insort.readline()
+            if not line:
+                break
+            bounds.append(insort.tell() - len(line))
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def iter_seed_hits(usort, span):
+    "yields (offset, hit, seed, ori) of each line in a span of sorted utemp"
+    with open(usort, 'rb') as insort:
+        insort.seek(span[0])
+        offset = span[0]
+        while offset < span[1]:
+            line = insort.readline()
+            if not line:
+                break
+            hit, seed, ori = line.decode().strip().split()
+            yield offset, hit, seed, ori
+            offset += len(line)
+
+
+def write_denovo_chunk(data, seqlist, chunkid):
+    """
+    Writes clusters to a chunk file for remote_align_denovo_clusters. The
+    chunkid is the byte offset in the sorted utemp file where its clusters
+    end, which is unique and keeps chunks in order across partitions.
+    """
+    pathname = os.path.join(
+        data.tmpdir, 
+        "{}.chunk_{}".format(data.name, chunkid))
+    with open(pathname, 'wt') as clustout:
+        clustout.write("\n//\n//\n".join(seqlist) + "\n//\n//\n")
+
+
+def build_single_denovo_clusters(data, usort, span, optim, prefix, jobids):
+    "use this function when not hierarchical clustering"
+    # open the disk-backed store of all consens accessed by name
+    allcons = SeqStore(None, prefix)
+
+    # iterate through a span of usort grabbing seeds and matches
+    lastseed = 0
+    fseqs = []
+    seqlist = []
+    for offset, hit, seed, ori in iter_seed_hits(usort, span):
+
+        # store hit if still matching to same seed
+        if seed == lastseed:
+            if ori == "-":
+                seq = fullcomp(allcons[hit])[::-1]
+            else:
                 seq = allcons[hit]
-                if ori == "-":
-                    seq = fullcomp(seq)[::-1]
-                fseqs.append(">{}\n{}".format(hit, seq))
+            fseqs.append(">{}\n{}".format(hit, seq))
+
+        # store seed and hit (to a new cluster) if new seed.
+        else:  
+            # store the last fseq, count it, and clear it
+            if fseqs:
+                seqlist.append("\n".join(fseqs))
+                fseqs = []
+
+            # occasionally write to file
+            if len(seqlist) >= optim:
+                write_denovo_chunk(data, seqlist, offset)
+                seqlist = []
+
+            # store the new seed on top of fseqs
+            fseqs.append(">{}\n{}".format(seed, allcons[seed]))
+            lastseed = seed
+
+            # store the first hit to the seed
+            seq = allcons[hit]
+            if ori == "-":
+                seq = fullcomp(seq)[::-1]
+            fseqs.append(">{}\n{}".format(hit, seq))
 
     # write whatever is left over to the clusts file
     if fseqs:
         seqlist.append("\n".join(fseqs))
-        seqsize += 1
-        loci += seqsize
     if seqlist:
-        pathname = os.path.join(data.tmpdir, 
-            data.name + ".chunk_{}".format(loci))
-        with open(pathname, 'wt') as clustsout:
-            clustsout.write("\n//\n//\n".join(seqlist) + "\n//\n//\n")
+        write_denovo_chunk(data, seqlist, span[1])
 
     ## final progress and cleanup
-    del allcons
+    allcons.close(remove=False)
 
 
-def build_hierarchical_denovo_clusters(data, usort, nseeds, jobids):
+def build_hierarchical_denovo_clusters(
+    data, usort, span, optim, prefix, jobids):
     "use this function when building clusters from hierarchical clusters"
-    # load all concat fasta files into a dictionary (memory concerns here...)
-    allcons = {}
-    conshandles = [
-        os.path.join(
-            data.dirs.across, "{}-{}-catcons.gz".format(data.name, jobid))
-        for jobid in jobids]
-    for conshandle in conshandles:
-        subcons = {}
-        with gzip.open(conshandle, 'rt') as iocons:
-            cons = izip(*[iter(iocons)] * 2)
-            for namestr, seq in cons:
-                nnn, sss = [i.strip() for i in (namestr, seq)]
-                subcons[nnn[1:]] = sss
-        allcons.update(subcons)
-        del subcons
-
-    # load all utemp files into a dictionary
+    # open the disk-backed store of all consens accessed by name
+    allcons = SeqStore(None, prefix)
+
+    # names of seeds and hits in this span, which are seeds in tier 1
+    names = set()
+    for _, hit, seed, _ in iter_seed_hits(usort, span):
+        names.add(hit)
+        names.add(seed)
+
+    # load tier 1 hits to these seeds from the utemp files into a dictionary
     subdict = {}
     usortfiles = [
         os.path.join(data.dirs.across, "{}-{}.utemp".format(data.name, jobid))
@@ -1167,53 +1165,31 @@ def build_hierarchical_denovo_clusters(data, usort, nseeds, jobids):
         with open(ufile, 'r') as inhits:
             for line in inhits:
                 hit, seed, ori = line.strip().split()
+                if seed not in names:
+                    continue
                 if seed not in subdict:
                     subdict[seed] = [(hit, ori)]
                 else:
                     subdict[seed].append((hit, ori))
+    del names
 
-    # set optim to approximately 4 chunks per core. Smaller allows for a bit
-    # cleaner looking progress bar. 40 cores will make 160 files.
-    optim = ((nseeds // (data.ncpus * 4)) + (nseeds % (data.ncpus * 4)))
-
-    # iterate through usort grabbing seeds and matches
-    insort = open(usort, 'rt')
-    isort = iter(insort)
-
-    # seed null, and seqlist null
-    loci = 0
+    # iterate through a span of usort grabbing seeds and matches
     lastseed = 0
     fseqs = []
     seqlist = []
-    seqsize = 0
-
-    while 1:
-        try:
-            hit, seed, ori = next(isort).strip().split()
-        except StopIteration:
-            break
+    for offset, hit, seed, ori in iter_seed_hits(usort, span):
     
         # if same seed append match
         if seed != lastseed:
             # store the last fseq, count it, and clear it
             if fseqs:
                 seqlist.append("\n".join(fseqs))
-                seqsize += 1
                 fseqs = []
 
             # occasionally write to file
-            if seqsize >= optim:
-                if seqlist:
-                    loci += seqsize
-                    pathname = os.path.join(
-                        data.tmpdir, 
-                        "{}.chunk_{}".format(data.name, loci))
-                    with open(pathname, 'wt') as clustout:
-                        clustout.write(
-                            "\n//\n//\n".join(seqlist) + "\n//\n//\n")
-                    # reset counter and list
-                    seqlist = []
-                    seqsize = 0
+            if len(seqlist) >= optim:
+                write_denovo_chunk(data, seqlist, offset)
+                seqlist = []
 
             # store the new seed on top of fseqs
             fseqs.append(">{}\n{}".format(seed, allcons[seed]))
@@ -1222,8 +1198,8 @@ def build_hierarchical_denovo_clusters(data, usort, nseeds, jobids):
             # expand subhits to seed
             uhits = subdict.get(seed)
             if uhits:
-                for ahit, ori in uhits:
-                    if ori == "-":
+                for ahit, aori in uhits:
+                    if aori == "-":
                         seq = fullcomp(allcons[ahit])[::-1]
                     else:
                         seq = allcons[ahit]
@@ -1233,31 +1209,23 @@ def build_hierarchical_denovo_clusters(data, usort, nseeds, jobids):
         hitseqs = [(hit, allcons[hit], ori)]
         uhits = subdict.get(hit)
         if uhits:
-            for hit in uhits:
-                hitseqs.append((hit[0], allcons[hit[0]], hit[1]))
+            for uhit in uhits:
+                hitseqs.append((uhit[0], allcons[uhit[0]], uhit[1]))
 
         # revcomp if orientation is reversed
-        for sname, seq, ori in hitseqs:
-            if ori == "-":
+        for sname, seq, sori in hitseqs:
+            if sori == "-":
                 seq = fullcomp(seq)[::-1]
             fseqs.append(">{}\n{}".format(sname, seq))
 
-    # close handle
-    insort.close()
-
     ## write whatever is left over to the clusts file
     if fseqs:
         seqlist.append("\n".join(fseqs))
-        seqsize += 1
-        loci += seqsize
     if seqlist:
-        pathname = os.path.join(data.tmpdir, 
-            data.name + ".chunk_{}".format(loci))
-        with open(pathname, 'wt') as clustsout:
-            clustsout.write("\n//\n//\n".join(seqlist) + "\n//\n//\n")
+        write_denovo_chunk(data, seqlist, span[1])
 
     ## final progress and cleanup
-    del allcons
+    allcons.close(remove=False)
 
 
 def align_to_array(data, samples, chunk):
@@ -1269,51 +1237,45 @@ def align_to_array(data, samples, chunk):
     # snames to ensure sorted order
     samples.sort(key=lambda x: x.name)
 
-    # create a persistent shell for running muscle in. 
-    proc = sps.Popen(["bash"], stdin=sps.PIPE, stdout=sps.PIPE, bufsize=0)
-
-    # iterate over clusters until finished
-    allstack = []
+    # build fasta inputs for all clusters
+    fastas = []
     for ldx in range(len(clusts)):
-        istack = []
         lines = clusts[ldx].strip().split("\n")
         names = lines[::2]
         seqs = lines[1::2]
-        align1 = []
-        
-        # find duplicates and skip aligning but keep it for downstream.
-        #unames = set([i.rsplit("_", 1)[0] for i in names])
-        #if len(unames) < len(names):
-        #    istack = ["{}\n{}".format(i[1:], j) for i, j in zip(names, seqs)]
-        #else:
-    
+
         # append counter to names because muscle doesn't retain order
         nnames = [">{};*{}".format(j[1:], i) for i, j in enumerate(names)]
 
         # make back into strings
-        cl1 = "\n".join(["\n".join(i) for i in zip(nnames, seqs)])                
+        fastas.append(
+            "\n".join(["\n".join(i) for i in zip(nnames, seqs)]) + "\n")
 
-        # store allele (lowercase) info, returns mask with lowercases
-        amask, abool = store_alleles(seqs)
+    # align all clusters with several muscle processes running at once
+    with MuscleAligner() as aligner:
+        alignments = aligner.align(fastas)
+        stats = aligner.stats
 
-        # send align1 to the bash shell (TODO: check for pipe-overflow)
-        cmd1 = ("echo -e '{}' | {} -quiet -in - ; echo {}"
-                .format(cl1, ipyrad.bins.muscle, "//\n"))
-        proc.stdin.write(cmd1.encode())
+    # iterate over clusters until finished
+    allstack = []
+    for ldx in range(len(clusts)):
+        istack = []
+        lines = clusts[ldx].strip().split("\n")
+        names = lines[::2]
+        seqs = lines[1::2]
 
-        # read the stdout by line until splitter is reached
-        for line in iter(proc.stdout.readline, b'//\n'):
-            align1.append(line.decode())
+        # store allele (lowercase) info, returns mask with lowercases
+        amask, abool = store_alleles(seqs)
 
         # reorder b/c muscle doesn't keep order
-        lines = "".join(align1)[1:].split("\n>")
+        lines = alignments[ldx][1:].split("\n>")
         dalign1 = dict([i.split("\n", 1) for i in lines])
         keys = sorted(
             dalign1.keys(), 
             key=lambda x: int(x.rsplit("*")[-1])
         )
         seqarr = np.zeros(
-            (len(nnames), len(dalign1[keys[0]].replace("\n", ""))),
+            (len(names), len(dalign1[keys[0]].replace("\n", ""))),
             dtype='S1',
             )
         for kidx, key in enumerate(keys):
@@ -1337,18 +1299,12 @@ def align_to_array(data, samples, chunk):
         if istack:
             allstack.append("\n".join(istack))
 
-    # cleanup
-    proc.stdout.close()
-    if proc.stderr:
-        proc.stderr.close()
-    proc.stdin.close()
-    proc.wait()
-
     # write to file when chunk is finished
     odx = chunk.rsplit("_")[-1]
     alignfile = os.path.join(data.tmpdir, "aligned_{}.fa".format(odx))
     with open(alignfile, 'wt') as outfile:
         outfile.write("\n//\n//\n".join(allstack) + "\n//\n//\n")
+    return stats
 
 
 def store_alleles(seqs):
@@ -14,6 +14,7 @@ except ImportError:
 import os
 import time
 import gzip
+import json
 import glob
 import shutil
 import warnings
@@ -23,10 +24,13 @@ from collections import Counter
 import numpy as np
 import pandas as pd
 import scipy.stats
+from numba import njit
 
 import ipyrad as ip
 from .jointestimate import recal_hidepth
-from .utils import IPyradError, clustdealer, PRIORITY
+from .clustmap import (
+    load_cluster_index, index_clusters, get_cluster_store_path)
+from .utils import IPyradError, ClusterStore, PRIORITY, count_sites
 
 with warnings.catch_warnings():
     warnings.filterwarnings("ignore", category=FutureWarning)
@@ -174,7 +178,6 @@ class Step5:
         # this isn't setup yet to allow restarting if interrupted mid run
         try:
             self.remote_calculate_depths()
-            self.remote_make_chunks()
             statsdicts = self.remote_process_chunks()
             self.remote_concatenate_chunks()
             self.data_store(statsdicts)
@@ -220,33 +223,45 @@ class Step5:
         self.data.hackersonly.max_fragment_length = max(maxlens)
 
 
-    def remote_make_chunks(self):
-        "split clusters into chunks for parallel processing"
-
-        # first progress bar
-        start = time.time()
-        printstr = ("chunking clusters   ", "s5")
-
-        # send off samples to be chunked
-        jobs = {}
-        for sample in self.samples:
-            jobs[sample.name] = self.lbview.apply(
-                make_chunks,
-                *(self.data, sample, len(self.ipyclient)))
-
-        # block until finished
-        while 1:
-            ready = [i.ready() for i in jobs.values()]
-            self.data._progressbar(len(ready), sum(ready), start, printstr)
-            time.sleep(0.1)
-            if len(ready) == sum(ready):
-                self.data._print("")
-                break
-
-        # check for failures
+    def get_chunks(self):
+        """
+        Returns {sname: [(start, end), ...]} ranges of clusters to process as
+        separate jobs, read directly from the ClusterStore of each sample. 
+        Each sample gets chunks in proportion to its share of the estimated 
+        work of all samples, such that there are about CONSENSCHUNKS chunks 
+        per engine, and clusters are split into chunks of equal work. The 
+        work of a cluster is its number of unique reads times its length, or
+        nothing if it is below the min depth, since base calls are made on 
+        weighted unique reads.
+        """
+        costs = {}
         for sample in self.samples:
-            if not jobs[sample.name].successful():
-                jobs[sample.name].get()
+            index = load_cluster_index(sample)
+            if index is None:
+                index = index_clusters(sample)
+            with ClusterStore(get_cluster_store_path(sample)) as store:
+                nreads = np.diff(store.clusters)
+            cost = np.where(
+                index["depths"] >= self.data.params.mindepth_majrule,
+                nreads * index["maxlens"], 
+                0) + 1
+            costs[sample.name] = np.cumsum(cost)
+
+        # split each sample into contiguous ranges of about equal work
+        total = float(sum(i[-1] for i in costs.values() if i.size))
+        nengines = len(self.ipyclient.ids)
+        chunks = {}
+        for sname, cumsum in costs.items():
+            if not cumsum.size:
+                chunks[sname] = []
+                continue
+            share = CONSENSCHUNKS * nengines * cumsum[-1] / total
+            nchunks = int(min(MAXCONSENSCHUNKS, max(1, np.ceil(share))))
+            bounds = np.searchsorted(
+                cumsum, np.arange(1, nchunks) * cumsum[-1] / float(nchunks))
+            bounds = np.unique(np.concatenate([[0], bounds, [cumsum.size]]))
+            chunks[sname] = list(zip(bounds[:-1], bounds[1:]))
+        return chunks
 
 
     def remote_process_chunks(self):
@@ -258,15 +273,22 @@ class Step5:
         printstr = ("consens calling     ", "s5")
         self.data._progressbar(1, 0, start, printstr)
 
-        # submit jobs (10 per sample === can be hundreds of jobs...)
-        for sample in self.samples:
-            chunks = glob.glob(os.path.join(
-                self.data.tmpdir,
-                "{}.chunk.*".format(sample.name)))
-            chunks.sort(key=lambda x: int(x.split('.')[-1]))
+        # report samples with base calls cached from a run with the same 
+        # params, which only need to be re-filtered for maxH and maxN.
+        cached = [
+            i for i in self.samples if 
+            load_consens_cache_key(i) == 
+            get_consens_cache_key(self.data, i, self.isref)
+        ]
+        if cached:
+            self.data._print(
+                "re-filtering cached base calls of {} samples"
+                .format(len(cached)))
 
-            # submit jobs
-            for chunk in chunks:
+        # submit jobs as ranges of clusters of each sample
+        chunks = self.get_chunks()
+        for sample in self.samples:
+            for chunk in chunks[sample.name]:
                 jobs[sample.name].append(
                     self.lbview.apply(
                         process_chunks,
@@ -309,6 +331,13 @@ class Step5:
                 concat_catgs,                
                 *(self.data, sample, self.isref))
 
+        # concat base calls cached for re-filtering on reruns
+        asyncs3 = {}
+        for sample in self.samples:
+            asyncs3[sample.name] = self.lbview.apply(
+                concat_consens_cache,
+                *(self.data, sample))
+
         # collect all results for a sample and store stats 
         if self.isref:
             concat_job = concat_reference_consens
@@ -321,7 +350,10 @@ class Step5:
                 *(self.data, sample))
             
         # track progress of stats storage
-        alljobs = list(asyncs1.values()) + list(asyncs2.values())
+        alljobs = (
+            list(asyncs1.values()) + 
+            list(asyncs2.values()) + 
+            list(asyncs3.values()))
         while 1:
             ready = [i.ready() for i in alljobs]
             self.data._progressbar(len(ready), sum(ready), start, printstr)
@@ -366,54 +398,17 @@ class Step5:
                 })
 
 
-def make_chunks(data, sample, ncpus):
-    "split job into bits and pass to the client"
-
-    # counter for split job submission
-    num = 0
-
-    # set optim size for chunks in N clusters. The first few chunks take longer
-    # because they contain larger clusters, so we create 4X as many chunks as
-    # processors so that they are split more evenly.
-    optim = int(
-        (sample.stats.clusters_total // ncpus) + \
-        (sample.stats.clusters_total % ncpus))
-
-    # open to clusters
-    with gzip.open(sample.files.clusters, 'rb') as clusters:
-        # create iterator to sample 2 lines at a time
-        pairdealer = izip(*[iter(clusters)] * 2)
-
-        # Use iterator to sample til end of cluster
-        done = 0
-        while not done:
-            # grab optim clusters and write to file.
-            done, chunk = clustdealer(pairdealer, optim)
-            chunk = [i.decode() for i in chunk]
-
-            # make file handle
-            chunkhandle = os.path.join(
-                data.tmpdir,
-                "{}.chunk.{}.{}".format(sample.name, optim, num * optim))
-
-            # write to file
-            if chunk:
-                with open(chunkhandle, 'wt') as outchunk:
-                    outchunk.write("//\n//\n".join(chunk) + "//\n//\n")
-                num += 1
-
-
-def process_chunks(data, sample, chunkfile, isref):
-    proc = Processor(data, sample, chunkfile, isref)
+def process_chunks(data, sample, chunk, isref):
+    proc = Processor(data, sample, chunk, isref)
     proc.run()
     return proc.counters, proc.filters     
 
 
 class Processor:
-    def __init__(self, data, sample, chunkfile, isref):
+    def __init__(self, data, sample, chunk, isref):
         self.data = data
         self.sample = sample
-        self.chunkfile = chunkfile
+        self.chunk = chunk
         self.isref = isref
 
         # prepare the processor
@@ -423,14 +418,18 @@ class Processor:
         self.chroms2ints()
 
     def run(self):
-        self.process_chunk()
+        # re-filter the cached base calls if made with the same params
+        if self.cached:
+            self.process_cached_chunk()
+        else:
+            self.process_chunk()
         self.write_chunk()
 
     def set_params(self):
         # set max limits
         self.nalleles = 1
-        self.tmpnum = int(self.chunkfile.split(".")[-1])
-        self.optim = int(self.chunkfile.split(".")[-2])
+        self.tmpnum = int(self.chunk[0])
+        self.optim = int(self.chunk[1] - self.chunk[0])
         self.este = self.data.stats.error_est.mean()
         self.esth = self.data.stats.hetero_est.mean()
         self.maxlen = self.data.hackersonly.max_fragment_length
@@ -439,6 +438,16 @@ class Processor:
         # not enforced for ref
         if self.isref:
             self.maxn = int(1e6)
+
+        # are there cached base calls made with these same params
+        self.cachekey = get_consens_cache_key(
+            self.data, self.sample, self.isref)
+        self.cached = bool(
+            load_consens_cache_key(self.sample) == self.cachekey)
+
+        # table of statistical calls is only needed to make new calls
+        if not self.cached:
+            self.table = get_binom_table(self.este, self.esth)
         
     def init_counters(self):
         # store data for stats counters.
@@ -461,10 +470,17 @@ class Processor:
 
     def init_arrays(self):
         # local copies to use to fill the arrays
-        self.catarr = np.zeros((self.optim, self.maxlen, 4), dtype=np.uint32)
+        # catg depths of each consens are stored as a list of (len, 4) arrays
+        self.catarr = []
         self.nallel = np.zeros((self.optim, ), dtype=np.uint8)
         self.refarr = np.zeros((self.optim, 3), dtype=np.int64)
 
+        # base calls of clusters before the maxH and maxN filters, by cidx
+        self.cacheidx = []
+        self.cachecons = []
+        self.cachecats = []
+        self.cacherefs = []
+
     def chroms2ints(self):
         # if reference-mapped then parse the fai to get index number of chroms
         if self.isref:
@@ -477,65 +493,87 @@ class Processor:
 
     # ---------------------------------------------
     def process_chunk(self):
-        # stream through the clusters
-        inclust = open(self.chunkfile, 'rb')
-        pairdealer = izip(*[iter(inclust)] * 2)
-        done = 0
-        while not done:
-            done, chunk = clustdealer(pairdealer, 1)
-            if chunk:  
+        # stream through the range of clusters from the store
+        store = ClusterStore(get_cluster_store_path(self.sample))
+        clusters = store.iter_clusters(*self.chunk)
+        for cidx, cluster in enumerate(clusters, int(self.chunk[0])):
 
-                # fills .name and .seqs attributes
-                self.parse_cluster(chunk)
+            # fills .name and .seqs attributes
+            self.parse_cluster(cluster)
 
-                # return 1 if enough reads at this locus position
-                if self.filter_mindepth():
+            # return 1 if enough reads at this locus position
+            if self.filter_mindepth():
 
-                    # return 1 if enough overlapping bases for calls
-                    # and fills .consens and .arrayed attributes
-                    if self.build_consens_and_array():
+                # return 1 if enough overlapping bases for calls
+                # and fills .consens and .arrayed attributes
+                if self.build_consens_and_array():
 
-                        # denovo only: mask repeats
-                        if not self.isref:
-                            # drops false columns from consens and arrayed
-                            self.mask_repeats()
+                    # denovo only: mask repeats
+                    if not self.isref:
+                        # drops false columns from consens and arrayed
+                        self.mask_repeats()
 
-                        # fills .hidx and .nheteros
-                        self.get_heteros()
+                    # fills .catg and keeps the calls for re-filtering
+                    self.cache_calls(cidx)
 
-                        # return 1 if not too many heterozygote calls
-                        if self.filter_maxhetero():
+                    # apply maxH and maxN filters and store result
+                    self.filter_and_store()
 
-                            # return 1 if not too many N or too short 
-                            if self.filter_maxN_minLen():
-                                
-                                # filter for max haplotypes...
-                                # self.get_alleles()
-                                # ...
+        # cleanup close handle
+        store.close()
 
-                                # store result
-                                self.store_data()
 
-        # cleanup close handle
-        inclust.close()
+    def process_cached_chunk(self):
+        "re-filter the cached base calls of the range of clusters"
+        cachefile = get_consens_cache_path(self.sample)
+        with h5py.File(cachefile, 'r') as io5:
+            # records of clusters in this range that passed depth filters
+            lidx, ridx = np.searchsorted(io5["cidx"][:], self.chunk)
+            offsets = io5["offsets"][lidx:ridx + 1]
+            consens = io5["consens"][offsets[0]:offsets[-1]]
+            catgs = io5["catg"][offsets[0]:offsets[-1]]
+            chroms = io5["chroms"][lidx:ridx]
+
+        # clusters with no cached calls were filtered by depth
+        self.filters["depth"] += self.optim - int(ridx - lidx)
+        offsets -= offsets[0]
+        for idx in range(ridx - lidx):
+            self.consens = consens[offsets[idx]:offsets[idx + 1]].view("S1")
+            self.catg = catgs[offsets[idx]:offsets[idx + 1]]
+            self.ref_position = tuple(chroms[idx])
+            self.filter_and_store()
+
 
+    def filter_and_store(self):
+        "apply the maxH and maxN filters to consens calls and store result"
+        # fills .hidx and .nheteros
+        self.get_heteros()
 
-    def parse_cluster(self, chunk):
-        "read in cluster chunk to get .names & .seqs and ref position"
-        # get names and seqs
-        piece = chunk[0].decode().strip().split("\n")
-        self.names = piece[0::2]
-        self.seqs = piece[1::2]
+        # return 1 if not too many heterozygote calls
+        if self.filter_maxhetero():
 
-        # pull replicate read info from seqs
-        self.reps = [int(n.split(";")[-2][5:]) for n in self.names]
+            # return 1 if not too many N or too short 
+            if self.filter_maxN_minLen():
+
+                # filter for max haplotypes...
+                # self.get_alleles()
+                # ...
+
+                # store result
+                self.store_data()
+
+
+    def parse_cluster(self, cluster):
+        "get .names, .reps & .seqs of a cluster from the store and ref position"
+        # get names, replicate read info, and seqs as a uint8 array
+        self.names, self.reps, _, seqs = cluster
+        self.seqs = np.vstack(seqs)
 
         # ref positions
         self.ref_position = (-1, 0, 0)
         if self.isref:
             # parse position from name string
-            rname = self.names[0].rsplit(";", 2)[0]
-            chrom, posish = rname.rsplit(":")
+            chrom, posish = self.names[0].rsplit(":")
             pos0, pos1 = posish.split("-")
             # pull idx from .fai reference dict
             chromint = self.faidict[chrom] + 1
@@ -563,23 +601,20 @@ class Processor:
         data much better... but puts N's into denovo data where we might other
         wise choose to drop those columns... Think more about this...
         """
-        # get stacks of base counts
-        sseqs = [list(seq) for seq in self.seqs]
-        arrayed = np.concatenate(
-            [[seq] * rep for (seq, rep) in zip(sseqs, self.reps)]
-        ).astype(bytes)
-
+        # unique seqs and counts of each base at each site weighted by reps
         # ! enforce maxlen limit !
-        self.arrayed = arrayed[:, :self.maxlen]
+        self.arrayed = self.seqs[:, :self.maxlen].view("S1")
+        self.counts = count_sites(self.seqs[:, :self.maxlen], self.reps)
+        self.depth = int(sum(self.reps))
                     
-        # get unphased consens sequence from arrayed
+        # get unphased consens sequence from site counts
         self.consens = base_caller(
-            self.arrayed, 
+            self.counts, 
             self.data.params.mindepth_majrule, 
             self.data.params.mindepth_statistical,
-            self.esth, 
-            self.este,
-        )
+            self.table, 
+            TRANSARR,
+        ).view("S1")
 
         # trim Ns from the left and right ends
         mask = self.consens.copy()
@@ -595,6 +630,7 @@ class Processor:
             ltrim, rtrim = trim.min(), trim.max()
             self.consens = self.consens[ltrim:rtrim + 1]
             self.arrayed = self.arrayed[:, ltrim:rtrim + 1]
+            self.counts = self.counts[ltrim:rtrim + 1]
 
             # update position for trimming
             self.ref_position = (
@@ -610,23 +646,34 @@ class Processor:
         Removes mask columns with low depth repeats from denovo clusters.
         """
         # get column counts of -s        
-        idepths = np.sum(self.arrayed == b"-", axis=0).astype(float)
+        idepths = self.counts[:, 45].astype(float)
 
         # get proportion of bases that are - at each site
-        props = idepths / self.arrayed.shape[0] 
+        props = idepths / self.depth
 
         # is proportion of - sites more than 0.8?
         keep = np.invert(props >= 0.8)
 
         # apply filter
         self.consens = self.consens[keep]
-        self.arrayed = self.arrayed[:, keep]            
+        self.arrayed = self.arrayed[:, keep]
+        self.counts = self.counts[keep]
+
+
+    def cache_calls(self, cidx):
+        "store the base calls and catg depths of a cluster before filtering"
+        # store a reduced array with only CATG
+        # do not allow ints larger than 65535 (uint16)
+        self.catg = np.minimum(
+            self.counts[:, [67, 65, 84, 71]], 65535).astype(np.uint16)
+        self.cacheidx.append(cidx)
+        self.cachecons.append(self.consens.view(np.uint8))
+        self.cachecats.append(self.catg)
+        self.cacherefs.append(self.ref_position)
 
 
     def get_heteros(self):
-        self.hidx = [
-            i for (i, j) in enumerate(self.consens) if 
-            j.decode() in list("RKSYWM")]
+        self.hidx = np.where(np.isin(self.consens, HETEROS))[0].tolist()
         self.nheteros = len(self.hidx)
 
 
@@ -654,19 +701,24 @@ class Processor:
         if len(self.hidx) < 2:
             self.nalleles = 1
         else:
-            # array of hetero sites
+            # array of hetero sites in unique reads, and their reps
             harray = self.arrayed[:, self.hidx]
+            reps = np.asarray(self.reps)
             # remove reads with - or N at variable site
-            harray = harray[~np.any(harray == b"-", axis=1)]
-            harray = harray[~np.any(harray == b"N", axis=1)]
+            keep = ~np.any(harray == b"-", axis=1)
+            keep &= ~np.any(harray == b"N", axis=1)
+            harray = harray[keep]
+            reps = reps[keep]
             # get counts of each allele (e.g., AT:2, CG:2)
-            ccx = Counter([tuple(i) for i in harray])
+            ccx = Counter()
+            for row, rep in zip(harray, reps):
+                ccx[tuple(row)] += int(rep)
 
             # remove low freq alleles if more than 2, since they may reflect
             # seq errors at hetero sites, making a third allele, or a new
             # allelic combination that is not real.
             if len(ccx) > 2:
-                totdepth = harray.shape[0]
+                totdepth = int(reps.sum())
                 cutoff = max(1, totdepth // 10)
                 alleles = [i for i in ccx if ccx[i] > cutoff]
             else:
@@ -685,14 +737,7 @@ class Processor:
         cidx = self.counters["nconsens"]
         self.nallel[cidx] = self.nalleles
         self.refarr[cidx] = self.ref_position
-
-        # store a reduced array with only CATG
-        catg = np.array(
-            [np.sum(self.arrayed == i, axis=0) for i in
-             [b'C', b'A', b'T', b'G']],
-            dtype='uint16').T
-        # do not allow ints larger than 65535 (uint16)
-        self.catarr[cidx, :catg.shape[0], :] = catg
+        self.catarr.append(self.catg)
 
         # store the seqdata and advance counters
         self.storeseq[cidx] = b"".join(list(self.consens))
@@ -709,12 +754,8 @@ class Processor:
         compatible to be converted to BAM (very stringent about cigars).
         """
 
-        # find last empty size
-        end = np.where(np.all(self.refarr == 0, axis=1))[0]
-        if np.any(end):
-            end = end.min()
-        else:
-            end = self.refarr.shape[0]
+        # number of consens stored (rows filled in the arrays)
+        end = self.counters["nconsens"]
 
         # write final consens string chunk
         consenshandle = os.path.join(
@@ -763,16 +804,25 @@ class Processor:
         # store reduced size arrays with indexes matching to keep indexes
         tmp5 = consenshandle.replace("_tmpcons.", "_tmpcats.")
         with h5py.File(tmp5, 'w') as io5:
-            # reduce catarr to uint16 size for easier storage
-            self.catarr[self.catarr > 65535] = 65535
-            self.catarr = self.catarr.astype(np.uint16)
-            io5.create_dataset(name="cats", data=self.catarr[:end])
+            # ragged catgs as one (nsites, 4) array and the len of each
+            io5.create_dataset(
+                name="cats", 
+                data=np.concatenate(
+                    self.catarr + [np.zeros((0, 4), dtype=np.uint16)]))
+            io5.create_dataset(
+                name="lens", 
+                data=np.array(
+                    [i.shape[0] for i in self.catarr], dtype=np.int64))
             io5.create_dataset(name="alls", data=self.nallel[:end])
             io5.create_dataset(name="chroms", data=self.refarr[:end])
         del self.catarr
         del self.nallel
         del self.refarr
 
+        # store base calls before filtering to be re-filtered on reruns
+        if not self.cached:
+            self.write_cache_chunk()
+
         # return stats and skip sites that are Ns (78)
         #self.counters['nsites'] = sum([len(i) for i in self.storeseq.values()])
         self.counters['nsites'] = sum(
@@ -782,9 +832,42 @@ class Processor:
         del self.storeseq
 
 
+    def write_cache_chunk(self):
+        "writes base calls and catgs of clusters that passed depth filters"
+        tmpc = os.path.join(
+            self.data.tmpdir,
+            "{}_tmpcache.{}".format(self.sample.name, self.tmpnum))
+        with h5py.File(tmpc, 'w') as io5:
+            io5.attrs["key"] = self.cachekey
+            io5.create_dataset(
+                name="cidx", data=np.array(self.cacheidx, dtype=np.int64))
+            io5.create_dataset(
+                name="lens", 
+                data=np.array(
+                    [i.size for i in self.cachecons], dtype=np.int64))
+            io5.create_dataset(
+                name="consens", 
+                data=np.concatenate(
+                    self.cachecons + [np.zeros(0, dtype=np.uint8)]))
+            io5.create_dataset(
+                name="catg", 
+                data=np.concatenate(
+                    self.cachecats + [np.zeros((0, 4), dtype=np.uint16)]))
+            io5.create_dataset(
+                name="chroms", 
+                data=np.array(self.cacherefs, dtype=np.int64).reshape(-1, 3))
+        del self.cachecons
+        del self.cachecats
+
+
 
 def concat_catgs(data, sample, isref):
-    "concat catgs into a single sample catg and remove tmp files"
+    """
+    concat catgs into a single sample catg and remove tmp files. The catg 
+    depths of all consens are stored as one ragged (nsites, 4) uint16 array
+    'catg' where the depths of consens i are in rows catg_offsets[i] to 
+    catg_offsets[i + 1].
+    """
 
     # collect tmpcat files
     tmpcats = glob.glob(os.path.join(
@@ -792,21 +875,30 @@ def concat_catgs(data, sample, isref):
         "{}_tmpcats.*".format(sample.name)))
     tmpcats.sort(key=lambda x: int(x.split(".")[-1]))
 
-    # get full nrows of the new h5 from the tmpcat filenames
+    # get full nrows of the new h5 from the tmpcat filenames, and nsites
     nrows = sum([int(i.rsplit(".", 2)[-2]) for i in tmpcats])
+    nsites = 0
+    for icat in tmpcats:
+        with h5py.File(icat, 'r') as io5:
+            nsites += io5['cats'].shape[0]
 
-    # get shape info from the first cat, (optim, maxlen, 4)
-    optim = min(nrows, 5000)
-    with h5py.File(tmpcats[0], 'r') as io5:
-        _, maxlen, _ = io5['cats'].shape
+    # chunk sizes of about 5000 loci
+    optim = max(1, min(nrows, 5000))
+    soptim = max(1, min(nsites, 5000 * 150))
 
     # fill in the chunk array
     with h5py.File(sample.files.database, 'w') as ioh5:
         dcat = ioh5.create_dataset(
             name="catg",
-            shape=(nrows, maxlen, 4),
-            dtype=np.uint32,
-            chunks=(optim, maxlen, 4),
+            shape=(nsites, 4),
+            dtype=np.uint16,
+            chunks=(soptim, 4),
+            compression="gzip")
+        doff = ioh5.create_dataset(
+            name="catg_offsets",
+            shape=(nrows + 1, ),
+            dtype=np.int64,
+            chunks=(optim + 1, ),
             compression="gzip")
         dall = ioh5.create_dataset(
             name="nalleles", 
@@ -825,20 +917,139 @@ def concat_catgs(data, sample, isref):
                 compression="gzip")
 
         # Combine all those tmp cats into the big cat
+        doff[0] = 0
         start = 0
+        sstart = 0
         for icat in tmpcats:
             addon = int(icat.rsplit(".", 2)[-2])
             end = start + addon
             io5 = h5py.File(icat, 'r')
-            dcat[start:end] = io5['cats'][:]
+            send = sstart + io5['cats'].shape[0]
+            dcat[sstart:send] = io5['cats'][:]
+            doff[start + 1:end + 1] = sstart + np.cumsum(io5['lens'][:])
             dall[start:end] = io5['alls'][:]
             if isref:
                 dchrom[start:end] = io5['chroms'][:]
             start = end
+            sstart = send
             io5.close()
             os.remove(icat)
 
 
+def get_consens_cache_path(sample):
+    """
+    path to the base calls of a sample cached for re-filtering, next to its
+    ClusterStore so that branches made after step 3 share it. It is kept 
+    between runs.
+    """
+    return os.path.join(
+        os.path.dirname(get_cluster_store_path(sample)),
+        "{}.consens.cache.hdf5".format(sample.name))
+
+
+def get_consens_cache_key(data, sample, isref):
+    """
+    Returns a string of the params and inputs that the base calls of a 
+    sample depend on. Cached base calls are re-filtered on a rerun only if 
+    this key is unchanged, i.e., if only max_Hs_consens or max_Ns_consens 
+    changed. 
+    """
+    return json.dumps({
+        "version": ip.__version__,
+        "isref": bool(isref),
+        "clusters": os.path.getmtime(get_cluster_store_path(sample)),
+        "mindepth_majrule": int(data.params.mindepth_majrule),
+        "mindepth_statistical": int(data.params.mindepth_statistical),
+        "maxdepth": int(data.params.maxdepth),
+        "max_fragment_length": int(data.hackersonly.max_fragment_length),
+        "error_est": float(data.stats.error_est.mean()),
+        "hetero_est": float(data.stats.hetero_est.mean()),
+    }, sort_keys=True)
+
+
+def load_consens_cache_key(sample):
+    "returns the key of the cached base calls of a sample, or None"
+    cachefile = get_consens_cache_path(sample)
+    if not os.path.exists(cachefile):
+        return None
+    try:
+        with h5py.File(cachefile, 'r') as io5:
+            return io5.attrs.get("key")
+    except (IOError, OSError):
+        return None
+
+
+def concat_consens_cache(data, sample):
+    """
+    concat the cached base calls of all chunks of a sample, if they were 
+    (re)made, into a single file of ragged 'consens' and 'catg' arrays where
+    the calls of record i are in rows offsets[i] to offsets[i + 1], and 
+    'cidx' is the index of its cluster in the ClusterStore. 
+    """
+    # collect tmpcache files
+    tmpcache = glob.glob(os.path.join(
+        data.tmpdir,
+        "{}_tmpcache.*".format(sample.name)))
+    tmpcache.sort(key=lambda x: int(x.split(".")[-1]))
+    if not tmpcache:
+        return
+
+    # get full nrows and nsites of the new h5
+    nrows = 0
+    nsites = 0
+    for icache in tmpcache:
+        with h5py.File(icache, 'r') as io5:
+            nrows += io5['cidx'].shape[0]
+            nsites += io5['consens'].shape[0]
+            key = io5.attrs["key"]
+
+    # chunk sizes of about 5000 loci
+    optim = max(1, min(nrows, 5000))
+    soptim = max(1, min(nsites, 5000 * 150))
+
+    # write to a tmp name so that an interrupted concat is never loaded, 
+    # named by assembly since branches can run step 5 at the same time
+    cachefile = get_consens_cache_path(sample)
+    tmpfile = "{}.{}.tmp".format(cachefile, data.name)
+    with h5py.File(tmpfile, 'w') as ioh5:
+        dcidx = ioh5.create_dataset(
+            name="cidx", shape=(nrows, ), dtype=np.int64,
+            chunks=(optim, ), compression="gzip")
+        doff = ioh5.create_dataset(
+            name="offsets", shape=(nrows + 1, ), dtype=np.int64,
+            chunks=(optim + 1, ), compression="gzip")
+        dcons = ioh5.create_dataset(
+            name="consens", shape=(nsites, ), dtype=np.uint8,
+            chunks=(soptim, ), compression="gzip")
+        dcat = ioh5.create_dataset(
+            name="catg", shape=(nsites, 4), dtype=np.uint16,
+            chunks=(soptim, 4), compression="gzip")
+        dchrom = ioh5.create_dataset(
+            name="chroms", shape=(nrows, 3), dtype=np.int64,
+            chunks=(optim, 3), compression="gzip")
+
+        # Combine all the tmp chunks
+        doff[0] = 0
+        start = 0
+        sstart = 0
+        for icache in tmpcache:
+            with h5py.File(icache, 'r') as io5:
+                end = start + io5['cidx'].shape[0]
+                send = sstart + io5['consens'].shape[0]
+                dcidx[start:end] = io5['cidx'][:]
+                doff[start + 1:end + 1] = sstart + np.cumsum(io5['lens'][:])
+                dcons[sstart:send] = io5['consens'][:]
+                dcat[sstart:send] = io5['catg'][:]
+                dchrom[start:end] = io5['chroms'][:]
+            start = end
+            sstart = send
+            os.remove(icache)
+
+        # set key last, it marks the cache as complete
+        ioh5.attrs["key"] = key
+    os.rename(tmpfile, cachefile)
+
+
 def concat_denovo_consens(data, sample):
     "concatenate consens bits into fasta file for denovo assemblies"
 
@@ -1080,103 +1291,100 @@ def apply_filters_and_fill_arrs():
     pass
 
 
-def base_caller(arrayed, mindepth_majrule, mindepth_statistical, estH, estE):
-    "call all sites in a locus array. Can't be jit'd yet b/c scipy"
-
+@njit
+def base_caller(counts, mindepth_majrule, mindepth_statistical, table, trans):
+    """
+    call all sites in a locus from an array with the count of each byte value
+    (columns) at each site (rows), see count_sites(). Statistical calls are 
+    looked up in a table of calls for each pair of the two most common base 
+    counts (see get_binom_table) and ambiguity codes in the trans array.
+    Returns consens as uint8.
+    """
     # an array to fill with consensus site calls
-    cons = np.zeros(arrayed.shape[1], dtype=np.uint8)
+    cons = np.zeros(counts.shape[0], dtype=np.uint8)
     cons.fill(78)
-    arr = arrayed.view(np.uint8)
 
     # iterate over columns
-    for col in range(arr.shape[1]):
-        # the site of focus
-        carr = arr[:, col]
+    for col in range(counts.shape[0]):
+        ccounts = counts[col]
 
         # if site is all dash then fill it dash (45)
-        if np.all(carr == 45):
+        depth = ccounts.sum()
+        if ccounts[45] == depth:
             cons[col] = 45
-            
-        # else mask all N and - sites for base call
-        else:
-            mask = carr == 45
-            mask += carr == 78
-            marr = carr[~mask]
-            
-            # call N if no real bases, or below majrule.
-            if marr.shape[0] < mindepth_majrule:
-                cons[col] = 78
+            continue
+
+        # get allele freqs (first-most, second = p, q) masking N and - 
+        pbase = 0
+        nump = 0
+        qbase = 0
+        numq = 0
+        nbases = 0
+        for base in range(256):
+            if base == 45 or base == 78:
+                continue
+            num = ccounts[base]
+            nbases += num
+            if num > nump:
+                qbase, numq = pbase, nump
+                pbase, nump = base, num
+            elif num > numq:
+                qbase, numq = base, num
                 
-            # if not variable
-            elif np.all(marr == marr[0]):
-                cons[col] = marr[0]
-
-            # estimate variable site call
-            else:
-                # get allele freqs (first-most, second, third = p, q, r)
-                counts = np.bincount(marr)
+        # call N if no real bases, or below majrule.
+        if nbases < mindepth_majrule:
+            cons[col] = 78
 
-                pbase = np.argmax(counts)
-                nump = counts[pbase]
-                counts[pbase] = 0
+        # if not variable
+        elif not numq:
+            cons[col] = pbase
 
-                qbase = np.argmax(counts)
-                numq = counts[qbase]
-                counts[qbase] = 0
-
-                ## based on biallelic depth
-                bidepth = nump + numq
-                if bidepth < mindepth_majrule:
-                    cons[col] = 78
+        # estimate variable site call
+        else:
+            ## based on biallelic depth
+            bidepth = nump + numq
+            if bidepth < mindepth_majrule:
+                cons[col] = 78
 
+            else:
+                # if depth is too high, reduce to sampled int
+                if bidepth > 500:
+                    base1 = int(500 * (nump / float(bidepth)))
+                    base2 = int(500 * (numq / float(bidepth)))
                 else:
-                    # if depth is too high, reduce to sampled int
-                    if bidepth > 500:
-                        base1 = int(500 * (nump / float(bidepth)))
-                        base2 = int(500 * (numq / float(bidepth)))
+                    base1 = nump
+                    base2 = numq
+
+                # make statistical base call
+                if bidepth >= mindepth_statistical:
+                    call = table[base1, base2]
+                    if call == 0:
+                        cons[col] = 78
+                    elif call == 2:
+                        cons[col] = trans[pbase, qbase]
                     else:
-                        base1 = nump
-                        base2 = numq
-
-                    # make statistical base call
-                    if bidepth >= mindepth_statistical:
-                        ishet, prob = get_binom(base1, base2, estE, estH)
-                        if prob < 0.95:
-                            cons[col] = 78
-                        else:
-                            if ishet:
-                                cons[col] = TRANS[(pbase, qbase)]
-                            else:
-                                cons[col] = pbase
-
-                    # make majrule base call
+                        cons[col] = pbase
+
+                # make majrule base call
+                else:
+                    if nump == numq:
+                        cons[col] = trans[pbase, qbase]
                     else:
-                        if nump == numq:
-                            cons[col] = TRANS[(pbase, qbase)]
-                        else:
-                            cons[col] = pbase
-    return cons.view("S1")
+                        cons[col] = pbase
+    return cons
 
 
 
-TRANS = {
-    (71, 65): 82,
-    (71, 84): 75,
-    (71, 67): 83,
-    (84, 67): 89,
-    (84, 65): 87,
-    (67, 65): 77,
-    (65, 67): 77,
-    (65, 84): 87,
-    (67, 84): 89,
-    (67, 71): 83,
-    (84, 71): 75,
-    (65, 71): 82,
-}
-
-
-def get_binom(base1, base2, estE, estH):
-    "return probability of base call"
+def get_binom_table(estE, estH, maxdepth=500):
+    """
+    Returns a table of statistical base calls for every pair of the counts 
+    of the two most common bases at a site (base1, base2) up to maxdepth, 
+    where 0 is N (the probability of the best call is < 0.95), 1 is the 
+    homozygous call, and 2 is the heterozygous call, where the call is 
+    heterozygous if its probability is greater than that of the homozygous 
+    call of base1.
+    """
+    base1, base2 = np.mgrid[0:maxdepth + 1, 0:maxdepth + 1]
     prior_homo = (1. - estH) / 2.
     prior_hete = estH
 
@@ -1192,17 +1400,45 @@ def get_binom(base1, base2, estE, estH):
     homob *= prior_homo
 
     ## final
-    probabilities = [homoa, homob, hetprob]
-    bestprob = max(probabilities) / float(sum(probabilities))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        bestprob = (
+            np.maximum(np.maximum(homoa, homob), hetprob) 
+            / (homoa + homob + hetprob))
+    table = np.where(hetprob > homoa, 2, 1).astype(np.uint8)
+    table[bestprob < 0.95] = 0
+    return table
 
-    ## return
-    if hetprob > homoa:
-        return True, bestprob
-    return False, bestprob
 
 
+# number of consens calling jobs per engine over all samples, and max per 
+# sample. Each job processes a range of clusters of a sample.
+CONSENSCHUNKS = 4
+MAXCONSENSCHUNKS = 200
+
+
+TRANS = {
+    (71, 65): 82,
+    (71, 84): 75,
+    (71, 67): 83,
+    (84, 67): 89,
+    (84, 65): 87,
+    (67, 65): 77,
+    (65, 67): 77,
+    (65, 84): 87,
+    (67, 84): 89,
+    (67, 71): 83,
+    (84, 71): 75,
+    (65, 71): 82,
+}
 
+# ambiguity codes of heterozygous consens calls
+HETEROS = np.frombuffer(b"RKSYWM", dtype="S1")
 
+# TRANS as an array for jitted functions. Any other pair is called N.
+TRANSARR = np.zeros((256, 256), dtype=np.uint8)
+TRANSARR.fill(78)
+for _key, _val in TRANS.items():
+    TRANSARR[_key] = _val
 
 
 # not currently used in reference assemblies
@@ -14,18 +14,22 @@ except ImportError:
 # external imports
 import os
 import io
+import zlib
 import gzip
 import glob
 import time
 import shutil
-import pickle
+import ctypes
+import ctypes.util
 import numpy as np
 import subprocess as sps
 from collections import Counter
+from numba import njit
 
 # ipyrad imports
 from ipyrad.core.sample import Sample
 from ipyrad.assemble.utils import IPyradError, ambigcutters, BADCHARS
+from ipyrad.assemble.utils import bgzf_compress, BGZF_EOF
       
         
 
@@ -301,7 +305,7 @@ class Demultiplexer:
         self.get_barcode_dict()        
 
         # store stats for each file handle (grouped results of chunks)
-        self.stats = Stats()
+        self.stats = Stats(get_snames(self.data.barcodes))
 
     def run(self):
         # Estimate size of files to plan parallelization. 
@@ -374,14 +378,25 @@ class Demultiplexer:
         ]
         assert self.cutters, "Must enter a restriction_overhang for demultiplexing."
 
-        # get matchdict
-        self.matchdict = inverse_barcodes(self.data)
+        # get barcode index to match observed barcodes to samples
+        self.matchdict = BarcodeIndex(
+            self.data.barcodes, self.data.params.max_barcode_mismatch)
+
+        # report barcodes close enough that some reads will be ambiguous
+        pairs = self.matchdict.ambiguous_pairs()
+        for pair in pairs[:10]:
+            print(AMBIGUOUS_BARCODES.format(
+                *(pair + (self.data.params.max_barcode_mismatch,))))
+        if len(pairs) > 10:
+            print("    ... and {} more pairs of close barcodes.\n"
+                .format(len(pairs) - 10))
 
 
     def setup_for_splitting(self, omin=int(8e6)):
         """
         Decide to split or not based on whether 1/16th of file size is 
-        bigger than omin, which is default to 8M reads.
+        bigger than omin, which is default to 8M reads. The number of reads
+        is estimated for each file to size its chunks.
         """
         # create a tmpdir for chunked_files and a chunk optimizer 
         self.tmpdir = os.path.realpath(
@@ -391,53 +406,53 @@ class Demultiplexer:
             shutil.rmtree(self.tmpdir)
         os.makedirs(self.tmpdir)
 
-        # chunk into 16 pieces
-        self.nreads = estimate_nreads(self.data, self.ftuples[0][0])
-        self.optim = int(self.nreads / 16)
+        # chunk each file into 16 pieces
+        self.optims = {}
+        for ftup in self.ftuples:
+            nreads = estimate_nreads(ftup[0])
+            self.optims[ftup[0]] = max(1, int(nreads / 16))
 
-        # if more files than cpus or optim<8M: no chunking
-        self.do_file_split = 0
-        if (len(self.ftuples) > len(self.ipyclient)) or (self.optim > omin):
-            self.do_file_split = 1
+        # if more files than cpus or optim>8M: chunking
+        self.do_file_split = {}
+        for ftup in self.ftuples:
+            self.do_file_split[ftup[0]] = (
+                (len(self.ftuples) > len(self.ipyclient)) or 
+                (self.optims[ftup[0]] > omin)
+            )
 
 
     def splitfiles(self):
-        "sends raws to be chunked"
-
-        # send slices N at a time. The dict chunkfiles stores a tuple of 
-        # rawpairs dictionary to store asyncresults for sorting jobs
+        """
+        Sends raws to be indexed into chunks of optim reads that are read
+        in place by barmatch. The dict chunksdict stores for each file a 
+        list of (ftuple, chunk) where chunk is the offsets of the slice or 
+        None to read the whole file.
+        """
         printstr = ('chunking large files', 's1')
         start = time.time()
-        done = 0
-        njobs = (
-            32 * len(self.ftuples) if "pair" in self.data.params.datatype
-            else 16 * len(self.ftuples)
-        )
         rasyncs = {}
         chunksdict = {}
         for fidx, ftup in enumerate(self.ftuples):
 
             # get file handle w/o basename for stats output
             handle = os.path.splitext(os.path.basename(ftup[0]))[0]
-            if not self.do_file_split:
-                chunksdict[handle] = [ftup]
+            if not self.do_file_split[ftup[0]]:
+                chunksdict[handle] = [(ftup, None)]
 
-            # chunk file into 4 bits using zcat_make_temps                
+            # index file into chunks using index_fastq_chunks
             else:               
-                args = (self.data, ftup, fidx, self.tmpdir, self.optim, start)
-                rasyncs[handle] = self.iview.apply(zcat_make_temps, *args)
+                optim = self.optims[ftup[0]]
+                args = (self.data, ftup, fidx, self.tmpdir, optim, start)
+                rasyncs[handle] = self.lbview.apply(index_fastq_chunks, *args)
 
         # track progress until finished
-        # for each file submitted we expect it to create 16 or 32 files.
         if rasyncs:
             while 1:
                 # break when all jobs are finished
-                if all([i.ready() for i in rasyncs.values()]):
+                ready = [i.ready() for i in rasyncs.values()]
+                self.data._progressbar(len(ready), sum(ready), start, printstr)
+                if all(ready):
                     break
-                
-                # ntemp files written or being written
-                done = len(glob.glob(os.path.join(self.tmpdir, "chunk*_*_*")))
-                self.data._progressbar(njobs, done, start, printstr)
                 time.sleep(0.5)
 
             # store results
@@ -460,19 +475,19 @@ class Demultiplexer:
         printstr = ("sorting reads       ", "s1")
 
         # chunkfiles is a dict with {handle: chunkslist, ...}. The func barmatch
-        # writes results to samplename files with PID number, and also writes a 
-        # pickle for chunk specific results with fidx suffix, which it returns.
+        # writes results to samplename files with PID number, and returns 
+        # compact chunk specific stats.
         rasyncs = {}
         ridx = 0
         for handle, ftuplist in self.chunksdict.items():
-            for fidx, ftuple in enumerate(ftuplist):
+            for ftuple, chunk in ftuplist:
                 args = (
                     self.data,
                     ftuple,
                     self.longbar,
                     self.cutters,
                     self.matchdict,
-                    fidx,
+                    chunk,
                     )
                 rasync = self.lbview.apply(barmatch, args)
                 rasyncs[ridx] = (handle, rasync)
@@ -491,8 +506,7 @@ class Demultiplexer:
             # cleanup finished ridx jobs and grab stats
             for ridx in finished:
                 handle, rasync = rasyncs[ridx]
-                pkl = rasync.get()
-                self.stats.fill_from_pickle(pkl, handle)
+                self.stats.fill_from_results(rasync.get(), handle)
                 del rasyncs[ridx]
                 done += 1
 
@@ -512,14 +526,14 @@ class Demultiplexer:
         """
         # collate files progress bar
         start = time.time()
-        printstr = ("writing/compressing ", "s1")
+        printstr = ("writing files       ", "s1")
         self.data._progressbar(10, 0, start, printstr) 
 
         # get all the files
         ftmps = glob.glob(os.path.join(
             self.data.dirs.fastqs, 
             "tmpdir", 
-            "tmp_*.fastq"))
+            "tmp_*.fastq.gz"))
 
         # a dict to assign tmp files to names/reads
         r1dict = {}
@@ -599,15 +613,11 @@ class Demultiplexer:
             .format("sample_name", "total_reads"))
 
         # names alphabetical. Write to file. Will save again below to Samples.
-        snames = set()
-        for sname in self.data.barcodes:
-            if "-technical-replicate-" in sname:
-                sname = sname.rsplit("-technical-replicate", 1)[0]
-            snames.add(sname)
-            
-        for sname in sorted(list(snames)):
+        snames = self.stats.snames
+        samplehits = dict(zip(snames, self.stats.fsamplehits.tolist()))
+        for sname in snames:
             outfile.write("{:<35}  {:>13}\n"
-                .format(sname, self.stats.fsamplehits[sname]))
+                .format(sname, samplehits[sname]))
 
         ## spacer, which barcodes were found -----------------------------------
         outfile.write('\n{:<35}  {:>13} {:>13} {:>13}\n'
@@ -634,22 +644,20 @@ class Demultiplexer:
                         offhitstring += (
                             "{:<35}  {:>13} {:>13} {:>13}\n"
                             .format(sname, hit, offhit, 
-                                int(self.stats.fbarhits[offhit] / 2))
+                                self.stats.fbarhits[offhit])
                             )
                         #sumoffhits += fbarhits[offhit]
             
                 # write string to file
                 outfile.write("{:<35}  {:>13} {:>13} {:>13}\n"
                     .format(sname, hit, hit, 
-                        int(self.stats.fbarhits[hit] / 2)))
+                        self.stats.fbarhits[hit]))
                 outfile.write(offhitstring)
             
-        # write misses
-        misskeys = list(self.stats.fmisses.keys())
-        misskeys.sort(key=self.stats.fmisses.get)
-        for key in misskeys[::-1]:
+        # write misses: all ('_') and the most common unmatched barcodes
+        for key, count in self.stats.fmisses.most_common(11):
             outfile.write('{:<35}  {:>13} {:>13} {:>13}\n'
-                .format("no_match", "_", key, self.stats.fmisses[key]))
+                .format("no_match", "_", key, count))
         outfile.close()        
 
         # Link Sample with this data file to the Assembly object
@@ -688,10 +696,9 @@ class Demultiplexer:
                 ]
 
             # fill in the summary stats
-            sample.stats["reads_raw"] = int(self.stats.fsamplehits[sname])
+            sample.stats["reads_raw"] = int(samplehits[sname])
             # fill in the full df stats value
-            sample.stats_dfs.s1["reads_raw"] = int(
-                self.stats.fsamplehits[sname])
+            sample.stats_dfs.s1["reads_raw"] = int(samplehits[sname])
 
             # Only link Sample if it has data
             if sample.stats["reads_raw"]:
@@ -710,9 +717,11 @@ class Demultiplexer:
 # this class is created and run inside the barmatch function() that is run
 # on remote engines for parallelization.
 class BarMatch:
-    def __init__(self, data, ftuple, longbar, cutters, matchdict, fidx):
+    def __init__(self, data, ftuple, longbar, cutters, matchdict, chunk=None):
         """
-        Sorts reads to samples based on barcodes and writes stats to a pickle.
+        Sorts reads to samples based on barcodes and returns compact stats.
+        If chunk is not None it is ((coffset, uoffset), (coffset, uoffset),
+        nreads) of the slice of the R1 and R2 files to read from.
         """
         # store attrs
         self.data = data
@@ -720,47 +729,78 @@ class BarMatch:
         self.cutters = cutters
         self.ftuple = ftuple
         self.matchdict = matchdict
-        self.fidx = fidx
+        self.chunk = chunk
 
         # when to write to disk
         self.chunksize = int(1e6) 
         self.epid = os.getpid()
         self.filestat = np.zeros(3, dtype=int)
         
-        # store reads per sample (group technical replicates)
-        self.samplehits = {}
-        for sname in self.data.barcodes:
-            if "-technical-replicate-" in sname:
-                sname = sname.rsplit("-technical-replicate", 1)[0]
-            self.samplehits[sname] = 0
+        # store reads per sample (group technical replicates) in an array
+        # ordered by sorted sample names.
+        self.snames = get_snames(self.data.barcodes)
+        self.sidxs = {j: i for (i, j) in enumerate(self.snames)}
+        self.samplehits = np.zeros(len(self.snames), dtype=np.int64)
 
-        # store all barcodes observed
+        # store observed barcodes matched to each sample and reads
         self.barhits = {}
-        for barc in self.matchdict:
-            self.barhits[barc] = 0
-
-        # store reads and bars matched to samples
         self.read1s = {} 
         self.read2s = {} 
-        self.dbars = {} 
-        for sname in self.data.barcodes:
-            if "-technical-replicate-" in sname:
-                sname = sname.rsplit("-technical-replicate", 1)[0]
+        for sname in self.snames:
+            self.barhits[sname] = Counter()
             self.read1s[sname] = []
             self.read2s[sname] = []
-            self.dbars[sname] = set()
 
-        # store counts of what didn't match to samples
-        self.misses = {}
-        self.misses['_'] = 0
+        # store counts of what didn't match to samples, and of the most 
+        # common unmatched barcodes (strings, or int codes in blocks).
+        self.nmisses = 0
+        self.misses = Counter()
+
+        # barcodes at a fixed position can be matched in blocks of reads
+        self.blocksize = int(5e4)
+        self.blocked = self.get_block_table()
 
 
     def run(self):
         self.demux = self.get_matching_function()
         self.open_read_generators()
-        pkl = self.sort_reads()
+        if self.blocked:
+            self.sort_read_blocks()
+        else:
+            self.sort_reads()
         self.close_read_generators()
-        return pkl
+        return self.get_stats()
+
+
+    def get_block_table(self):
+        """
+        Builds a sorted table of integer encoded barcodes and the index of 
+        the sample they match to, used to resolve a whole block of reads at
+        once. Returns False if barcodes are not at a fixed position or 
+        cannot be encoded, in which case reads are matched one at a time.
+        """
+        if self.data.hackersonly.demultiplex_on_i7_tags:
+            return False
+        if '3rad' in self.data.params.datatype:
+            return False
+        if self.longbar[1] != 'same' or self.longbar[0] > MAXBLOCKBAR:
+            return False
+        for barcode in self.matchdict:
+            if len(barcode) != self.longbar[0]:
+                return False
+            if not set(barcode).issubset(BARBASES):
+                return False
+
+        # a cache of {code: (sidx, barcode)} of observed barcode codes that 
+        # were resolved by the barcode index.
+        self.codecache = {-1: (-1, None)}
+
+        # 2brad barcodes are at the end of R1 before the cut overhang
+        self.tail = int(self.data.params.datatype == '2brad')
+        self.cutlen = 0
+        if self.tail:
+            self.cutlen = len(self.cutters[0][0])
+        return True
 
 
     def get_matching_function(self):
@@ -778,19 +818,28 @@ class BarMatch:
         Gzips are always bytes so let's use rb to make unzipped also bytes.
         """
 
-        # get file type
-        if self.ftuple[0].endswith(".gz"):
+        # a chunk is read in place from indexed offsets in the raw file
+        if self.chunk:
+            offsets1, offsets2, nreads = self.chunk
+            self.ofile1 = open_fastq_slice(self.ftuple[0], *offsets1)
+        elif self.ftuple[0].endswith(".gz"):
+            nreads = None
             self.ofile1 = gzip.open(self.ftuple[0], 'rb')
         else:
+            nreads = None
             self.ofile1 = open(self.ftuple[0], 'rb')
 
         # create iterators 
         fr1 = iter(self.ofile1) 
-        quart1 = izip(fr1, fr1, fr1, fr1)
+        quart1 = islice(izip(fr1, fr1, fr1, fr1), nreads)
+        self.block1 = FastqBlockReader(self.ofile1, nreads)
+        self.block2 = None
         
         # create second read iterator for paired data
         if self.ftuple[1]:
-            if self.ftuple[0].endswith(".gz"):
+            if self.chunk:
+                self.ofile2 = open_fastq_slice(self.ftuple[1], *offsets2)
+            elif self.ftuple[0].endswith(".gz"):
                 self.ofile2 = gzip.open(self.ftuple[1], 'rb')
             else:
                 self.ofile2 = open(self.ftuple[1], 'rb')
@@ -799,6 +848,7 @@ class BarMatch:
             fr2 = iter(self.ofile2)  
             quart2 = izip(fr2, fr2, fr2, fr2)
             self.quarts = izip(quart1, quart2)
+            self.block2 = FastqBlockReader(self.ofile2, nreads)
         else:
             self.quarts = izip(quart1, iter(int, 1))
 
@@ -846,16 +896,10 @@ class BarMatch:
 
             if sname_match:
 
-                # add to observed set of bars
-                self.dbars[sname_match].add(barcode)
+                # add to observed bars
                 self.filestat[1:] += 1
-
-                self.samplehits[sname_match] += 1
-                self.barhits[barcode] += 1
-                if barcode in self.barhits:
-                    self.barhits[barcode] += 1
-                else:
-                    self.barhits[barcode] = 1
+                self.samplehits[self.sidxs[sname_match]] += 1
+                self.barhits[sname_match][barcode] += 1
         
                 # trim off barcode
                 lenbar1 = len(barcode)
@@ -886,14 +930,15 @@ class BarMatch:
                     read2[3] = read2[3][lenbar2:]
         
                 # append to sorted reads list
-                self.read1s[sname_match].append(b"".join(read1).decode())
+                self.read1s[sname_match].append(b"".join(read1))
                 if 'pair' in self.data.params.datatype:
-                    self.read2s[sname_match].append(b"".join(read2).decode())
+                    self.read2s[sname_match].append(b"".join(read2))
 
             else:
-                self.misses["_"] += 1
+                self.nmisses += 1
                 if barcode:
                     self.filestat[1] += 1
+                    self.count_misses({barcode: 1})
 
             # Write to each sample file (pid's have different handles)
             if not self.filestat[0] % int(1e6):
@@ -915,46 +960,361 @@ class BarMatch:
         if 'pair' in self.data.params.datatype:
             write_to_file(self.data, self.read2s, 2, self.epid)
 
-        ## return stats in saved pickle b/c return_queue is too small
-        ## and the size of the match dictionary can become quite large
-        samplestats = [self.samplehits, self.barhits, self.misses, self.dbars]
-        pklname = os.path.join(
-            self.data.dirs.fastqs, 
-            "tmpdir",
-            "tmp_{}_{}.p".format(self.epid, self.fidx))
-        with open(pklname, 'wb') as wout:
-            pickle.dump([self.filestat, samplestats], wout)
-        return pklname
+
+    def sort_read_blocks(self):
+        """
+        Sorts reads to samples in blocks. Barcodes are pulled from all reads
+        in a block as integer codes, resolved to samples by a binary search 
+        of the sorted barcode table, and the trimmed reads are gathered into
+        one bytes string per sample. Results are identical to sort_reads().
+        """
+        nsamples = len(self.snames)
+        ispair = 'pair' in self.data.params.datatype
+        unwritten = 0
+        while 1:
+            arr1, ends1 = self.block1.read(self.blocksize)
+            nreads = ends1.size // 4
+            if not nreads:
+                break
+            if self.block2:
+                arr2, ends2 = self.block2.read(nreads)
+                if ends2.size // 4 != nreads:
+                    raise IPyradError(
+                        "R1 and R2 files have different numbers of reads: {}"
+                        .format(self.ftuple))
+
+            # integer barcode codes (-1 if not a full ACGTN barcode)
+            codes, found = block_barcodes(
+                arr1, ends1, self.longbar[0], self.tail, self.cutlen)
+
+            # sample index of each read (-1 if no match) from the sample 
+            # index of each unique barcode in the block.
+            ucodes, uinverse = np.unique(codes, return_inverse=True)
+            usidxs = np.array(
+                [self.resolve_code(i)[0] for i in ucodes], dtype=np.int64)
+            sidxs = usidxs[uinverse]
+            hits = sidxs >= 0
+            nhits = int(hits.sum())
+
+            # store file stats: total, cutfound, matched
+            self.filestat[0] += nreads
+            self.filestat[1] += int(found.sum())
+            self.filestat[2] += nhits
+            self.nmisses += nreads - nhits
+
+            # store sample and barcode hits, and unmatched barcode codes
+            scounts = np.bincount(sidxs[hits], minlength=nsamples)
+            snonzero = np.flatnonzero(scounts)
+            self.samplehits += scounts
+            ucounts = np.bincount(uinverse, minlength=ucodes.size)
+            for uidx in np.flatnonzero((usidxs >= 0) & (ucounts > 0)):
+                sidx, barcode = self.resolve_code(ucodes[uidx])
+                self.barhits[self.snames[sidx]][barcode] += int(ucounts[uidx])
+            umiss = (usidxs < 0) & (ucodes >= 0)
+            self.count_misses(
+                dict(zip(ucodes[umiss].tolist(), ucounts[umiss].tolist())))
+
+            # gather trimmed R1s (and untrimmed R2s) by sample
+            reads, offsets = gather_reads(
+                arr1, ends1, sidxs, nsamples, 
+                self.longbar[0], self.tail, self.cutlen)
+            for sidx in snonzero:
+                self.read1s[self.snames[sidx]].append(
+                    reads[offsets[sidx]:offsets[sidx + 1]].tobytes())
+            if ispair:
+                reads, offsets = gather_reads(
+                    arr2, ends2, sidxs, nsamples, 0, 0, 0)
+                for sidx in snonzero:
+                    self.read2s[self.snames[sidx]].append(
+                        reads[offsets[sidx]:offsets[sidx + 1]].tobytes())
+
+            # write to each sample file every chunksize reads
+            unwritten += nreads
+            if unwritten >= self.chunksize:
+                write_to_file(self.data, self.read1s, 1, self.epid)
+                if ispair:
+                    write_to_file(self.data, self.read2s, 2, self.epid)
+                for sname in self.read1s:
+                    self.read1s[sname] = []
+                    self.read2s[sname] = []
+                unwritten = 0
+
+        ## write the remaining reads to file
+        write_to_file(self.data, self.read1s, 1, self.epid)
+        if ispair:
+            write_to_file(self.data, self.read2s, 2, self.epid)
+
+
+    def resolve_code(self, code):
+        "Returns (sidx, barcode) for an integer barcode code, or (-1, None)"
+        code = int(code)
+        if code not in self.codecache:
+            if len(self.codecache) > MAXCACHE:
+                self.codecache = {-1: (-1, None)}
+            barcode = decode_barcode(code, self.longbar[0])
+            sname = self.matchdict.get(barcode)
+            if sname:
+                self.codecache[code] = (self.sidxs[sname], barcode)
+            else:
+                self.codecache[code] = (-1, None)
+        return self.codecache[code]
+
+
+    def count_misses(self, counts):
+        "Counts unmatched barcodes keeping only the most common when large"
+        self.misses.update(counts)
+        if len(self.misses) > MAXCACHE:
+            self.misses = Counter(dict(self.misses.most_common(NMISSES)))
+
+
+    def get_stats(self):
+        """
+        Returns stats as (filestat, samplehits, barhits, misses), where 
+        samplehits is an array of counts for sorted sample names, barhits
+        is {sname: {barcode: count}} of observed barcodes matched to each
+        sample, and misses is {'_': count} of all unmatched reads plus the 
+        counts of the most common unmatched barcodes.
+        """
+        misses = {"_": self.nmisses}
+        for barcode, count in self.misses.most_common(NMISSES):
+            if self.blocked:
+                barcode = decode_barcode(barcode, self.longbar[0])
+            misses[barcode] = count
+        barhits = {i: dict(j) for (i, j) in self.barhits.items() if j}
+        return self.filestat, self.samplehits, barhits, misses
+
+
+
+class FastqBlockReader:
+    """
+    Reads complete 4-line fastq records from an open binary file in blocks.
+    Each block is returned as a uint8 array of the raw bytes and an array 
+    of the index of each newline in it (four per record).
+    """
+    def __init__(self, ofile, maxreads=None, readsize=int(2 ** 22)):
+        self.ofile = ofile
+        self.maxreads = maxreads
+        self.readsize = readsize
+        self.rest = b""
+        self.eof = False
+        self.nread = 0
+
+
+    def read(self, nreads):
+        "Returns (arr, ends) for up to nreads complete records"
+        if self.maxreads is not None:
+            nreads = max(0, min(nreads, self.maxreads - self.nread))
+        chunks = [self.rest]
+        nlines = self.rest.count(b"\n")
+        while (nlines < 4 * nreads) and (not self.eof):
+            chunk = self.ofile.read(self.readsize)
+            if not chunk:
+                self.eof = True
+                break
+            chunks.append(chunk)
+            nlines += chunk.count(b"\n")
+        buff = b"".join(chunks)
+
+        # terminate a last line that is missing its newline
+        if self.eof and buff and not buff.endswith(b"\n"):
+            buff += b"\n"
+
+        # cut after the last complete record and keep the rest for next
+        arr = np.frombuffer(buff, dtype=np.uint8)
+        ends = np.flatnonzero(arr == 10)
+        nrecs = min(nreads, ends.size // 4)
+        cut = (ends[4 * nrecs - 1] + 1 if nrecs else 0)
+        self.rest = buff[cut:]
+        self.nread += nrecs
+        return arr[:cut], ends[:4 * nrecs]
+
+
+
+class GzipSliceReader(io.RawIOBase):
+    """
+    Raw reader of the decompressed data of a (multi-member) gzip file 
+    starting uoffset bytes after an access point at compressed offset
+    coffset: the start of a member, or a deflate block boundary entered 
+    with the bits of the byte at coffset and the 32KB window before it 
+    (see iter_gzip_points). Wrap in io.BufferedReader to iterate over lines.
+    """
+    def __init__(self, path, coffset, uoffset, bits=None, window=None):
+        self.ofile = open(path, 'rb')
+        self.ofile.seek(coffset)
+        if window is None:
+            self.pieces = iter_gzip_members(self.ofile)
+        else:
+            self.pieces = iter_gzip_block(self.ofile, bits, window)
+        self.skip = uoffset
+        self.buff = memoryview(b"")
+
+
+    def readable(self):
+        return True
+
+
+    def readinto(self, out):
+        while not len(self.buff):
+            try:
+                piece = next(self.pieces)[1]
+            except StopIteration:
+                return 0
+            if self.skip:
+                cut = min(self.skip, len(piece))
+                self.skip -= cut
+                piece = piece[cut:]
+            self.buff = memoryview(piece)
+        size = min(len(out), len(self.buff))
+        out[:size] = self.buff[:size]
+        self.buff = self.buff[size:]
+        return size
+
+
+    def close(self):
+        self.ofile.close()
+        io.RawIOBase.close(self)
+
+
+class BarcodeIndex:
+    """
+    Index of sample barcodes to find the nearest barcode to an observed 
+    barcode within maxmismatch (Hamming distance). Each barcode is split into 
+    maxmismatch + 1 segments that are indexed as seeds, since a barcode 
+    within maxmismatch of an observed barcode must match it exactly in at 
+    least one segment (pigeonhole). Observed barcodes equally close to the 
+    barcodes of different samples are ambiguous and are not matched. Can be
+    used like the dict {barcode: sname} of true barcodes.
+    """
+    def __init__(self, barcodes, maxmismatch=0):
+        self.maxmismatch = int(maxmismatch)
+
+        # {barcode: sname} grouping technical replicates by name
+        self.barcodes = {}
+        for sname, barcode in barcodes.items():
+            if "-technical-replicate-" in sname:
+                sname = sname.rsplit("-technical-replicate", 1)[0]
+            self.barcodes[barcode] = sname
+
+        # {(length, segment idx, segment): [barcodes, ...]}
+        self.seeds = {}
+        for barcode in self.barcodes:
+            for seed in self.get_seeds(barcode):
+                self.seeds.setdefault(seed, []).append(barcode)
+
+        # cache of resolved observed barcodes, filled on engines.
+        self.cache = {}
+
+
+    def __iter__(self):
+        return iter(self.barcodes)
+
+
+    def __len__(self):
+        return len(self.barcodes)
+
+
+    def get_seeds(self, barcode):
+        "Returns the segments of a barcode as seed keys"
+        nsegs = self.maxmismatch + 1
+        bounds = [len(barcode) * i // nsegs for i in range(nsegs + 1)]
+        return [
+            (len(barcode), i, barcode[bounds[i]:bounds[i + 1]]) 
+            for i in range(nsegs)
+        ]
+
+
+    def get(self, barcode, default=None):
+        "Returns the sname of the nearest barcode, or default if none/ambig"
+        if barcode in self.barcodes:
+            return self.barcodes[barcode]
+        if barcode not in self.cache:
+            if len(self.cache) > MAXCACHE:
+                self.cache = {}
+            self.cache[barcode] = self.search(barcode)
+        sname = self.cache[barcode]
+        return (sname if sname else default)
+
+
+    def search(self, barcode):
+        "Returns the sname of the nearest barcode or None if none/ambig"
+        if not self.maxmismatch or not set(barcode).issubset(BARCHARS):
+            return None
+
+        # get candidates sharing a seed and their distances to barcode
+        snames = set()
+        mindist = self.maxmismatch + 1
+        candidates = set()
+        for seed in self.get_seeds(barcode):
+            candidates.update(self.seeds.get(seed, []))
+        for cand in candidates:
+            dist = sum(i != j for (i, j) in zip(cand, barcode))
+            if dist > self.maxmismatch:
+                continue
+            if dist < mindist:
+                mindist = dist
+                snames = set([self.barcodes[cand]])
+            elif dist == mindist:
+                snames.add(self.barcodes[cand])
+
+        # return sname if one sample is nearest
+        if len(snames) == 1:
+            return snames.pop()
+        return None
+
+
+    def ambiguous_pairs(self):
+        """
+        Returns a list of (sname, barcode, sname, barcode) for each pair of
+        barcodes of different samples that are close enough that a read 
+        could be within maxmismatch of both.
+        """
+        pairs = []
+        if not self.maxmismatch:
+            return pairs
+
+        # compare all barcodes of the same length at once
+        lengths = set(len(i) for i in self.barcodes)
+        for length in sorted(lengths):
+            barcodes = sorted(i for i in self.barcodes if len(i) == length)
+            arr = np.array([list(i) for i in barcodes]).reshape(-1, length)
+            dists = (arr[:, None, :] != arr[None, :, :]).sum(axis=2)
+            for idx, jdx in zip(*np.where(dists <= 2 * self.maxmismatch)):
+                bar0 = barcodes[idx]
+                bar1 = barcodes[jdx]
+                if (idx < jdx) and (self.barcodes[bar0] != self.barcodes[bar1]):
+                    pairs.append(
+                        (self.barcodes[bar0], bar0, self.barcodes[bar1], bar1))
+        return pairs
+
 
 
 # used inside BarMatch to store stats nicely.
 class Stats:
-    def __init__(self):
+    def __init__(self, snames):
         # stats for each raw input file
         self.perfile = {}
 
-        # stats for each sample
+        # stats for each sample (samplehits ordered by sorted snames)
+        self.snames = snames
         self.fdbars = {}
-        self.fsamplehits = Counter()
+        self.fsamplehits = np.zeros(len(snames), dtype=np.int64)
         self.fbarhits = Counter()
         self.fmisses = Counter()
 
 
-    def fill_from_pickle(self, pkl, handle):
-
-        # load in stats pickle
-        with open(pkl, 'rb') as infile:
-            filestats, samplestats = pickle.load(infile)
+    def fill_from_results(self, results, handle):
+        "Merges the stats returned by one BarMatch job"
+        filestats, samplehits, barhits, misses = results
 
         ## pull new stats
         self.perfile[handle] += filestats
 
         ## update sample stats
-        samplehits, barhits, misses, dbars = samplestats
-        self.fsamplehits.update(samplehits)
-        self.fbarhits.update(barhits)
+        self.fsamplehits += samplehits
+        for sname, hits in barhits.items():
+            self.fbarhits.update(hits)
+            self.fdbars.setdefault(sname, set()).update(hits)
         self.fmisses.update(misses)
-        self.fdbars.update(dbars)
 
 
 # -------------------------------------
@@ -964,9 +1324,18 @@ class Stats:
 def barmatch(args):
     # run procesor
     bar = BarMatch(*args)
-    # writes reads t ofile and writes stats to pickle
-    pkl = bar.run()
-    return pkl
+    # writes reads to file and returns stats
+    return bar.run()
+
+
+def get_snames(barcodes):
+    "Returns sorted sample names grouping technical replicates"
+    snames = set()
+    for sname in barcodes:
+        if "-technical-replicate-" in sname:
+            sname = sname.rsplit("-technical-replicate", 1)[0]
+        snames.add(sname)
+    return sorted(snames)
 
 
 # CALLED BY FILELINKER
@@ -1030,6 +1399,119 @@ def zbufcountlines(filename, gzipped):
     return nlines
 
 
+def decode_barcode(code, lenbar):
+    "Decodes a barcode string from an integer with 3 bits per base"
+    bases = []
+    for _ in range(lenbar):
+        bases.append(BARBASES[code & 7])
+        code >>= 3
+    return "".join(bases[::-1])
+
+
+@njit
+def block_barcodes(arr, ends, lenbar, tail, lencut):
+    """
+    Returns integer codes for the barcode of each record in a block (-1 if
+    not a full length ACGTN barcode) and whether a barcode string was found, 
+    following getbarcode2, or getbarcode1 when tail=1 (2brad).
+    """
+    nrecs = ends.size // 4
+    codes = np.full(nrecs, -1, dtype=np.int64)
+    found = np.zeros(nrecs, dtype=np.bool_)
+    for ridx in range(nrecs):
+        start = ends[4 * ridx] + 1
+        end = ends[4 * ridx + 1]
+        if tail:
+            wend = end - lencut
+            wstart = max(start, wend - lenbar)
+            found[ridx] = wend > start
+        else:
+            wstart = start
+            wend = min(end, start + lenbar)
+            found[ridx] = True
+        if wend - wstart != lenbar:
+            continue
+
+        code = 0
+        for idx in range(wstart, wend):
+            base = arr[idx]
+            if base == 65:
+                code = (code << 3)
+            elif base == 67:
+                code = (code << 3) | 1
+            elif base == 71:
+                code = (code << 3) | 2
+            elif base == 84:
+                code = (code << 3) | 3
+            elif base == 78:
+                code = (code << 3) | 4
+            else:
+                code = -1
+                break
+        codes[ridx] = code
+    return codes, found
+
+
+@njit
+def gather_reads(arr, ends, sidxs, nsamples, lenbar, tail, lencut):
+    """
+    Copies each record with a sample index >= 0 into one array grouped by 
+    sample (in file order) trimming the barcode from the seq and quality 
+    lines as in sort_reads. Returns the array and the sample offsets in it.
+    """
+    nrecs = ends.size // 4
+    starts = np.zeros(nrecs, dtype=np.int64)
+    starts[1:] = ends[3:-1:4] + 1
+
+    # the kept part of the seq and quality lines of each record
+    keeps = np.zeros((nrecs, 2, 2), dtype=np.int64)
+    sizes = np.zeros(nsamples, dtype=np.int64)
+    for ridx in range(nrecs):
+        if sidxs[ridx] < 0:
+            continue
+        size = ends[4 * ridx + 3] + 1 - starts[ridx]
+        for line in range(2):
+            start = ends[4 * ridx + 2 * line] + 1
+            end = ends[4 * ridx + 2 * line + 1]
+            if tail:
+                keeps[ridx, line, 0] = start
+                keeps[ridx, line, 1] = max(start, end - lencut - lenbar)
+            else:
+                keeps[ridx, line, 0] = min(end, start + lenbar)
+                keeps[ridx, line, 1] = end
+            size -= (end - start) - (keeps[ridx, line, 1] - keeps[ridx, line, 0])
+        sizes[sidxs[ridx]] += size
+
+    offsets = np.zeros(nsamples + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(sizes)
+    out = np.empty(offsets[-1], dtype=np.uint8)
+    fill = offsets[:-1].copy()
+
+    # copy name, kept seq, newline and +, kept quality, newline
+    bounds = np.zeros(10, dtype=np.int64)
+    for ridx in range(nrecs):
+        sidx = sidxs[ridx]
+        if sidx < 0:
+            continue
+        bounds[0] = starts[ridx]
+        bounds[1] = ends[4 * ridx] + 1
+        bounds[2] = keeps[ridx, 0, 0]
+        bounds[3] = keeps[ridx, 0, 1]
+        bounds[4] = ends[4 * ridx + 1]
+        bounds[5] = ends[4 * ridx + 2] + 1
+        bounds[6] = keeps[ridx, 1, 0]
+        bounds[7] = keeps[ridx, 1, 1]
+        bounds[8] = ends[4 * ridx + 3]
+        bounds[9] = ends[4 * ridx + 3] + 1
+        pos = fill[sidx]
+        for part in range(5):
+            for idx in range(bounds[2 * part], bounds[2 * part + 1]):
+                out[pos] = arr[idx]
+                pos += 1
+        fill[sidx] = pos
+    return out, offsets
+
+
 def find3radbcode(cutters, longbar, read):
     "find barcode sequence in the beginning of read"
     ## default barcode string
@@ -1091,7 +1573,10 @@ def getbarcode3(cutters, read1, longbar):
 
 
 def write_to_file(data, dsort, read, pid):
-    "Writes sorted data to tmp files"
+    """
+    Appends sorted data (bytes) to tmp files for each sample as compressed
+    BGZF blocks, such that the files can later simply be concatenated.
+    """
     if read == 1:
         rrr = "R1"
     else:
@@ -1105,181 +1590,445 @@ def write_to_file(data, dsort, read, pid):
         handle = os.path.join(
             data.dirs.fastqs, 
             "tmpdir",
-            "tmp_{}_{}_{}.fastq".format(sname, rrr, pid))
+            "tmp_{}_{}_{}.fastq.gz".format(sname, rrr, pid))
 
         # append to this sample name
-        with open(handle, 'a') as out:
-            out.write("".join(dsort[sname]))
+        with open(handle, 'ab') as out:
+            out.write(bgzf_compress(b"".join(dsort[sname])))
 
 
 
 def collate_files(data, sname, tmp1s, tmp2s):
     """ 
-    Collate temp fastq files in tmp-dir into 1 gzipped sample.
+    Collate compressed temp fastq files in tmp-dir into 1 gzipped sample.
+    The tmp files are BGZF so they are concatenated without recompressing.
     """
-    ## out handle
-    out1 = os.path.join(data.dirs.fastqs, "{}_R1_.fastq.gz".format(sname))
-    out = io.BufferedWriter(gzip.open(out1, 'w'))
-
-    ## build cmd
-    cmd1 = ['cat']
-    for tmpfile in tmp1s:
-        cmd1 += [tmpfile]
-
-    ## compression function
-    proc = sps.Popen(['which', 'pigz'], 
-        stderr=sps.PIPE, 
-        stdout=sps.PIPE).communicate()
-    if proc[0].strip():
-        compress = ["pigz"]
-    else:
-        compress = ["gzip"]
+    reads = [("R1", tmp1s)]
+    if 'pair' in data.params.datatype:
+        reads.append(("R2", tmp2s))
+
+    for rrr, tmps in reads:
+        out = os.path.join(
+            data.dirs.fastqs, "{}_{}_.fastq.gz".format(sname, rrr))
+
+        # the first tmp file is moved and the rest are appended to it
+        mode = 'wb'
+        if tmps:
+            os.rename(tmps[0], out)
+            mode = 'ab'
+        with open(out, mode) as outfile:
+            for tmpfile in tmps[1:]:
+                with open(tmpfile, 'rb') as infile:
+                    shutil.copyfileobj(infile, outfile)
+                os.remove(tmpfile)
+            outfile.write(BGZF_EOF)
+
+
+def estimate_nreads(path, nsamples=4, sampsize=int(2 ** 18)):
+    """ 
+    Estimate the number of reads in a raw fastq file from the number of 
+    lines per (compressed) byte in a few samples spread through the file, 
+    decompressed in memory. Samples from gzip files after the first start at 
+    the next member found after the sample offset (e.g., BGZF blocks). 
+    """
+    size = os.path.getsize(path)
+    nlines = 0
+    nbytes = 0
+    with open(path, 'rb') as infile:
+        for sidx in range(nsamples):
+            offset = size * sidx // nsamples
+            if path.endswith(".gz"):
+                sample = sample_gzip_lines(infile, offset, sampsize)
+            else:
+                infile.seek(offset)
+                chunk = infile.read(sampsize)
+                sample = (len(chunk), chunk.count(b"\n"))
+            if sample:
+                nbytes += sample[0]
+                nlines += sample[1]
+    if not nbytes:
+        return 0
+    return int(size * nlines / nbytes / 4)
+
+
+def sample_gzip_lines(infile, offset, sampsize):
+    """
+    Returns (ncompressed, nlines) for a sample of up to sampsize compressed
+    bytes starting at the first gzip member at or after offset, or None if 
+    no member start is found near offset.
+    """
+    infile.seek(offset)
+    chunk = infile.read(2 * sampsize)
+    start = 0
+    while 1:
+        # find the next gzip magic bytes and try to decompress from there
+        start = chunk.find(b"\x1f\x8b\x08", start)
+        if start < 0:
+            return None
+        sample = data = chunk[start:start + sampsize]
+        nlines = 0
+        dobj = zlib.decompressobj(31)
+        try:
+            while data:
+                nlines += dobj.decompress(data).count(b"\n")
+                if not dobj.eof:
+                    break
+                data = dobj.unused_data
+                dobj = zlib.decompressobj(31)
 
-    ## call cmd
-    proc1 = sps.Popen(cmd1, stderr=sps.PIPE, stdout=sps.PIPE)
-    proc2 = sps.Popen(compress, 
-        stdin=proc1.stdout, 
-        stderr=sps.PIPE, 
-        stdout=out)
-    err = proc2.communicate()
-    if proc2.returncode:
-        raise IPyradError("error in collate_files R1 %s", err)
-    proc1.stdout.close()
-    out.close()
+        # not a member start, or trailing bytes after the last member
+        except zlib.error:
+            if data is sample:
+                start += 1
+                continue
+            return len(sample) - len(data), nlines
+        return len(sample), nlines
 
-    ## then cleanup
-    for tmpfile in tmp1s:
-        os.remove(tmpfile)
 
-    if 'pair' in data.params.datatype:
-        ## out handle
-        out2 = os.path.join(data.dirs.fastqs, "{}_R2_.fastq.gz".format(sname))
-        out = io.BufferedWriter(gzip.open(out2, 'w'))
-
-        ## build cmd
-        cmd1 = ['cat']
-        for tmpfile in tmp2s:
-            cmd1 += [tmpfile]
-
-        ## call cmd
-        proc1 = sps.Popen(cmd1, stderr=sps.PIPE, stdout=sps.PIPE)
-        proc2 = sps.Popen(compress, 
-            stdin=proc1.stdout,
-            stderr=sps.PIPE, 
-            stdout=out)
-        err = proc2.communicate()
-        if proc2.returncode:
-            raise IPyradError("error in collate_files R2 %s", err)
-        proc1.stdout.close()
-        out.close()
-
-        ## then cleanup
-        for tmpfile in tmp2s:
-            os.remove(tmpfile)
-
-
-def inverse_barcodes(data):
-    """ Build full inverse barcodes dictionary """
-    matchdict = {}
-    bases = set("CATGN")
-    poss = set()
-
-    ## do perfect matches
-    for sname, barc in data.barcodes.items():
-        ## remove -technical-replicate-N if present
-        if "-technical-replicate-" in sname:
-            sname = sname.rsplit("-technical-replicate", 1)[0]
-        matchdict[barc] = sname
-        poss.add(barc)
-
-        if data.params.max_barcode_mismatch:
-            ## get 1-base diffs
-            for idx1, base in enumerate(barc):
-                diffs = bases.difference(base)
-                for diff in diffs:
-                    lbar = list(barc)
-                    lbar[idx1] = diff
-                    tbar1 = "".join(lbar)
-                    if tbar1 not in poss:
-                        matchdict[tbar1] = sname                    
-                        poss.add(tbar1)
-                    else:
-                        if matchdict.get(tbar1) != sname:
-                            print("""\
-        Note: barcodes {}:{} and {}:{} are within {} base change of each other
-            Ambiguous barcodes that match to both samples will arbitrarily
-            be assigned to the first sample. If you do not like this idea 
-            then lower the value of max_barcode_mismatch and rerun step 1\n"""
-            .format(sname, barc, 
-                matchdict[tbar1], data.barcodes[matchdict[tbar1]],
-                data.params.max_barcode_mismatch))
-
-                ## if allowing two base difference things get big
-                ## for each modified bar, allow one modification to other bases
-                if data.params.max_barcode_mismatch > 1:
-                    for idx2, _ in enumerate(tbar1):
-                        ## skip the base that is already modified
-                        if idx2 != idx1:
-                            for diff in bases.difference(tbar1[idx2]):
-                                ltbar = list(tbar1)
-                                ltbar[idx2] = diff
-                                tbar2 = "".join(ltbar)
-                                if tbar2 not in poss:
-                                    matchdict[tbar2] = sname                    
-                                    poss.add(tbar2)
-                                else:
-                                    if matchdict.get(tbar2) != sname:
-                                        print("""\
-        Note: barcodes {}:{} and {}:{} are within {} base change of each other\
-             Ambiguous barcodes that match to both samples will arbitrarily
-             be assigned to the first sample. If you do not like this idea 
-             then lower the value of max_barcode_mismatch and rerun step 1\n"""
-             .format(sname, barc, 
-                     matchdict[tbar2], data.barcodes[matchdict[tbar2]],
-                     data.params.max_barcode_mismatch))
-    return matchdict
-
-
-def estimate_nreads(data, testfile):
-    """ 
-    Estimate a reasonable optim value by grabbing a chunk of sequences, 
-    decompressing and counting them, to estimate the full file size.
+def iter_gzip_members(ofile, readsize=int(2 ** 20)):
     """
-    ## count the len of one file and assume all others are similar len
-    insize = os.path.getsize(testfile)
-    tmp_file_name = os.path.join(
-        data.params.project_dir, 
-        "tmp-step1-count.fq")
-
-    if testfile.endswith(".gz"):
-        infile = gzip.open(testfile)
-        outfile = gzip.open(tmp_file_name, 'w', compresslevel=5)
-    else:
-        infile = open(testfile)
-        outfile = open(tmp_file_name, 'w')
-        
-    ## We'll take the average of the size of a file based on the
-    ## first 10000 reads to approximate number of reads in the main file
+    Yields (coffset, data) for pieces of decompressed data of each member of
+    a (multi-member) gzip file read from its current position, where coffset
+    is the position of the start of the member in the compressed file.
+    """
+    dobj = zlib.decompressobj(31)
+    mstart = ofile.tell()
+    chunk = ofile.read(readsize)
+    while chunk:
+        data = dobj.decompress(chunk)
+        if data:
+            yield mstart, data
+        if dobj.eof:
+            rest = dobj.unused_data
+            mstart = ofile.tell() - len(rest)
+            dobj = zlib.decompressobj(31)
+            chunk = rest or ofile.read(readsize)
+        else:
+            chunk = ofile.read(readsize)
+
+
+class ZStream(ctypes.Structure):
+    "zlib's z_stream struct"
+    _fields_ = [
+        ("next_in", ctypes.c_void_p),
+        ("avail_in", ctypes.c_uint),
+        ("total_in", ctypes.c_ulong),
+        ("next_out", ctypes.c_void_p),
+        ("avail_out", ctypes.c_uint),
+        ("total_out", ctypes.c_ulong),
+        ("msg", ctypes.c_char_p),
+        ("state", ctypes.c_void_p),
+        ("zalloc", ctypes.c_void_p),
+        ("zfree", ctypes.c_void_p),
+        ("opaque", ctypes.c_void_p),
+        ("data_type", ctypes.c_int),
+        ("adler", ctypes.c_ulong),
+        ("reserved", ctypes.c_ulong),
+    ]
+
+
+def load_libz():
+    """
+    Returns the zlib shared library loaded with ctypes, or None if it 
+    cannot be found, in which case only BGZF files can be read from an 
+    offset.
+    """
+    path = ctypes.util.find_library("z")
+    if not path:
+        return None
     try:
-        dat = b"".join(islice(infile, 40000))
-    except TypeError:
-        dat = "".join(islice(infile, 40000))
-    outfile.write(dat)
-    outfile.close()
-    infile.close()
+        libz = ctypes.CDLL(path)
+    except OSError:
+        return None
+    strm = ctypes.POINTER(ZStream)
+    libz.zlibVersion.restype = ctypes.c_char_p
+    libz.inflateInit2_.argtypes = [
+        strm, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+    libz.inflate.argtypes = [strm, ctypes.c_int]
+    libz.inflateEnd.argtypes = [strm]
+    libz.inflatePrime.argtypes = [strm, ctypes.c_int, ctypes.c_int]
+    libz.inflateSetDictionary.argtypes = [
+        strm, ctypes.c_char_p, ctypes.c_uint]
+    return libz
+
+
+class Inflater:
+    """
+    Minimal ctypes wrapper of zlib's inflate() for the two things the zlib
+    module does not expose, which are needed to index and enter a single 
+    member gzip file at any deflate block boundary as in zlib's zran.c 
+    example: stopping at block boundaries (Z_BLOCK), and starting at a 
+    boundary that is not byte aligned (inflatePrime).
+    """
+    def __init__(self, wbits, bits=0, value=0, window=None):
+        self.strm = ZStream()
+        self.inbuf = None
+        self.outbuf = ctypes.create_string_buffer(INFLATE_OUTSIZE)
+        self.eof = False
+        ret = LIBZ.inflateInit2_(
+            ctypes.byref(self.strm), wbits, LIBZ.zlibVersion(), 
+            ctypes.sizeof(self.strm))
+        if ret != Z_OK:
+            raise IPyradError("zlib inflateInit2 error: {}".format(ret))
+        if bits:
+            LIBZ.inflatePrime(ctypes.byref(self.strm), bits, value)
+        if window:
+            LIBZ.inflateSetDictionary(
+                ctypes.byref(self.strm), window, len(window))
+
+
+    def feed(self, data):
+        "set data as the next input, it must be called when avail_in is 0"
+        self.inbuf = ctypes.create_string_buffer(data, len(data))
+        self.strm.next_in = ctypes.addressof(self.inbuf)
+        self.strm.avail_in = len(data)
+
+
+    def inflate(self):
+        "decompress up to the end of the next deflate block or of the input"
+        self.strm.next_out = ctypes.addressof(self.outbuf)
+        self.strm.avail_out = INFLATE_OUTSIZE
+        ret = LIBZ.inflate(ctypes.byref(self.strm), Z_BLOCK)
+        if ret == Z_STREAM_END:
+            self.eof = True
+        elif ret not in (Z_OK, Z_BUF_ERROR):
+            raise IPyradError(
+                "error decompressing gzip file: {}".format(self.strm.msg))
+        return ctypes.string_at(
+            self.outbuf, INFLATE_OUTSIZE - self.strm.avail_out)
+
+
+    @property
+    def avail_in(self):
+        return self.strm.avail_in
+
+
+    @property
+    def unused_data(self):
+        return ctypes.string_at(self.strm.next_in, self.strm.avail_in)
+
+
+    @property
+    def at_block_end(self):
+        "at the end of a block that is not the last one of the stream"
+        dtype = self.strm.data_type
+        return bool(dtype & 128) and not (dtype & 64)
+
+
+    @property
+    def bits(self):
+        "the number of unused bits in the last input byte consumed"
+        return self.strm.data_type & 7
+
+
+    def close(self):
+        LIBZ.inflateEnd(ctypes.byref(self.strm))
+
+
+
+def iter_gzip_points(ofile, readsize=int(2 ** 20)):
+    """
+    Yields (point, uoffset, data) for pieces of decompressed data of a 
+    (multi-member) gzip file read from its current position, where uoffset
+    is the offset of the piece from the access point that it can be read 
+    from. Access points are the start of each member (coffset,) and the 
+    first deflate block boundary at least GZIP_SPAN bytes after the last 
+    access point (coffset, bits, window), which is entered by priming inflate with
+    the last bits of the byte at coffset and the 32KB window before it.
+    """
+    inflater = Inflater(31)
+    point = (ofile.tell(),)
+    uoffset = 0
+    window = b""
+    while 1:
+        if not inflater.avail_in:
+            inflater.feed(ofile.read(readsize))
+        data = inflater.inflate()
+        if data:
+            yield point, uoffset, data
+            uoffset += len(data)
+            window = (window + data)[-GZIP_WINDOW:]
+
+        # start a new inflater at the next member, if any
+        if inflater.eof:
+            rest = inflater.unused_data or ofile.read(readsize)
+            inflater.close()
+            if not rest:
+                break
+            inflater = Inflater(31)
+            inflater.feed(rest)
+            point = (ofile.tell() - len(rest),)
+            uoffset = 0
+            window = b""
+
+        # store an access point at this block boundary
+        elif inflater.at_block_end and uoffset >= GZIP_SPAN:
+            bits = inflater.bits
+            coffset = ofile.tell() - inflater.avail_in - (1 if bits else 0)
+            point = (coffset, bits, window)
+            uoffset = 0
+
+        # truncated file
+        elif not (data or inflater.avail_in):
+            inflater.close()
+            break
+
+
+def iter_gzip_block(ofile, bits, window, readsize=int(2 ** 20)):
+    """
+    Yields (coffset, data) for pieces of decompressed data of a gzip file
+    read from a block boundary access point at its current position, and 
+    of the members after it, where coffset is the start of the member 
+    following the access point (or 0 for the member containing it).
+    """
+    value = 0
+    if bits:
+        value = ord(ofile.read(1)) >> (8 - bits)
+    inflater = Inflater(-15, bits, value, window)
+    while 1:
+        if not inflater.avail_in:
+            chunk = ofile.read(readsize)
+            if not chunk:
+                break
+            inflater.feed(chunk)
+        data = inflater.inflate()
+        if data:
+            yield 0, data
+        if inflater.eof:
+            break
 
-    ## Get the size of the tmp file
-    tmp_size = os.path.getsize(tmp_file_name)
+    # skip the 8 byte gzip trailer and read any following members
+    inflater.close()
+    if inflater.eof:
+        ofile.seek(8 - inflater.avail_in, 1)
+        for member in iter_gzip_members(ofile, readsize):
+            yield member
 
-    # divide by the tmp file size and multiply by 10000 to approximate
-    # the size of the input .fq files
-    inputreads = int(insize / tmp_size) * 10000
-    os.remove(tmp_file_name)
 
-    return inputreads
+def is_bgzf(path):
+    "True if the first gzip member header has the BGZF extra field 'BC'"
+    with open(path, 'rb') as ofile:
+        head = ofile.read(18)
+    return (
+        head[:4] == b"\x1f\x8b\x08\x04" and head[12:14] == b"BC")
+
+
+def open_fastq_slice(path, coffset, uoffset, bits=None, window=None):
+    "Returns a binary file handle at an indexed record of a raw fastq file"
+    if path.endswith(".gz"):
+        return io.BufferedReader(
+            GzipSliceReader(path, coffset, uoffset, bits, window), 
+            int(2 ** 20))
+    ofile = open(path, 'rb')
+    ofile.seek(coffset + uoffset)
+    return ofile
+
+
+def iter_points(pieces):
+    """
+    Yields (point, uoffset, data) for (coffset, data) pieces of a file 
+    (see iter_gzip_points) with an access point (coffset,) at each new 
+    coffset, i.e., the start of each member of a BGZF or uncompressed file.
+    """
+    point = None
+    for coffset, data in pieces:
+        if point != (coffset,):
+            point = (coffset,)
+            uoffset = 0
+        yield point, uoffset, data
+        uoffset += len(data)
+
+
+def index_fastq(path, optim):
+    """
+    Reads through a raw fastq file without writing anything to find the
+    offsets of the first record of every chunk of optim reads. Returns a 
+    list of (offsets, nreads) where offsets are the arguments to 
+    open_fastq_slice: (coffset, uoffset) for the byte offset of the record
+    (coffset is 0 if not gzipped, or the start of the gzip member), or 
+    (coffset, uoffset, bits, window) for a record uoffset bytes after a 
+    deflate block access point. Returns None for gzip files that are not
+    BGZF if zlib's library cannot be loaded to make block access points.
+    """
+    gzipped = path.endswith(".gz")
+    if gzipped and (LIBZ is None) and (not is_bgzf(path)):
+        return None
+
+    offsets = []
+    nlines = 0
+    target = 0
+    lastbyte = b"\n"
+    with open(path, 'rb') as ofile:
+        if gzipped and LIBZ:
+            pieces = iter_gzip_points(ofile)
+        elif gzipped:
+            pieces = iter_points(iter_gzip_members(ofile))
+        else:
+            pieces = iter_points(
+                (0, i) for i in iter(lambda: ofile.read(2 ** 20), b""))
+
+        for point, uoffset, piece in pieces:
+            nnew = piece.count(b"\n")
+
+            # store offsets of chunk starts that fall in this piece
+            while target <= nlines + nnew:
+                if target == nlines:
+                    start = uoffset
+                else:
+                    ends = np.flatnonzero(
+                        np.frombuffer(piece, dtype=np.uint8) == 10)
+                    start = uoffset + int(ends[target - nlines - 1]) + 1
+                offsets.append((point[0], start) + point[1:])
+                target += 4 * optim
+
+            nlines += nnew
+            lastbyte = piece[-1:]
+
+    # a last line missing its newline is still a line
+    if lastbyte != b"\n":
+        nlines += 1
+    nreads = nlines // 4
+
+    # pair offsets with the number of reads in each chunk
+    chunks = []
+    for cidx, offset in enumerate(offsets):
+        size = min(optim, nreads - cidx * optim)
+        if size > 0:
+            chunks.append((offset, size))
+    return chunks
 
 
 # used by splitfiles()
+def index_fastq_chunks(data, ftup, num, tmpdir, optim, start):
+    """
+    Index R1 (and R2) files into chunks of optim reads that are read in place
+    by barmatch. Returns a list of (ftup, chunk). Falls back to splitting 
+    into tmp files with zcat_make_temps for files that cannot be indexed.
+    """
+    chunks1 = index_fastq(ftup[0], optim)
+    chunks2 = None
+    if chunks1 and ("pair" in data.params.datatype):
+        chunks2 = index_fastq(ftup[1], optim)
+        if chunks2 and len(chunks1) != len(chunks2):
+            raise IPyradError(
+                "R1 and R2 files have different numbers of reads: {}"
+                .format(ftup))
+
+    # not indexable, write temp file chunks instead
+    if (chunks1 is None) or (("pair" in data.params.datatype) and not chunks2):
+        args = (data, ftup, num, tmpdir, optim, start)
+        return [(i, None) for i in zcat_make_temps(*args)]
+
+    # ((r1 offsets, r2 offsets, nreads), ...)
+    if chunks2 is None:
+        chunks2 = [((0, 0), i[1]) for i in chunks1]
+    return [
+        (ftup, (off1, off2, nreads)) 
+        for ((off1, nreads), (off2, _)) in zip(chunks1, chunks2)
+    ]
+
+
+# used by index_fastq_chunks()
 def zcat_make_temps(data, ftup, num, tmpdir, optim, start):
     """ 
     Call bash command 'cat' and 'split' to split large files into 4 bits.
@@ -1348,6 +2097,34 @@ def zcat_make_temps(data, ftup, num, tmpdir, optim, start):
 
 
 ## GLOBALS
+# zlib constants used with Inflater, the size of its output buffer, the 
+# size of the deflate window, and the min distance in decompressed bytes 
+# between access points to a single member gzip file.
+Z_OK = 0
+Z_STREAM_END = 1
+Z_BUF_ERROR = -5
+Z_BLOCK = 5
+INFLATE_OUTSIZE = int(2 ** 18)
+GZIP_WINDOW = 32768
+GZIP_SPAN = int(2 ** 20)
+LIBZ = load_libz()
+
+# bases in the order used to encode barcodes as ints (3 bits per base) in
+# the block matcher, the longest barcode that fits in an int64, the max
+# number of resolved (or unmatched) barcodes to keep, and the number of 
+# most common unmatched barcodes to return from each job.
+BARBASES = "ACGTN"
+BARCHARS = set("ACGTN+")
+MAXBLOCKBAR = 21
+MAXCACHE = int(1e6)
+NMISSES = 1000
+
+AMBIGUOUS_BARCODES = """\
+    Note: barcodes {}:{} and {}:{} are within 2x{} base changes of each other.
+    Reads that are equally close to both barcodes are ambiguous and will 
+    not be assigned to either sample.
+"""
+
 NO_RAWS = """\
     No data found in {}. Fix path to data files.
     """
@@ -12,16 +12,15 @@ except ImportError:
 
 import os
 import time
-import gzip
-from collections import Counter
 
 import scipy.optimize
+import scipy.special
 import scipy.stats
 import numpy as np
 import numba
 
-from .clustmap import get_quick_depths
-from .utils import IPyradError, clustdealer
+from .clustmap import get_quick_depths, get_cluster_store_path
+from .utils import IPyradError, ClusterStore, count_sites
 
 
 class Step4:
@@ -115,14 +114,18 @@ class Step4:
         # send all jobs to a load balanced client
         lbview = self.ipyclient.load_balanced_view()
 
-        # stores async results using sample names
-        jobs = {}
-        for sample in self.samples:
-            jobs[sample.name] = lbview.apply(optim, *(self.data, sample))
+        # samples are sent in batches (about OPTIMBATCHES per engine) that 
+        # each run several fits, with the largest samples spread across them
+        nbatches = min(
+            len(self.samples), OPTIMBATCHES * len(self.ipyclient.ids))
+        jobs = []
+        for bidx in range(nbatches):
+            batch = self.samples[bidx::nbatches]
+            jobs.append(lbview.apply(optim_batch, *(self.data, batch)))
 
         # progress bar
         while 1:
-            fin = [i.ready() for i in jobs.values()]
+            fin = [i.ready() for i in jobs]
             self.data._progressbar(len(fin), sum(fin), start, printstr)
             time.sleep(0.1)
             if len(fin) == sum(fin):
@@ -132,9 +135,16 @@ class Step4:
         self.data._print("")        
         for job in jobs:
             # collect results
-            hest, eest, success = jobs[job].get()
-            # store results to sample objects
-            sample_cleanup(self.data.samples[job], hest, eest, success)
+            for sname, result in job.get().items():
+                # store results to sample objects
+                sample_cleanup(self.data.samples[sname], *result)
+
+        # report fits that did not converge
+        for sample in self.samples:
+            if not sample.stats_dfs.s4.get("optim_converged", True):
+                self.data._print(
+                    "{}[H, E] estimate did not converge for {}"
+                    .format(self.data._spacer, sample.name))
 
 
     def cleanup(self):
@@ -172,101 +182,107 @@ class Step4:
 ############################################################################
 
 
-def likelihood1(errors, bfreqs, ustacks):
+def get_stack_stats(ustacks, bfreqs):
     """
-    Probability homozygous. """
-    ## make sure base_frequencies are in the right order
-    # print uniqstackl.sum()-uniqstack, uniqstackl.sum(), 0.001
-    # totals = np.array([ustacks.sum(axis=1)]*4).T
-    totals = np.array([ustacks.sum(axis=1)] * 4).T
-    prob = scipy.stats.binom.pmf(totals - ustacks, totals, errors)
-    lik1 = np.sum(bfreqs * prob, axis=1)
-    return lik1
+    Precomputes the terms of the likelihood of each unique stack that do not
+    depend on [H, E]: the base counts (c) and log binomial coefficients of 
+    the homozygous likelihood, and for each of the six pairs of bases (j, k)
+    of the heterozygous likelihood the base counts, log binomial coefficient
+    and the constant part, 2 * f_j * f_k * P(n - c_j - c_k | n, 0.5) / 
+    (1 - sum(f^2)).
+    """
+    ust = ustacks.astype(np.float64)
+    tots = ust.sum(axis=1)
+
+    # homozygous: P(n - c_k | n, E) for each base
+    misses = tots[:, None] - ust
+    logc1 = (
+        scipy.special.gammaln(tots + 1)[:, None] 
+        - scipy.special.gammaln(misses + 1)
+        - scipy.special.gammaln(ust + 1))
+
+    # heterozygous: P(c_j | c_j + c_k, 2E/3) for each pair of bases
+    jidx, kidx = np.array(list(combinations(range(4), 2))).T
+    cjs = ust[:, jidx]
+    cks = ust[:, kidx]
+    logc2 = (
+        scipy.special.gammaln(cjs + cks + 1)
+        - scipy.special.gammaln(cjs + 1)
+        - scipy.special.gammaln(cks + 1))
+    one = 2. * bfreqs[jidx] * bfreqs[kidx]
+    four = 1. - np.sum(bfreqs ** 2)
+    twos = scipy.stats.binom.pmf(
+        tots[:, None] - cjs - cks, tots[:, None], 0.5)
+    hconst = one * twos / four
+    return ust, misses, logc1, cjs, cks, logc2, hconst
 
 
 
 @numba.jit(nopython=True)
-def nblik2_build(ustacks):
-    "JIT'd function builds array that can be used to calc binom pmf"
-    # fill for pmf later
-    tots = np.empty((ustacks.shape[0], 1))
-    twos = np.empty((ustacks.shape[0], 6))
-    thrs = np.empty((ustacks.shape[0], 6, 2))
-
-    ## fill big arrays
-    for idx in range(ustacks.shape[0]):
-
-        ust = ustacks[idx]
-        tot = ust.sum()
-        tots[idx] = tot
-
-        ## fast filling of arrays
-        i = 0
-        for jdx in range(4):
-            for kdx in range(4):
-                if jdx < kdx:
-                    twos[idx][i] = tot - ust[jdx] - ust[kdx]
-                    thrs[idx][i] = ust[jdx], ust[jdx] + ust[kdx]
-                    i += 1
-
-    return tots, twos, thrs
-
-
-
-def lik2_calc(err, one, tots, twos, thrs, four):
-    "vectorized calc of binom pmf on large arrays"
-    ## calculate twos
-    _twos = scipy.stats.binom.pmf(twos, tots, 0.5)
-
-    ## calculate threes
-    _thrs = thrs.reshape(thrs.shape[0] * thrs.shape[1], thrs.shape[2])
-    _thrs = scipy.stats.binom.pmf(_thrs[:, 0], _thrs[:, 1], (2. * err) / 3.)
-    _thrs = _thrs.reshape(thrs.shape[0], 6)
-
-    ## calculate return sums
-    return np.sum(one * _twos * (_thrs / four), axis=1)
-
-
-
-def nlikelihood2(errors, bfreqs, ustacks):
-    "calls nblik2_build and lik2_calc for a given err"
-    one = [2. * bfreqs[i] * bfreqs[j] for i, j in combinations(range(4), 2)]
-    four = 1. - np.sum(bfreqs**2)
-    tots, twos, thrs = nblik2_build(ustacks)
-    res2 = lik2_calc(errors, one, tots, twos, thrs, four)
-    return res2
-
-
-
-def nget_diploid_lik(pstart, bfreqs, ustacks, counts):
-    "Log likelihood score given values [H,E]"
-    hetero, errors = pstart
-    if (hetero <= 0.) or (errors <= 0.):
-        score = np.exp(100)
-    else:
-        ## get likelihood for all sites
-        lik1 = (1. - hetero) * likelihood1(errors, bfreqs, ustacks)
-        lik2 = (hetero) * nlikelihood2(errors, bfreqs, ustacks)
-        liks = lik1 + lik2
-        logliks = np.log(liks[liks > 0]) * counts[liks > 0]
-        score = -logliks.sum()
-    return score
-
-
-
-def get_haploid_lik(errors, bfreqs, ustacks, counts):
-    "Log likelihood score given values [E]"
-    hetero = 0.
-    ## score terribly if below 0
-    if errors <= 0.:
-        score = np.exp(100)
-    else:
-        ## get likelihood for all sites
-        lik1 = ((1. - hetero) * likelihood1(errors, bfreqs, ustacks))
-        liks = lik1
-        logliks = np.log(liks[liks > 0]) * counts[liks > 0]
-        score = -logliks.sum()
-    return score
+def nlik_and_grad(hetero, errors, bfreqs, counts, stats):
+    """
+    Returns the negative log likelihood of the unique stacks (each weighted
+    by its count) given [H, E], and its gradient with respect to H and E, 
+    from the precomputed stack stats (see get_stack_stats).
+    """
+    ust, misses, logc1, cjs, cks, logc2, hconst = stats
+    loge = np.log(errors)
+    log1e = np.log(1. - errors)
+    err3 = (2. * errors) / 3.
+    loge3 = np.log(err3)
+    log1e3 = np.log(1. - err3)
+
+    score = 0.
+    gradh = 0.
+    grade = 0.
+    for idx in range(ust.shape[0]):
+        # homozygous likelihood and its derivative
+        lik1 = 0.
+        dlik1 = 0.
+        for kdx in range(4):
+            prob = bfreqs[kdx] * np.exp(
+                logc1[idx, kdx] 
+                + misses[idx, kdx] * loge 
+                + ust[idx, kdx] * log1e)
+            lik1 += prob
+            dlik1 += prob * (
+                misses[idx, kdx] / errors - ust[idx, kdx] / (1. - errors))
+
+        # heterozygous likelihood and its derivative
+        lik2 = 0.
+        dlik2 = 0.
+        for jdx in range(6):
+            prob = hconst[idx, jdx] * np.exp(
+                logc2[idx, jdx] 
+                + cjs[idx, jdx] * loge3 
+                + cks[idx, jdx] * log1e3)
+            lik2 += prob
+            dlik2 += prob * (2. / 3.) * (
+                cjs[idx, jdx] / err3 - cks[idx, jdx] / (1. - err3))
+
+        # sum log likelihoods of sites
+        lik = (1. - hetero) * lik1 + hetero * lik2
+        if lik > 0:
+            score -= counts[idx] * np.log(lik)
+            gradh -= counts[idx] * (lik2 - lik1) / lik
+            grade -= counts[idx] * (
+                (1. - hetero) * dlik1 + hetero * dlik2) / lik
+    return score, gradh, grade
+
+
+
+def get_diploid_lik(pstart, bfreqs, counts, stats):
+    "Log likelihood score and gradient given values [H,E]"
+    score, gradh, grade = nlik_and_grad(
+        pstart[0], pstart[1], bfreqs, counts, stats)
+    return score, np.array([gradh, grade])
+
+
+
+def get_haploid_lik(pstart, bfreqs, counts, stats):
+    "Log likelihood score and gradient given values [E] with H fixed to 0"
+    score, _, grade = nlik_and_grad(0., pstart[0], bfreqs, counts, stats)
+    return score, np.array([grade])
 
 
 
@@ -321,9 +337,8 @@ def stackarray(data, sample):
     sample.stats["clusters_hidepth"] = hidepth
     sample.stats_dfs.s3["clusters_hidepth"] = hidepth
 
-    # get clusters file
-    clusters = gzip.open(sample.files.clusters, 'rb')
-    pairdealer = izip(*[iter(clusters)] * 2)
+    # get clusters from the binary store written in step 3
+    store = ClusterStore(get_cluster_store_path(sample))
 
     # we subsample, else ... (could e.g., use first 10000 loci).
     # limit maxlen b/c some ref clusters can create huge contigs
@@ -346,60 +361,50 @@ def stackarray(data, sample):
 
     # fill stacked
     nclust = 0
-    done = 0
-    while not done:
+    for _, reps, _, seqs in store.iter_clusters():
         try:
-            done, chunk = clustdealer(pairdealer, 1)
-        except IndexError:
+            seqs = np.vstack(seqs)
+        except ValueError:
             raise IPyradError(
-                "  clustfile formatting error in {}".format(chunk))
-
-        if chunk:
-            piece = chunk[0].decode().strip().split("\n")
-            names = piece[0::2]
-            seqs = piece[1::2]
-            # pull replicate read info from seqs
-            reps = [int(sname.split("=")[-1][:-2]) for sname in names]
-
-            ## get all reps
-            sseqs = [list(seq) for seq in seqs]
-            arrayed = np.concatenate([
-                [seq] * rep for seq, rep in zip(sseqs, reps)
-            ])
-
-            ## enforce minimum depth for estimates
-            if arrayed.shape[0] >= data.params.mindepth_statistical:
-                # remove edge columns and select only the first 500
-                # derep reads, just like in step 5
-                arrayed = arrayed[:500, cutlens[0]:cutlens[1]]
-                # remove cols that are pair separator
-                arrayed = arrayed[:, ~np.any(arrayed == "n", axis=0)]
-                # remove cols that are all Ns after converting -s to Ns
-                arrayed[arrayed == "-"] = "N"
-                arrayed = arrayed[:, ~np.all(arrayed == "N", axis=0)]
-                # store in stacked dict
-
-                catg = np.array(
-                    [np.sum(arrayed == i, axis=0) for i in list("CATG")],
-                    dtype=np.uint64).T
-
-                stacked[nclust, :catg.shape[0], :] = catg
-                nclust += 1
+                "  clustfile formatting error in {}".format(sample.name))
+
+        ## enforce minimum depth for estimates
+        if reps.sum() >= data.params.mindepth_statistical:
+            # remove edge columns and select only the first 500
+            # derep reads, just like in step 5, by capping the reps
+            reps = reps.astype(np.int64)
+            reps = np.clip(500 - (np.cumsum(reps) - reps), 0, reps)
+            counts = count_sites(seqs[:, cutlens[0]:cutlens[1]], reps)
+            depth = reps.sum()
+            # remove cols that are pair separator
+            counts = counts[counts[:, 110] == 0]
+            # remove cols that are all Ns after converting -s to Ns
+            counts = counts[counts[:, 45] + counts[:, 78] != depth]
+            # store in stacked dict
+            catg = counts[:, [67, 65, 84, 71]].astype(np.uint64)
+
+            stacked[nclust, :catg.shape[0], :] = catg
+            nclust += 1
+
         # bail out when nclusts have been done
         if nclust == hidepth:
-            done = True
+            break
 
     ## drop the empty rows in case there are fewer loci than the size of array
     newstack = stacked[stacked.sum(axis=2) > 0]
     assert not np.any(newstack.sum(axis=1) == 0), "no zero rows"
-    clusters.close()
+    store.close()
 
     return newstack
 
 
 
 def optim(data, sample):
-    """ func scipy optimize to find best parameters"""
+    """ 
+    func scipy optimize to find best parameters. Returns [H, E], whether 
+    there were data to estimate them from, and a dict of diagnostics of 
+    the convergence of the optimizer.
+    """
 
     hetero = 0.01
     errors = 0.001
@@ -407,6 +412,7 @@ def optim(data, sample):
     ## A flag for communicating with sample_cleanup so a nice warning
     ## message can be displayed.
     success = False
+    diagnostics = {}
 
     try:
         ## get array of all clusters data
@@ -419,39 +425,45 @@ def optim(data, sample):
                 "Bad stack in getfreqs; {} {}"
                 .format(sample.name, bfreqs))
 
-        ## put into array, count array items as Byte strings
-        tstack = Counter([j.tostring() for j in stacked])
-
-        ## get keys back as arrays and store vals as separate arrays
-        ustacks = np.array(
-            [np.frombuffer(i, dtype=np.uint64) for i in tstack.keys()]
-        )
-        counts = np.array(list(tstack.values()))
-        ## cleanup
-        del tstack
+        ## get unique stacks and their counts, and precompute the 
+        ## likelihood terms of each that do not depend on [H, E]
+        ustacks, counts = np.unique(stacked, axis=0, return_counts=True)
+        stats = get_stack_stats(ustacks, bfreqs)
+        counts = counts.astype(np.float64)
 
         ## if data are haploid fix H to 0
         if int(data.params.max_alleles_consens) == 1:
-            pstart = np.array([0.001], dtype=np.float64)
+            res = scipy.optimize.minimize(
+                get_haploid_lik, 
+                np.array([0.001]),
+                args=(bfreqs, counts, stats),
+                jac=True,
+                method="L-BFGS-B",
+                bounds=[OPTIM_BOUNDS],
+                options={"maxiter": OPTIM_MAXITER},
+            )
             hetero = 0.
-            errors = scipy.optimize.fmin(
-                get_haploid_lik, pstart,
-                (bfreqs, ustacks, counts),
-                maxfun=50,
-                maxiter=50,
-                disp=False,
-                full_output=False)
+            errors = float(res.x[0])
+
         ## or do joint diploid estimates
         else:
-            pstart = np.array([0.01, 0.001], dtype=np.float64)
-            hetero, errors = scipy.optimize.fmin(
-                nget_diploid_lik, pstart,
-                (bfreqs, ustacks, counts),
-                maxfun=50,
-                maxiter=50,
-                disp=False,
-                full_output=False)
+            res = scipy.optimize.minimize(
+                get_diploid_lik, 
+                np.array([0.01, 0.001]),
+                args=(bfreqs, counts, stats),
+                jac=True,
+                method="L-BFGS-B",
+                bounds=[OPTIM_BOUNDS, OPTIM_BOUNDS],
+                options={"maxiter": OPTIM_MAXITER},
+            )
+            hetero, errors = [float(i) for i in res.x]
         success = True
+        diagnostics = {
+            "optim_converged": bool(res.success),
+            "optim_iterations": int(res.nit),
+            "optim_loglik": float(-res.fun),
+            "unique_stacks": int(ustacks.shape[0]),
+        }
 
     except IPyradError as inst:
         ## recal_hidepth raises this exception if there are no clusters that
@@ -462,11 +474,17 @@ def optim(data, sample):
             # "Found sample with no clusters hidepth - {}".format(sample.name))
         pass
 
-    return hetero, errors, success
+    return hetero, errors, success, diagnostics
+
 
 
+def optim_batch(data, samples):
+    "runs optim on several samples in one job, returns {name: results}"
+    return {sample.name: optim(data, sample) for sample in samples}
 
-def sample_cleanup(sample, hest, eest, success):
+
+
+def sample_cleanup(sample, hest, eest, success, diagnostics):
     "Store results to the Sample objects"
     # sample summary assignments
     sample.stats.state = 4
@@ -476,6 +494,8 @@ def sample_cleanup(sample, hest, eest, success):
     # sample full assigments
     sample.stats_dfs.s4.hetero_est = float(hest)
     sample.stats_dfs.s4.error_est = float(eest)
+    for key, value in diagnostics.items():
+        sample.stats_dfs.s4[key] = value
 
     # In rare cases no hidepth clusters for statistical basecalling
     # so we warn the user, but carry on with default values
@@ -485,3 +505,10 @@ def sample_cleanup(sample, hest, eest, success):
         basecalling. Setting default heterozygosity/error to 0.01/0.001.
         """.format(sample.name))
         print(msg)
+
+
+# bounds of [H, E] estimates, max iterations of the optimizer, and number 
+# of optim jobs (each a batch of samples) per engine.
+OPTIM_BOUNDS = (1e-9, 0.5)
+OPTIM_MAXITER = 200
+OPTIMBATCHES = 2
@@ -10,10 +10,16 @@ from __future__ import print_function
 
 import os
 import io
+import gzip
 import time
+import shutil
+import threading
 import numpy as np
 import subprocess as sps
-from .utils import IPyradError, fullcomp
+from numba import njit
+from .utils import IPyradError, fullcomp, bgzf_compress, BGZF_EOF
+from .demultiplex import (
+    FastqBlockReader, estimate_nreads, index_fastq, open_fastq_slice)
 
 
 class Step2(object):
@@ -86,6 +92,8 @@ class Step2(object):
 
 
     def check_binaries(self):
+        if self.data.hackersonly.trim_engine != "cutadapt":
+            return
         cmd = ['which', 'cutadapt']
         proc = sps.Popen(cmd, stderr=sps.PIPE, stdout=sps.PIPE)
         comm = proc.communicate()[0]
@@ -156,41 +164,112 @@ class Step2(object):
                 self.data.samples[rasync].files.concat = catjobs[rasync].get()
 
 
+    def get_shards(self):
+        """
+        Decide how many pieces (shards) to trim each sample in from the size
+        of its input files and the number of engines, such that samples much
+        larger than the average load per engine are split across engines. 
+        """
+        nengines = len(self.ipyclient.ids[::2])
+        sizes = {}
+        for sample in self.samples:
+            sizes[sample.name] = sum(
+                os.path.getsize(i) for i in sample.files.concat[0] if i)
+
+        # no shard is made smaller than SHARD_MIN_SIZE
+        target = max(SHARD_MIN_SIZE, sum(sizes.values()) / float(nengines))
+        shards = {}
+        for sname, size in sizes.items():
+            shards[sname] = int(min(nengines, max(1, np.ceil(size / target))))
+        return shards
+
+
+    def remote_index_shards(self):
+        """
+        Index the inputs of samples that will be split into record-aligned
+        slices. Returns {sname: [chunk, ...]} where chunk is (r1 offsets, 
+        r2 offsets, nreads), or [None] for samples trimmed whole.
+        """
+        nshards = self.get_shards()
+        chunks = {i: [None] for i in nshards}
+        rasyncs = {}
+        for sample in self.samples:
+            if nshards[sample.name] > 1:
+                rasyncs[sample.name] = self.lbview.apply(
+                    index_shards, *(self.data, sample, nshards[sample.name]))
+        if not rasyncs:
+            return chunks
+
+        # wait for all to finish
+        start = time.time()
+        printstr = ("indexing large samples", "s2")
+        while 1:
+            finished = sum([i.ready() for i in rasyncs.values()])
+            self.data._progressbar(len(rasyncs), finished, start, printstr)
+            time.sleep(0.1)
+            if finished == len(rasyncs):
+                print("")
+                break
+
+        # samples that could not be indexed are trimmed whole
+        for sname in rasyncs:
+            chunks[sname] = rasyncs[sname].get() or [None]
+        return chunks
+
+
     def remote_run_cutadapt(self):
         # choose cutadapt function based on datatype
+        if self.data.hackersonly.trim_engine == "numba":
+            func = trim_reads
+        elif "pair" in self.data.params.datatype:
+            func = cutadaptit_pairs
+        else:
+            func = cutadaptit_single
+
+        # split large samples into shards, each is a (sidx, chunk) or None
+        chunks = self.remote_index_shards()
+
+        # send samples (or shards of samples) to cutadapt filtering
         start = time.time()
         printstr = ("processing reads    ", "s2")
-        finished = 0
         rawedits = {}
-
-        # send samples to cutadapt filtering
         for sample in self.samples:
-            if "pair" in self.data.params.datatype:
-                rasync = self.lbview.apply(
-                    cutadaptit_pairs, *(self.data, sample))
+            if chunks[sample.name] == [None]:
+                shards = [None]
             else:
-                rasync = self.lbview.apply(
-                    cutadaptit_single, *(self.data, sample))
-            rawedits[sample.name] = rasync
+                shards = list(enumerate(chunks[sample.name]))
+            rawedits[sample.name] = [
+                self.lbview.apply(func, *(self.data, sample, shard))
+                for shard in shards
+            ]
 
         # wait for all to finish
+        jobs = [i for sjobs in rawedits.values() for i in sjobs]
         while 1:
-            finished = sum([i.ready() for i in rawedits.values()])
-            self.data._progressbar(len(rawedits), finished, start, printstr)
+            finished = sum([i.ready() for i in jobs])
+            self.data._progressbar(len(jobs), finished, start, printstr)
             time.sleep(0.1)
-            if finished == len(rawedits):
+            if finished == len(jobs):
                 print("")
                 break
 
         # collect results, report failures, store stats. async = sample.name
-        for rasync in rawedits:
-            res = rawedits[rasync].get()
-            if "pair" not in self.data.params.datatype:
-                parse_single_results(
-                    self.data, self.data.samples[rasync], res)
-            else:
-                parse_pair_results(
-                    self.data, self.data.samples[rasync], res)
+        for sname in rawedits:
+            stats = []
+            for rasync in rawedits[sname]:
+                res = rasync.get()
+                if self.data.hackersonly.trim_engine == "numba":
+                    stats.append(res)
+                elif "pair" not in self.data.params.datatype:
+                    stats.append(parse_single_results(res))
+                else:
+                    stats.append(parse_pair_results(res))
+
+            # merge the outputs and stats of shards
+            sample = self.data.samples[sname]
+            if len(stats) > 1:
+                concat_shards(self.data, sample, len(stats))
+            store_sample_stats(self.data, sample, merge_stats(stats))
 
 
     def assembly_cleanup(self):
@@ -223,16 +302,17 @@ def assembly_cleanup(data):
 
 
 
-def parse_single_results(data, sample, res1):
-    """ parse results from cutadapt into sample data"""
+def parse_single_results(res1):
+    """ parse results from cutadapt into a dict of s2 stats"""
 
     ## set default values 
-    #sample.stats_dfs.s2["reads_raw"] = 0
-    sample.stats_dfs.s2["trim_adapter_bp_read1"] = 0
-    sample.stats_dfs.s2["trim_quality_bp_read1"] = 0
-    sample.stats_dfs.s2["reads_filtered_by_Ns"] = 0
-    sample.stats_dfs.s2["reads_filtered_by_minlen"] = 0
-    sample.stats_dfs.s2["reads_passed_filter"] = 0
+    stats = {
+        "trim_adapter_bp_read1": 0,
+        "trim_quality_bp_read1": 0,
+        "reads_filtered_by_Ns": 0,
+        "reads_filtered_by_minlen": 0,
+        "reads_passed_filter": 0,
+    }
 
     ## parse new values from cutadapt results output
     lines = res1.decode().strip().split("\n")
@@ -240,56 +320,43 @@ def parse_single_results(data, sample, res1):
 
         if "Total reads processed:" in line:
             value = int(line.split()[3].replace(",", ""))
-            sample.stats_dfs.s2["reads_raw"] = value
+            stats["reads_raw"] = value
 
         if "Reads with adapters:" in line:
             value = int(line.split()[3].replace(",", ""))
-            sample.stats_dfs.s2["trim_adapter_bp_read1"] = value
+            stats["trim_adapter_bp_read1"] = value
 
         if "Quality-trimmed" in line:
             value = int(line.split()[1].replace(",", ""))
-            sample.stats_dfs.s2["trim_quality_bp_read1"] = value
+            stats["trim_quality_bp_read1"] = value
 
         if "Reads that were too short" in line:
             value = int(line.split()[5].replace(",", ""))
-            sample.stats_dfs.s2["reads_filtered_by_minlen"] = value
+            stats["reads_filtered_by_minlen"] = value
 
         if "Reads with too many N" in line:
             value = int(line.split()[5].replace(",", ""))
-            sample.stats_dfs.s2["reads_filtered_by_Ns"] = value
+            stats["reads_filtered_by_Ns"] = value
    
         if "Reads written (passing filters):" in line:
             value = int(line.split()[4].replace(",", ""))
-            sample.stats_dfs.s2["reads_passed_filter"] = value
-
-    ## save to stats summary
-    if sample.stats_dfs.s2.reads_passed_filter:
-        sample.stats.state = 2
-        sample.stats.reads_passed_filter = (
-            sample.stats_dfs.s2.reads_passed_filter)
-        sample.files.edits = [
-            (os.path.join(
-                data.dirs.edits, sample.name + ".trimmed_R1_.fastq.gz"), 0)]
-        ## write the long form output to the log file.
-        # ip.logger.info(res1)
-
-    else:
-        print("{}No reads passed filtering in Sample: {}"
-              .format(data._spacer, sample.name))
+            stats["reads_passed_filter"] = value
+    return stats
 
 
 
-def parse_pair_results(data, sample, res):
-    """ parse results from cutadapt for paired data"""
-    # ip.logger.info("in parse pair mod results\n%s", res)   
+def parse_pair_results(res):
+    """ parse results from cutadapt for paired data into a dict of s2 stats"""
     ## set default values
-    sample.stats_dfs.s2["trim_adapter_bp_read1"] = 0
-    sample.stats_dfs.s2["trim_adapter_bp_read2"] = 0    
-    sample.stats_dfs.s2["trim_quality_bp_read1"] = 0
-    sample.stats_dfs.s2["trim_quality_bp_read2"] = 0    
-    sample.stats_dfs.s2["reads_filtered_by_Ns"] = 0
-    sample.stats_dfs.s2["reads_filtered_by_minlen"] = 0
-    sample.stats_dfs.s2["reads_passed_filter"] = 0
+    stats = {
+        "trim_adapter_bp_read1": 0,
+        "trim_adapter_bp_read2": 0,
+        "trim_quality_bp_read1": 0,
+        "trim_quality_bp_read2": 0,
+        "reads_filtered_by_Ns": 0,
+        "reads_filtered_by_minlen": 0,
+        "reads_passed_filter": 0,
+    }
 
     lines = res.decode().strip().split("\n")
     qprimed = 0
@@ -302,62 +369,252 @@ def parse_pair_results(data, sample, res):
         if "Read 1:" in line:
             if qprimed:
                 value = int(line.split()[2].replace(",", ""))
-                sample.stats_dfs.s2["trim_quality_bp_read1"] = value
+                stats["trim_quality_bp_read1"] = value
 
         if "Read 2:" in line:
             if qprimed:
                 value = int(line.split()[2].replace(",", ""))
-                sample.stats_dfs.s2["trim_quality_bp_read2"] = value
+                stats["trim_quality_bp_read2"] = value
                 qprimed = 0
 
         if "Read 1 with adapter:" in line:
             value = int(line.split()[4].replace(",", ""))
-            sample.stats_dfs.s2["trim_adapter_bp_read1"] = value
+            stats["trim_adapter_bp_read1"] = value
 
         if "Read 2 with adapter:" in line:
             value = int(line.split()[4].replace(",", ""))
-            sample.stats_dfs.s2["trim_adapter_bp_read2"] = value
+            stats["trim_adapter_bp_read2"] = value
 
         if "Total read pairs processed:" in line:
             value = int(line.split()[4].replace(",", ""))
-            sample.stats_dfs.s2["reads_raw"] = value
+            stats["reads_raw"] = value
 
         if "Pairs that were too short" in line:
             value = int(line.split()[5].replace(",", ""))
-            sample.stats_dfs.s2["reads_filtered_by_minlen"] = value
+            stats["reads_filtered_by_minlen"] = value
 
         if "Pairs with too many N" in line:
             value = int(line.split()[5].replace(",", ""))
-            sample.stats_dfs.s2["reads_filtered_by_Ns"] = value
+            stats["reads_filtered_by_Ns"] = value
 
         if "Pairs written (passing filters):" in line:
             value = int(line.split()[4].replace(",", ""))
-            sample.stats_dfs.s2["reads_passed_filter"] = value
+            stats["reads_passed_filter"] = value
+    return stats
+
+
+
+def store_sample_stats(data, sample, stats):
+    """ store a dict of s2 stats to the sample and set its edits files"""
+    for key, value in stats.items():
+        sample.stats_dfs.s2[key] = value
 
     ## save to stats summary
     if sample.stats_dfs.s2.reads_passed_filter:
         sample.stats.state = 2
         sample.stats.reads_passed_filter = (
             sample.stats_dfs.s2.reads_passed_filter)
-        sample.files.edits = [(
-            os.path.join(
-                data.dirs.edits, sample.name + ".trimmed_R1_.fastq.gz"), 
-            os.path.join(
+        edits1 = os.path.join(
+            data.dirs.edits, sample.name + ".trimmed_R1_.fastq.gz")
+        edits2 = 0
+        if "pair" in data.params.datatype:
+            edits2 = os.path.join(
                 data.dirs.edits, sample.name + ".trimmed_R2_.fastq.gz")
-            )]
+        sample.files.edits = [(edits1, edits2)]
     else:
-        print("No reads passed filtering in Sample: {}".format(sample.name))
+        print("{}No reads passed filtering in Sample: {}"
+              .format(data._spacer, sample.name))
+
+
+
+def merge_stats(stats):
+    "Sum a list of dicts of s2 stats from the shards of a sample"
+    merged = {}
+    for stat in stats:
+        for key, value in stat.items():
+            merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+
+def get_trimmed_paths(data, sample, shard=None):
+    """
+    Returns the paths of the trimmed R1 and R2 files of a sample, or of the
+    tmp files of one of its shards.
+    """
+    tag = ("" if not shard else ".shard{}".format(shard[0]))
+    return [
+        os.path.join(
+            data.dirs.edits, 
+            "{}.trimmed_{}_{}.fastq.gz".format(sample.name, rrr, tag))
+        for rrr in ("R1", "R2")
+    ]
+
+
+
+def concat_shards(data, sample, nshards):
+    """
+    Concatenate the trimmed (compressed) tmp files of the shards of a sample
+    in order into its trimmed files. Gzip members can be concatenated without
+    recompressing.
+    """
+    nreads = (2 if "pair" in data.params.datatype else 1)
+    for ridx in range(nreads):
+        tmps = [
+            get_trimmed_paths(data, sample, (sidx, None))[ridx] 
+            for sidx in range(nshards)
+        ]
+        out = get_trimmed_paths(data, sample)[ridx]
+        os.rename(tmps[0], out)
+        with open(out, 'ab') as outfile:
+            for tmpfile in tmps[1:]:
+                with open(tmpfile, 'rb') as infile:
+                    shutil.copyfileobj(infile, outfile)
+                os.remove(tmpfile)
+            outfile.write(BGZF_EOF)
+
 
 
 # CALLED BY STEP
-def cutadaptit_single(data, sample):
-    """ 
-    Applies quality and adapter filters to reads using cutadapt. If the ipyrad
-    filter param is set to 0 then it only filters to hard trim edges and uses
-    mintrimlen. If filter=1, we add quality filters. If filter=2 we add
-    adapter filters. 
+def index_shards(data, sample, nshards):
+    """
+    Index the (concatenated) input files of a sample into about nshards 
+    record-aligned slices. Returns a list of (r1 offsets, r2 offsets, nreads)
+    or None if the files cannot be read from an offset (gzip files that 
+    are not BGZF when zlib's library cannot be loaded).
+    """
+    ftup = sample.files.concat[0]
+    optim = int(np.ceil(estimate_nreads(ftup[0]) / float(nshards)))
+    chunks1 = index_fastq(ftup[0], max(1, optim))
+    if not chunks1:
+        return None
+
+    # the R2 index must have the same reads in each chunk
+    if "pair" in data.params.datatype:
+        chunks2 = index_fastq(ftup[1], max(1, optim))
+        if not chunks2:
+            return None
+        if [i[1] for i in chunks1] != [i[1] for i in chunks2]:
+            raise IPyradError(
+                "R1 and R2 files have different numbers of reads: {}"
+                .format(ftup))
+    else:
+        chunks2 = [((0, 0), i[1]) for i in chunks1]
+
+    # the estimate may leave a small last chunk, join it to the one before
+    chunks = [
+        [off1, off2, nreads] 
+        for ((off1, nreads), (off2, _)) in zip(chunks1, chunks2)
+    ]
+    if len(chunks) > 1 and chunks[-1][2] < optim / 2:
+        chunks[-2][2] += chunks.pop()[2]
+    if len(chunks) < 2:
+        return None
+    return [tuple(i) for i in chunks]
+
+
+
+def open_shard_readers(infiles, shard=None):
+    """
+    Returns a FastqBlockReader for each input file, reading the whole file, 
+    or only the slice of reads of a shard (sidx, chunk).
+    """
+    readers = []
+    for ridx, infile in enumerate(infiles):
+        if shard:
+            offsets, nreads = shard[1][ridx], shard[1][2]
+            ofile = open_fastq_slice(infile, *offsets)
+            readers.append(FastqBlockReader(ofile, nreads))
+        elif infile.endswith(".gz"):
+            readers.append(FastqBlockReader(gzip.open(infile, 'rb')))
+        else:
+            readers.append(FastqBlockReader(open(infile, 'rb')))
+    return readers
+
+
+
+def run_cutadapt(cmd, data, sample, shard=None):
+    """
+    Runs a cutadapt command and returns (proc, output). For a shard the 
+    reads (interleaved if paired) are written to cutadapt's stdin from a 
+    separate thread while its output is read.
+    """
+    if not shard:
+        proc = sps.Popen(cmd, stderr=sps.STDOUT, stdout=sps.PIPE, close_fds=True)
+        try:
+            return proc, proc.communicate()[0]
+        except KeyboardInterrupt:
+            proc.kill()
+            raise KeyboardInterrupt
+
+    proc = sps.Popen(
+        cmd, stdin=sps.PIPE, stderr=sps.STDOUT, stdout=sps.PIPE, 
+        close_fds=True)
+    infiles = sample.files.concat[0][:1 + int("pair" in data.params.datatype)]
+    feeder = threading.Thread(
+        target=feed_shard, args=(infiles, shard, proc.stdin))
+    feeder.daemon = True
+    feeder.start()
+    try:
+        res = proc.stdout.read()
+        proc.wait()
+    except KeyboardInterrupt:
+        proc.kill()
+        raise KeyboardInterrupt
+    feeder.join()
+    return proc, res
+
+
+
+def feed_shard(infiles, shard, out):
+    "Write the reads of a shard, interleaved if paired, to an open stream"
+    readers = open_shard_readers(infiles, shard)
+    try:
+        while 1:
+            blocks = [reader.read(TRIMBLOCK) for reader in readers]
+            if not blocks[0][1].size:
+                break
+            if len(blocks) > 1:
+                out.write(interleave_block(*(blocks[0] + blocks[1])).tobytes())
+            else:
+                out.write(blocks[0][0].tobytes())
+    # cutadapt exited early, its error is reported by the caller
+    except (IOError, OSError):
+        pass
+    finally:
+        for reader in readers:
+            reader.ofile.close()
+        try:
+            out.close()
+        except (IOError, OSError):
+            pass
+
+
+
+def interleave_block(arr1, ends1, arr2, ends2):
+    """
+    Returns a uint8 array of the records of two blocks of the same number of
+    fastq records interleaved (R1, R2, R1, R2, ...).
+    """
+    stops1 = ends1[3::4] + 1
+    stops2 = ends2[3::4] + 1 + arr1.size
+    starts1 = np.concatenate([[0], stops1[:-1]])
+    starts2 = np.concatenate([[arr1.size], stops2[:-1]])
+    starts = np.column_stack([starts1, starts2]).ravel()
+    sizes = np.column_stack([stops1 - starts1, stops2 - starts2]).ravel()
+
+    # index of each output byte in the joined blocks
+    shift = np.repeat(starts - (np.cumsum(sizes) - sizes), sizes)
+    index = np.arange(sizes.sum()) + shift
+    return np.concatenate([arr1, arr2])[index]
+
+
+
+def get_adapters_single(data, sample):
+    """
+    Returns the list of 3' adapters to trim from single-end reads, the main
+    adapter first followed by any extra adapters.
     """
-    sname = sample.name
     # if (GBS, ddRAD) we look for the second cut site + adapter. For SE
     # data we don't bother trying to remove the second barcode since it's not
     # as critical as with PE data.
@@ -398,90 +655,15 @@ def cutadaptit_single(data, sample):
                 data.hackersonly.p3_adapter, 
             ])
 
-    # get length trim parameter from new or older version of ipyrad params
-    trim5r1 = trim3r1 = []
-    trimlen = data.params.trim_reads
-        
-    # trim 5' end
-    if trimlen[0]:
-        trim5r1 = ["-u", str(trimlen[0])]
-    if trimlen[1] < 0:
-        trim3r1 = ["-u", str(trimlen[1])]
-    if trimlen[1] > 0:
-        trim3r1 = ["--length", str(trimlen[1])]
-    # else:
-        # trimlen = data.paramsdict.get("edit_cutsites")
-        # trim5r1 = ["--cut", str(trimlen[0])]
-
-    ## testing new 'trim_reads' setting
-    cmdf1 = ["cutadapt"]
-    if trim5r1:
-        cmdf1 += trim5r1
-    if trim3r1:
-        cmdf1 += trim3r1
-    cmdf1 += [
-        "--minimum-length", str(data.params.filter_min_trim_len),
-        "--max-n", str(data.params.max_low_qual_bases),
-        "--trim-n", 
-        "--output", os.path.join(
-            data.dirs.edits, sname + ".trimmed_R1_.fastq.gz"),
-        sample.files.concat[0][0],
-        ]
-
-    if int(data.params.filter_adapters):
-        ## NEW: only quality trim the 3' end for SE data.
-        cmdf1.insert(1, "20")
-        cmdf1.insert(1, "-q")
-        cmdf1.insert(1, str(data.params.phred_Qscore_offset))
-        cmdf1.insert(1, "--quality-base")
-
-    ## if filter_adapters==3 then p3_adapters_extra will already have extra
-    ## poly adapters added to its list. 
-    if int(data.params.filter_adapters) > 1:
-
-        ## TODO: ------------
-        ## first enter extra cuts (order of input is reversed) -----------------------
-        for extracut in list(set(data.hackersonly.p3_adapters_extra))[::-1]:
-
-            cmdf1.insert(1, extracut)
-            cmdf1.insert(1, "-a")
-        ## then put the main cut so it appears first in command
-        cmdf1.insert(1, adapter)
-        cmdf1.insert(1, "-a")
-
-    ## do modifications to read1 and write to tmp file
-    proc1 = sps.Popen(cmdf1, stderr=sps.STDOUT, stdout=sps.PIPE, close_fds=True)
-    try:
-        res1 = proc1.communicate()[0]
-    except KeyboardInterrupt:
-        proc1.kill()
-        raise KeyboardInterrupt
+    return [adapter] + list(set(data.hackersonly.p3_adapters_extra))
 
-    ## raise errors if found
-    if proc1.returncode:
-        raise IPyradError(" error in {}\n {}".format(" ".join(cmdf1), res1))
-
-    ## return result string to be parsed outside of engine
-    return res1
 
 
-# CALLED BY STEP
-## BEING MODIFIED FOR MULTIPLE BARCODES (i.e., merged samples. NOT PERFECT YET)
-def cutadaptit_pairs(data, sample):
+def get_adapters_pairs(data, sample):
     """
-    Applies trim & filters to pairs, including adapter detection. If we have
-    barcode information then we use it to trim reversecut+bcode+adapter from 
-    reverse read, if not then we have to apply a more general cut to make sure 
-    we remove the barcode, this uses wildcards and so will have more false 
-    positives that trim a little extra from the ends of reads. Should we add
-    a warning about this when filter_adapters=2 and no barcodes?
+    Returns lists of 3' adapters to trim from R1 and R2 of paired reads, the
+    main adapters first followed by any extra adapters.
     """
-    sname = sample.name
-
-    ## applied to read pairs
-    finput_r1 = sample.files.concat[0][0]
-    finput_r2 = sample.files.concat[0][1]
-
     ## Get adapter sequences. This is very important. For the forward adapter
     ## we don't care all that much about getting the sequence just before the 
     ## Illumina adapter, b/c it will either be random (in RAD), or the reverse
@@ -554,6 +736,119 @@ def cutadaptit_pairs(data, sample):
         adapter1 = data.hackersonly.p3_adapter
         adapter2 = fullcomp(data.hackersonly.p5_adapter)
 
+    ## if technical replicates then add other copies
+    if isinstance(sample.barcode, list):
+        for extrabar in sample.barcode[1:]:
+            
+            data.hackersonly.p5_adapters_extra.append(
+                "".join([
+                    fullcomp(data.params.restriction_overhang[0])[::-1], 
+                    fullcomp(extrabar)[::-1], 
+                    data.hackersonly.p5_adapter
+                ])
+            )
+
+            data.hackersonly.p5_adapters_extra.append(
+                "".join([
+                    fullcomp(data.params.restriction_overhang[1])[::-1], 
+                    data.hackersonly.p3_adapter,
+                ])
+            )
+
+    return (
+        [adapter1] + list(set(data.hackersonly.p3_adapters_extra)),
+        [adapter2] + list(set(data.hackersonly.p5_adapters_extra)),
+    )
+
+
+
+# CALLED BY STEP
+def cutadaptit_single(data, sample, shard=None):
+    """ 
+    Applies quality and adapter filters to reads using cutadapt. If the ipyrad
+    filter param is set to 0 then it only filters to hard trim edges and uses
+    mintrimlen. If filter=1, we add quality filters. If filter=2 we add
+    adapter filters. If a shard (sidx, chunk) is entered then only that slice
+    of the input is trimmed, streamed to cutadapt through stdin.
+    """
+    adapters = get_adapters_single(data, sample)
+
+    # get length trim parameter from new or older version of ipyrad params
+    trim5r1 = trim3r1 = []
+    trimlen = data.params.trim_reads
+        
+    # trim 5' end
+    if trimlen[0]:
+        trim5r1 = ["-u", str(trimlen[0])]
+    if trimlen[1] < 0:
+        trim3r1 = ["-u", str(trimlen[1])]
+    if trimlen[1] > 0:
+        trim3r1 = ["--length", str(trimlen[1])]
+    # else:
+        # trimlen = data.paramsdict.get("edit_cutsites")
+        # trim5r1 = ["--cut", str(trimlen[0])]
+
+    ## testing new 'trim_reads' setting
+    cmdf1 = ["cutadapt"]
+    if trim5r1:
+        cmdf1 += trim5r1
+    if trim3r1:
+        cmdf1 += trim3r1
+    cmdf1 += [
+        "--minimum-length", str(data.params.filter_min_trim_len),
+        "--max-n", str(data.params.max_low_qual_bases),
+        "--trim-n", 
+        "--output", get_trimmed_paths(data, sample, shard)[0],
+        ("-" if shard else sample.files.concat[0][0]),
+        ]
+
+    if int(data.params.filter_adapters):
+        ## NEW: only quality trim the 3' end for SE data.
+        cmdf1.insert(1, "20")
+        cmdf1.insert(1, "-q")
+        cmdf1.insert(1, str(data.params.phred_Qscore_offset))
+        cmdf1.insert(1, "--quality-base")
+
+    ## if filter_adapters==3 then p3_adapters_extra will already have extra
+    ## poly adapters added to its list. The main cut appears first.
+    if int(data.params.filter_adapters) > 1:
+        for adapter in adapters[::-1]:
+            cmdf1.insert(1, adapter)
+            cmdf1.insert(1, "-a")
+
+    ## do modifications to read1 and write to tmp file
+    proc1, res1 = run_cutadapt(cmdf1, data, sample, shard)
+
+    ## raise errors if found
+    if proc1.returncode:
+        raise IPyradError(" error in {}\n {}".format(" ".join(cmdf1), res1))
+
+    ## return result string to be parsed outside of engine
+    return res1
+
+
+# CALLED BY STEP
+## BEING MODIFIED FOR MULTIPLE BARCODES (i.e., merged samples. NOT PERFECT YET)
+def cutadaptit_pairs(data, sample, shard=None):
+    """
+    Applies trim & filters to pairs, including adapter detection. If we have
+    barcode information then we use it to trim reversecut+bcode+adapter from 
+    reverse read, if not then we have to apply a more general cut to make sure 
+    we remove the barcode, this uses wildcards and so will have more false 
+    positives that trim a little extra from the ends of reads. Should we add
+    a warning about this when filter_adapters=2 and no barcodes?
+    If a shard (sidx, chunk) is entered then only that slice of the inputs 
+    is trimmed, streamed to cutadapt through stdin as interleaved pairs.
+    """
+    ## applied to read pairs
+    finputs = list(sample.files.concat[0][:2])
+    if shard:
+        finputs = ["--interleaved", "-"]
+    foutput_r1, foutput_r2 = get_trimmed_paths(data, sample, shard)
+
+    # get adapter sequences (main adapter first) for R1 and R2
+    adapters1, adapters2 = get_adapters_pairs(data, sample)
+
     # parse trim_reads
     trim5r1 = trim5r2 = trim3r1 = trim3r2 = []
     trimlen = data.params.trim_reads
@@ -593,13 +888,9 @@ def cutadaptit_pairs(data, sample):
         "--trim-n",
         "--max-n", str(data.params.max_low_qual_bases),
         "--minimum-length", str(data.params.filter_min_trim_len),
-        "-o", os.path.join(
-            data.dirs.edits, sname + ".trimmed_R1_.fastq.gz"),
-        "-p", os.path.join(
-            data.dirs.edits, sname + ".trimmed_R2_.fastq.gz"),
-        finput_r1,
-        finput_r2,
-        ]
+        "-o", foutput_r1,
+        "-p", foutput_r2,
+        ] + finputs
 
     ## additional args
     if int(data.params.filter_adapters) < 2:
@@ -614,48 +905,287 @@ def cutadaptit_pairs(data, sample):
         cmdf1.insert(1, "--quality-base")
 
     if int(data.params.filter_adapters) > 1:
-        ## if technical replicates then add other copies
-        if isinstance(sample.barcode, list):
-            for extrabar in sample.barcode[1:]:
-                
-                data.hackersonly.p5_adapters_extra.append(
-                    "".join([
-                        fullcomp(data.params.restriction_overhang[0])[::-1], 
-                        fullcomp(extrabar)[::-1], 
-                        data.hackersonly.p5_adapter
-                    ])
-                )
-
-                data.hackersonly.p5_adapters_extra.append(
-                    "".join([
-                        fullcomp(data.params.restriction_overhang[1])[::-1], 
-                        data.hackersonly.p3_adapter,
-                    ])
-                )
-
         ## first enter extra cuts
-        zcut1 = list(set(data.hackersonly.p3_adapters_extra))[::-1]
-        zcut2 = list(set(data.hackersonly.p5_adapters_extra))[::-1]
+        zcut1 = adapters1[1:][::-1]
+        zcut2 = adapters2[1:][::-1]
         for ecut1, ecut2 in zip(zcut1, zcut2):
             cmdf1.insert(1, ecut1)
             cmdf1.insert(1, "-a")
             cmdf1.insert(1, ecut2)
             cmdf1.insert(1, "-A")
         ## then put the main cut first
-        cmdf1.insert(1, adapter1)
+        cmdf1.insert(1, adapters1[0])
         cmdf1.insert(1, '-a')        
-        cmdf1.insert(1, adapter2)
+        cmdf1.insert(1, adapters2[0])
         cmdf1.insert(1, '-A')         
 
     ## do modifications to read1 and write to tmp file
-    proc1 = sps.Popen(cmdf1, stderr=sps.STDOUT, stdout=sps.PIPE, close_fds=True)
-    res1 = proc1.communicate()[0]
+    proc1, res1 = run_cutadapt(cmdf1, data, sample, shard)
     if proc1.returncode:
         raise IPyradError("error in cutadapt: {}".format(res1.decode()))
     return res1
 
 
 
+# CALLED BY STEP
+def trim_reads(data, sample, shard=None):
+    """
+    The numba trim engine (hackersonly.trim_engine='numba'). Applies the same
+    edge trims, quality trimming, adapter trimming, N trimming and filters as
+    the cutadapt commands above, in that order, to blocks of reads in memory
+    and writes compressed (BGZF) outputs directly. Adapters are matched with
+    up to 10% mismatches but no indels. If a shard (sidx, chunk) is entered
+    then only that slice of the inputs is trimmed. Returns a dict of s2 stats.
+    """
+    ispair = "pair" in data.params.datatype
+    if ispair:
+        adapters = get_adapters_pairs(data, sample)
+        qcuts = (20, 20)
+    else:
+        adapters = (get_adapters_single(data, sample), [])
+        qcuts = (0, 20)
+
+    # only trim quality with filter > 0 and adapters with filter > 1
+    if not int(data.params.filter_adapters):
+        qcuts = (0, 0)
+    if int(data.params.filter_adapters) < 2:
+        adapters = ([], [])
+
+    # open inputs and outputs 
+    infiles = sample.files.concat[0][:1 + int(ispair)]
+    outfiles = get_trimmed_paths(data, sample, shard)[:1 + int(ispair)]
+    readers = open_shard_readers(infiles, shard)
+    outs = [open(i, 'wb') for i in outfiles]
+
+    # trim settings for each read as arrays
+    trims = get_trim_lengths(data)
+    adarrs = [get_adapter_array(i) for i in adapters]
+    nstats = np.zeros((2, 2), dtype=np.int64)
+    stats = {"reads_raw": 0, "reads_filtered_by_Ns": 0,
+             "reads_filtered_by_minlen": 0, "reads_passed_filter": 0}
+
+    try:
+        while 1:
+            # trim a block of R1s (and the same number of R2s)
+            blocks = []
+            nreads = TRIMBLOCK
+            for ridx, reader in enumerate(readers):
+                arr, ends = reader.read(nreads)
+                if ridx and (ends.size // 4 != nreads):
+                    raise IPyradError(
+                        "R1 and R2 files have different numbers of reads: {}"
+                        .format(infiles))
+                nreads = ends.size // 4
+                res = trim_block(
+                    arr, ends, data.params.phred_Qscore_offset,
+                    qcuts[0], qcuts[1], trims[ridx][0], trims[ridx][1], 
+                    trims[ridx][2], adarrs[ridx][0], adarrs[ridx][1],
+                    data.params.max_low_qual_bases, 
+                    data.params.filter_min_trim_len)
+                blocks.append((arr, ends) + res)
+            if not nreads:
+                break
+
+            # a pair is filtered if either read is (too short first)
+            short = np.zeros(nreads, dtype=np.bool_)
+            many_ns = np.zeros(nreads, dtype=np.bool_)
+            for ridx, block in enumerate(blocks):
+                short |= block[5] == 1
+                many_ns |= block[5] == 2
+                nstats[ridx, 0] += block[4].sum()
+                nstats[ridx, 1] += block[3].sum()
+            many_ns &= ~short
+            keep = ~(short | many_ns)
+            stats["reads_raw"] += nreads
+            stats["reads_filtered_by_minlen"] += int(short.sum())
+            stats["reads_filtered_by_Ns"] += int(many_ns.sum())
+            stats["reads_passed_filter"] += int(keep.sum())
+
+            # write kept reads trimmed to their spans
+            for ridx, block in enumerate(blocks):
+                chunk = gather_trimmed(block[0], block[1], block[2], keep)
+                outs[ridx].write(bgzf_compress(chunk.tobytes()))
+    finally:
+        for reader in readers:
+            reader.ofile.close()
+        for out in outs:
+            # shards get an EOF block after they are concatenated
+            if not shard:
+                out.write(BGZF_EOF)
+            out.close()
+
+    # store adapter (reads) and quality (bp) trimming for each read
+    for ridx in range(len(readers)):
+        stats["trim_adapter_bp_read{}".format(ridx + 1)] = int(nstats[ridx, 0])
+        stats["trim_quality_bp_read{}".format(ridx + 1)] = int(nstats[ridx, 1])
+    return stats
+
+
+
+def get_trim_lengths(data):
+    """
+    Returns (cut5, cut3, length) for R1 and R2 from the trim_reads param;
+    the number of bases to cut from the 5' and 3' ends, and the length to 
+    shorten reads to (0=no shortening).
+    """
+    trimlen = data.params.trim_reads
+    return (
+        (trimlen[0], max(0, -trimlen[1]), max(0, trimlen[1])),
+        (trimlen[2], max(0, -trimlen[3]), max(0, trimlen[3])),
+    )
+
+
+
+def get_adapter_array(adapters):
+    "Returns adapters as a padded uint8 array and an array of their lengths"
+    adapters = [i.upper().encode() for i in adapters if i]
+    alens = np.array([len(i) for i in adapters], dtype=np.int64)
+    arr = np.zeros((len(adapters), max([1] + alens.tolist())), dtype=np.uint8)
+    for idx, adapter in enumerate(adapters):
+        arr[idx, :alens[idx]] = np.frombuffer(adapter, dtype=np.uint8)
+    return arr, alens
+
+
+
+@njit
+def trim_block(
+    arr, ends, qbase, qcut5, qcut3, cut5, cut3, length, 
+    adapters, alens, maxn, minlen):
+    """
+    Returns for each record in a block the (start, stop) of the trimmed read
+    relative to the start of its sequence line, the number of bases quality
+    trimmed, whether an adapter was found, and its filter status (0=passed,
+    1=too short, 2=too many Ns).
+    """
+    nrecs = ends.size // 4
+    spans = np.zeros((nrecs, 2), dtype=np.int64)
+    qtrimmed = np.zeros(nrecs, dtype=np.int64)
+    adapted = np.zeros(nrecs, dtype=np.int64)
+    status = np.zeros(nrecs, dtype=np.int64)
+
+    for ridx in range(nrecs):
+        seq = ends[4 * ridx] + 1
+        qual = ends[4 * ridx + 2] + 1
+        size = ends[4 * ridx + 1] - seq
+
+        # unconditional trimming of edges (-u)
+        start = min(cut5, size)
+        stop = max(start, size - cut3)
+
+        # quality trimming of 5' and 3' ends (BWA algorithm, -q)
+        qstart = start
+        qstop = stop
+        score = 0
+        best = 0
+        for idx in range(start, stop):
+            score += qcut5 - (arr[qual + idx] - qbase)
+            if score < 0:
+                break
+            if score > best:
+                best = score
+                qstart = idx + 1
+        score = 0
+        best = 0
+        for idx in range(stop - 1, start - 1, -1):
+            score += qcut3 - (arr[qual + idx] - qbase)
+            if score < 0:
+                break
+            if score > best:
+                best = score
+                qstop = idx
+        if qstart >= qstop:
+            qstart = qstop = start
+        qtrimmed[ridx] = (stop - start) - (qstop - qstart)
+        start = qstart
+        stop = qstop
+
+        # adapter trimming (-a); the best match of any adapter that is in
+        # the read, or overlaps its 3' end by >=3 bases.
+        bestpos = -1
+        bestmatch = -1
+        for aidx in range(alens.size):
+            for pos in range(start, stop - ADAPTER_MIN_OVERLAP + 1):
+                overlap = min(alens[aidx], stop - pos)
+                maxerr = int(ADAPTER_ERROR_RATE * overlap)
+                nerr = 0
+                for idx in range(overlap):
+                    abase = adapters[aidx, idx]
+                    if (abase != 78) and (abase != arr[seq + pos + idx]):
+                        nerr += 1
+                        if nerr > maxerr:
+                            break
+                if (nerr <= maxerr) and (overlap - nerr > bestmatch):
+                    bestmatch = overlap - nerr
+                    bestpos = pos
+        if bestpos >= 0:
+            adapted[ridx] = 1
+            stop = bestpos
+
+        # shorten to length (--length)
+        if length:
+            stop = min(stop, start + length)
+
+        # trim Ns from ends (--trim-n)
+        while (start < stop) and (arr[seq + start] == 78):
+            start += 1
+        while (stop > start) and (arr[seq + stop - 1] == 78):
+            stop -= 1
+        spans[ridx, 0] = start
+        spans[ridx, 1] = stop
+
+        # filters (--minimum-length, --max-n)
+        if stop - start < minlen:
+            status[ridx] = 1
+        else:
+            nns = 0
+            for idx in range(start, stop):
+                if arr[seq + idx] == 78:
+                    nns += 1
+            if nns > maxn:
+                status[ridx] = 2
+    return spans, qtrimmed, adapted, status
+
+
+
+@njit
+def gather_trimmed(arr, ends, spans, keep):
+    """
+    Copies each kept record into one array with its sequence and quality 
+    lines trimmed to its span, and its '+' line emptied.
+    """
+    nrecs = ends.size // 4
+    starts = np.zeros(nrecs, dtype=np.int64)
+    starts[1:] = ends[3:-1:4] + 1
+
+    size = 0
+    for ridx in range(nrecs):
+        if keep[ridx]:
+            size += ends[4 * ridx] + 1 - starts[ridx]
+            size += 2 * (spans[ridx, 1] - spans[ridx, 0]) + 4
+
+    out = np.empty(size, dtype=np.uint8)
+    pos = 0
+    for ridx in range(nrecs):
+        if not keep[ridx]:
+            continue
+        for idx in range(starts[ridx], ends[4 * ridx] + 1):
+            out[pos] = arr[idx]
+            pos += 1
+        for line in (1, 3):
+            lstart = ends[4 * ridx + line - 1] + 1
+            for idx in range(lstart + spans[ridx, 0], lstart + spans[ridx, 1]):
+                out[pos] = arr[idx]
+                pos += 1
+            out[pos] = 10
+            pos += 1
+            if line == 1:
+                out[pos] = 43
+                out[pos + 1] = 10
+                pos += 2
+    return out
+
+
+
 # CALLED BY STEP
 def concat_multiple_inputs(data, sample):
     """ 
@@ -704,6 +1234,16 @@ def concat_multiple_inputs(data, sample):
 
 
 ## GLOBALS
+# numba trim engine: reads per block, and cutadapt's default max adapter 
+# error rate and minimum overlap of adapters at the 3' end of reads.
+TRIMBLOCK = int(1e5)
+ADAPTER_ERROR_RATE = 0.1
+ADAPTER_MIN_OVERLAP = 3
+
+# large samples are split into shards for step 2 of at least this many 
+# bytes of (compressed) input.
+SHARD_MIN_SIZE = int(5e7)
+
 NO_BARS_GBS_WARNING = """\
     This is a just a warning: 
     You set 'filter_adapters' to 2 (stringent), however, b/c your data
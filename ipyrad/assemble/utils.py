@@ -14,13 +14,25 @@ except ImportError:
 
 import os
 import sys
+import mmap
+import gzip
+import time
+import zlib
+import struct
 import socket
+import string
+import warnings
+import subprocess as sps
+from multiprocessing.pool import ThreadPool
 import pandas as pd
 import numpy as np
-import string
 
 import ipyrad
 
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    import h5py
+
 
 BADCHARS = (
     string.punctuation
@@ -425,6 +437,25 @@ def clustdealer(pairdealer, optim):
 
 
 
+def count_sites(seqs, reps):
+    """
+    Returns an int64 array of shape (nsites, 256) with the number of reads 
+    with each byte value at each site of a stack of unique sequences (a 
+    uint8 array of shape (nseqs, nsites)), where each sequence is counted 
+    reps times. This gives the same counts as stacking each sequence reps 
+    times without ever expanding the stack. 
+    """
+    nseqs, nsites = seqs.shape
+    index = seqs.astype(np.int64) + (np.arange(nsites, dtype=np.int64) * 256)
+    counts = np.bincount(
+        index.ravel(),
+        weights=np.repeat(np.asarray(reps, dtype=np.float64), nsites),
+        minlength=nsites * 256,
+    )
+    return counts.astype(np.int64).reshape(nsites, 256)
+
+
+
 def get_threaded_view(ipyclient, split=True):
     """ gets optimum threaded view of ids given the host setup """
     ## engine ids
@@ -473,6 +504,456 @@ def get_threaded_view(ipyclient, split=True):
     return hostdict
 
 
+# BGZF: gzip members of <64Kb with a 'BC' extra field storing the
+# compressed block size. Members concatenate to a valid gzip file and
+# blocks can be found without decompressing (used for random access).
+BGZF_BLOCKSIZE = 65280
+BGZF_EOF = (
+    b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00"
+    b"BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+)
+
+
+def bgzf_compress(data, level=6):
+    """
+    Returns bytes data compressed as a series of BGZF blocks. The result 
+    can be appended to any gzip file. Does not add the BGZF EOF block.
+    """
+    blocks = []
+    for start in range(0, len(data), BGZF_BLOCKSIZE):
+        chunk = data[start:start + BGZF_BLOCKSIZE]
+        comp = zlib.compressobj(level, zlib.DEFLATED, -15)
+        cdata = comp.compress(chunk) + comp.flush()
+        blocks.append(
+            struct.pack(
+                "<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+                len(cdata) + 25)
+            + cdata 
+            + struct.pack("<II", zlib.crc32(chunk) & 0xffffffff, len(chunk))
+        )
+    return b"".join(blocks)
+
+
+
+
+class SeqStore(object):
+    """
+    Disk-backed store of the sequences in 2-line fasta files (e.g., derep 
+    or catcons files) that can be accessed by name like a dict, without
+    loading them into memory. Records are written to a blob file that is 
+    memory-mapped, and found through an index of name hashes sorted with 
+    the (start, end) span of each record in the blob, both loaded as 
+    memory-mapped arrays. Files are written with the prefix path, or if
+    fastas is None a store already written with the prefix is opened (e.g.,
+    to share one store between several engines).
+    """
+    def __init__(self, fastas, prefix):
+        if isinstance(fastas, str):
+            fastas = [fastas]
+        self.blobfile = prefix + ".seqs"
+        self.hashfile = prefix + ".hashes.npy"
+        self.spanfile = prefix + ".spans.npy"
+        if fastas is not None:
+            self.build(fastas)
+
+        # load the blob and index as memory-mapped (viewed as plain arrays,
+        # which is much faster to index than np.memmap)
+        self.hashes = np.load(self.hashfile, mmap_mode='r').view(np.ndarray)
+        self.spans = np.load(self.spanfile, mmap_mode='r').view(np.ndarray)
+        self.blob = b""
+        if self.hashes.size:
+            with open(self.blobfile, 'rb') as blobfile:
+                self.blob = mmap.mmap(
+                    blobfile.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+    def build(self, fastas):
+        "Write records to the blob and the sorted index of name hashes"
+        # index is stored to arrays every 1M records to limit memory
+        hashes, ends = [], []
+        hasharrs, endarrs = [], []
+        offset = 0
+        with open(self.blobfile, 'wb') as blob:
+            for fasta in fastas:
+                if fasta.endswith(".gz"):
+                    infile = gzip.open(fasta, 'rb')
+                else:
+                    infile = open(fasta, 'rb')
+                with infile:
+                    records = izip(*[iter(infile)] * 2)
+                    for namestr, seq in records:
+                        name = namestr.strip()[1:]
+                        record = name + b"\n" + seq.strip()
+                        blob.write(record)
+                        offset += len(record)
+                        hashes.append(hash_name(name))
+                        ends.append(offset)
+                        if len(hashes) == int(1e6):
+                            hasharrs.append(np.array(hashes, dtype=np.int64))
+                            endarrs.append(np.array(ends, dtype=np.int64))
+                            hashes, ends = [], []
+        hasharrs.append(np.array(hashes, dtype=np.int64))
+        endarrs.append(np.array(ends, dtype=np.int64))
+
+        # sort the index of (start, end) spans by hash
+        hashes = np.concatenate(hasharrs)
+        ends = np.concatenate(endarrs)
+        starts = np.zeros_like(ends)
+        starts[1:] = ends[:-1]
+        spans = np.column_stack([starts, ends])
+        order = np.argsort(hashes, kind="mergesort")
+        np.save(self.hashfile, hashes[order])
+        np.save(self.spanfile, spans[order].astype(np.int64))
+
+
+    def get(self, name, default=None):
+        "Returns the sequence of a record by name"
+        bname = name.encode()
+        key = hash_name(bname)
+        idx = int(self.hashes.searchsorted(key))
+        while (idx < self.hashes.size) and (self.hashes[idx] == key):
+            rname, seq = (
+                self.blob[self.spans[idx, 0]:self.spans[idx, 1]].split(b"\n"))
+            if rname == bname:
+                return seq.decode()
+            idx += 1
+        return default
+
+
+    def __getitem__(self, name):
+        seq = self.get(name)
+        if seq is None:
+            raise KeyError(name)
+        return seq
+
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+
+    def __len__(self):
+        return self.hashes.size
+
+
+    def close(self, remove=True):
+        "Close the memory-mapped files and remove them from disk"
+        if self.hashes.size:
+            self.blob.close()
+        del self.hashes
+        del self.spans
+        if remove:
+            for path in (self.blobfile, self.hashfile, self.spanfile):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+
+def hash_name(name):
+    "Returns a 63-bit int hash of bytes that is the same across processes"
+    return (
+        ((zlib.crc32(name) & 0x7fffffff) << 32) | 
+        (zlib.adler32(name) & 0xffffffff)
+    )
+
+
+
+# number of clusters held in memory by a ClusterStore before writing to 
+# disk, and read at once when iterating over a range of clusters.
+CLUSTSTORE_BLOCK = 10000
+
+
+class ClusterStore(object):
+    """
+    Binary store of clusters in an HDF5 file, written by step 3 and read by
+    steps 4 and 5 in place of the text clustS format (which can be exported
+    with to_text). The reads of all clusters are stored 
+    as columns: sequences and names (without the size and orientation
+    suffixes) as concatenated uint8 arrays with offsets, and the depth and 
+    orientation (*, +, -) of each read. Clusters are stored as offsets into
+    the reads. Datasets are chunked and compressed so that any range of 
+    clusters can be read (e.g., on separate engines) without reading the 
+    whole file. Open with mode 'w' to write clusters with add().
+    """
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.mode = mode
+        self.io5 = h5py.File(path, mode)
+        if mode == 'w':
+            for key, dtype in (
+                ("seqs", np.uint8), ("names", np.uint8), 
+                ("depths", np.uint32), ("orients", np.uint8),
+                ("seqoffsets", np.int64), ("nameoffsets", np.int64), 
+                ("clusters", np.int64),
+                ):
+                self.io5.create_dataset(
+                    key, shape=(0,), maxshape=(None,), dtype=dtype, 
+                    chunks=(2 ** 16,), compression="gzip")
+            for key in ("seqoffsets", "nameoffsets", "clusters"):
+                self.append(key, np.zeros(1, dtype=np.int64))
+            self.clear_buffers()
+        else:
+            self.clusters = self.io5["clusters"][:]
+
+
+    def clear_buffers(self):
+        "empty the lists of reads and clusters held before writing to disk"
+        self.bseqs = []
+        self.bnames = []
+        self.bdepths = []
+        self.borients = []
+        self.bsizes = []
+
+
+    def append(self, key, arr):
+        "append an array to the end of a dataset"
+        dset = self.io5[key]
+        size = dset.shape[0]
+        dset.resize((size + arr.size,))
+        dset[size:] = arr
+
+
+    def add(self, names, depths, orients, seqs):
+        """
+        Add a cluster as lists of read names (bytes, without the size and 
+        orientation suffixes), depths, orientations (b"*", b"+", or b"-") 
+        and sequences (bytes). 
+        """
+        self.bnames.extend(names)
+        self.bdepths.extend(depths)
+        self.borients.extend(orients)
+        self.bseqs.extend(seqs)
+        self.bsizes.append(len(seqs))
+        if len(self.bsizes) == CLUSTSTORE_BLOCK:
+            self.flush()
+
+
+    def add_text(self, lines):
+        "Add a cluster from its lines in the text clustS format"
+        names, depths, orients, seqs = [], [], [], []
+        for name, seq in izip(*[iter(lines)] * 2):
+            name, size, orient = name.strip().rsplit(b";", 2)
+            names.append(name)
+            depths.append(int(size[5:]))
+            orients.append(orient)
+            seqs.append(seq.strip())
+        self.add(names, depths, orients, seqs)
+
+
+    def flush(self):
+        "write clusters held in memory to disk"
+        if not self.bsizes:
+            return
+        for key, data, okey in (
+            ("seqs", self.bseqs, "seqoffsets"), 
+            ("names", self.bnames, "nameoffsets"),
+            ):
+            ends = np.cumsum([len(i) for i in data], dtype=np.int64)
+            self.append(okey, self.io5[okey][-1] + ends)
+            self.append(key, np.frombuffer(b"".join(data), dtype=np.uint8))
+        ends = np.cumsum(self.bsizes, dtype=np.int64)
+        self.append("clusters", self.io5["clusters"][-1] + ends)
+        self.append("depths", np.array(self.bdepths, dtype=np.uint32))
+        self.append(
+            "orients", np.frombuffer(b"".join(self.borients), dtype=np.uint8))
+        self.clear_buffers()
+
+
+    def close(self):
+        "write any remaining clusters and close the file"
+        if self.mode == 'w':
+            self.flush()
+        self.io5.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def __len__(self):
+        return self.clusters.size - 1
+
+
+    def iter_clusters(self, start=0, end=None, blocksize=CLUSTSTORE_BLOCK):
+        """
+        Yields clusters in the range start:end as tuples of (names, depths, 
+        orients, seqs), where names and orients are lists of str, depths is
+        an array, and seqs is a list of uint8 arrays. Clusters are read from
+        disk in blocks of blocksize clusters.
+        """
+        end = (len(self) if end is None else min(end, len(self)))
+        for bstart in range(start, end, blocksize):
+            bend = min(bstart + blocksize, end)
+            rstart, rend = self.clusters[bstart], self.clusters[bend]
+
+            # read columns of the reads in this block
+            soffs = self.io5["seqoffsets"][rstart:rend + 1]
+            noffs = self.io5["nameoffsets"][rstart:rend + 1]
+            seqs = self.io5["seqs"][soffs[0]:soffs[-1]]
+            names = self.io5["names"][noffs[0]:noffs[-1]].tobytes().decode()
+            depths = self.io5["depths"][rstart:rend]
+            orients = self.io5["orients"][rstart:rend].tobytes().decode()
+            soffs = soffs - soffs[0]
+            noffs = noffs - noffs[0]
+
+            for cidx in range(bstart, bend):
+                cstart = self.clusters[cidx] - rstart
+                cend = self.clusters[cidx + 1] - rstart
+                yield (
+                    [names[noffs[i]:noffs[i + 1]] for i in range(cstart, cend)],
+                    depths[cstart:cend],
+                    list(orients[cstart:cend]),
+                    [seqs[soffs[i]:soffs[i + 1]] for i in range(cstart, cend)],
+                )
+
+
+    def to_text(self, path, start=0, end=None):
+        "Export the clusters in the range start:end in the text clustS format"
+        with gzip.open(path, 'wt') as out:
+            for names, depths, orients, seqs in self.iter_clusters(start, end):
+                out.write("".join(
+                    "{};size={};{}\n{}\n".format(
+                        name, depth, orient, seq.tobytes().decode())
+                    for (name, depth, orient, seq) 
+                    in zip(names, depths, orients, seqs)
+                ) + "//\n//\n")
+
+
+
+# number of muscle processes run at once by each MuscleAligner. Alignments 
+# of small clusters are mostly process startup and pipe i/o, so a few run
+# at once keep an engine's core busy. Clusters of equal length sequences 
+# that differ from the first (seed) at no more than GAPLESS_MAXDIFF of 
+# sites (ignoring Ns) are not sent to muscle.
+MUSCLE_NPROCS = 3
+GAPLESS_MAXDIFF = 0.05
+
+
+class MuscleAligner(object):
+    """
+    Aligns clusters (fasta strings) with muscle, keeping up to nprocs muscle
+    processes running at once from a pool of threads. Each cluster is written
+    to a muscle process's stdin and its alignment read from stdout directly 
+    (no shell, so no escaping and no pipe limits). Clusters are handed to 
+    threads in batches. Clusters with a single sequence, or that need no 
+    gaps (see gapless_alignment) are returned without calling muscle. 
+    Counts of clusters by each path and throughput are kept in .stats.
+    """
+    def __init__(
+        self, nprocs=MUSCLE_NPROCS, binary=None, maxdiff=GAPLESS_MAXDIFF):
+        self.binary = (binary if binary else ipyrad.bins.muscle)
+        self.nprocs = max(1, int(nprocs))
+        self.maxdiff = maxdiff
+        self.pool = ThreadPool(self.nprocs)
+        self.stats = {
+            "clusters": 0, 
+            "single": 0,
+            "gapless": 0,
+            "muscle": 0, 
+            "sequences": 0, 
+            "seconds": 0.,
+        }
+
+
+    def align_one(self, fasta):
+        "Returns the muscle alignment of a fasta string as a fasta string"
+        if fasta.count(">") < 2:
+            return fasta
+        proc = sps.Popen(
+            [self.binary, "-quiet", "-in", "-"], 
+            stdin=sps.PIPE, stdout=sps.PIPE, stderr=sps.PIPE, close_fds=True)
+        out, err = proc.communicate(fasta.encode())
+        if proc.returncode:
+            raise IPyradError("error in muscle: {}".format(err.decode()))
+        return out.decode()
+
+
+    def align(self, fastas, batchsize=16):
+        "Returns a list of the alignments of a list of fasta strings in order"
+        start = time.time()
+
+        # fast path for clusters that need no gaps, the rest go to muscle
+        nseqs = [i.count(">") for i in fastas]
+        aligned = [
+            (i if j < 2 else gapless_alignment(i, self.maxdiff)) 
+            for i, j in zip(fastas, nseqs)
+        ]
+        todo = [i for i, j in zip(fastas, aligned) if j is None]
+        muscled = iter(self.pool.map(self.align_one, todo, batchsize))
+        aligned = [(next(muscled) if i is None else i) for i in aligned]
+
+        self.stats["clusters"] += len(fastas)
+        self.stats["single"] += sum(1 for i in nseqs if i < 2)
+        self.stats["muscle"] += len(todo)
+        self.stats["gapless"] = (
+            self.stats["clusters"] - self.stats["single"] - self.stats["muscle"])
+        self.stats["sequences"] += sum(nseqs)
+        self.stats["seconds"] += time.time() - start
+        return aligned
+
+
+    def throughput(self):
+        "Returns the number of clusters aligned per second"
+        if not self.stats["seconds"]:
+            return 0.
+        return self.stats["clusters"] / self.stats["seconds"]
+
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+    @staticmethod
+    def summary(stats):
+        "Returns a string summarizing (summed) aligner stats dicts"
+        total = {}
+        for stat in stats:
+            for key, value in stat.items():
+                total[key] = total.get(key, 0) + value
+        return (
+            "aligned {} clusters: {} single, {} gapless, {} by muscle"
+            .format(
+                total.get("clusters", 0), total.get("single", 0), 
+                total.get("gapless", 0), total.get("muscle", 0))
+        )
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+def gapless_alignment(fasta, maxdiff=GAPLESS_MAXDIFF):
+    """
+    Returns a fasta string as an alignment (uppercase, like muscle output) 
+    if its sequences are all the same length and each differs from the first
+    at no more than maxdiff of sites where neither is N, such that no gaps 
+    would be inserted. Otherwise returns None.
+    """
+    lines = fasta.split()
+    seqs = lines[1::2]
+    if (len(set(len(i) for i in seqs)) > 1) or (not seqs[0]):
+        return None
+
+    # compare uppercase sequences to the first on a uint8 view
+    arr = np.frombuffer(
+        "".join(seqs).upper().encode(), dtype=np.uint8).reshape(len(seqs), -1)
+    called = (arr != 78) & (arr[0] != 78)
+    ndiffs = ((arr != arr[0]) & called).sum(axis=1)
+    if ndiffs.max() > maxdiff * arr.shape[1]:
+        return None
+    return "".join(
+        "{}\n{}\n".format(i, j.upper()) for i, j in zip(lines[::2], seqs))
+
+
 ##############################################################
 def detect_cpus():
     """
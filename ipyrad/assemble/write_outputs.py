@@ -2108,10 +2108,17 @@ class VCF_filler:
             self.snpsmap = io5['snpsmap'][:, [0, 2]]   
 
         # TODO: scaffs should be ordered (right?) so no need to load it all!
-        # All catgs for this sample (this could be done more mem efficient...)
+        # All catgs for this sample as a ragged (nsites, 4) array where the
+        # catgs of consens i are in rows offsets[i]:offsets[i + 1]. Older
+        # databases store a dense (nconsens, maxlen, 4) array.
         with h5py.File(sample.files.database, 'r') as io5:
             self.catgs = io5['catg'][:]
-            self.maxlen = self.catgs.shape[1]
+            if "catg_offsets" in io5:
+                self.offsets = io5['catg_offsets'][:]
+            else:
+                nrows, maxlen, _ = self.catgs.shape
+                self.offsets = np.arange(nrows + 1) * maxlen
+                self.catgs = self.catgs.reshape(-1, 4)
 
         # Sample-level counters
         self.locidx = 0
@@ -2180,8 +2187,7 @@ class VCF_filler:
             for tup in tups:
                 cidx, coffset = tup
                 pos = snp + (self.gtrim - coffset)
-                if (pos >= 0) & (pos < self.maxlen):
-                    self.vcfd[self.snpidx] += self.catgs[cidx, pos]
+                self.enter_catg(cidx, pos)
             self.snpidx += 1
 
 
@@ -2210,11 +2216,17 @@ class VCF_filler:
                 cidx, coffset = tup
                 # pos = snp + (self.gtrim - coffset) - ishift
                 pos = snp + coffset - ishift                
-                if (pos >= 0) & (pos < self.maxlen):
-                    self.vcfd[self.snpidx] += self.catgs[cidx, pos]
+                self.enter_catg(cidx, pos)
             self.snpidx += 1
 
 
+    def enter_catg(self, cidx, pos):
+        "add the catg of consens cidx at pos to the current SNP if it exists"
+        start, end = self.offsets[cidx], self.offsets[cidx + 1]
+        if (pos >= 0) & (pos < end - start):
+            self.vcfd[self.snpidx] += self.catgs[start + pos]
+
+
     def yield_loc(self):
         self.names = []
         self.seqs = []
@@ -44,6 +44,8 @@ class Hackers(object):
             ("merge_technical_replicates", False),
             ("exclude_reference", False),
             ("trim_loci_min_sites", 4),
+            ("trim_engine", "cutadapt"),
+            ("write_clustS", True),
         ])
 
     # pretty printing of object
@@ -181,6 +183,22 @@ class Hackers(object):
     @trim_loci_min_sites.setter
     def trim_loci_min_sites(self, value):
         self._data["trim_loci_min_sites"] = int(value)
+
+    @property
+    def trim_engine(self):
+        return self._data["trim_engine"]
+    @trim_engine.setter
+    def trim_engine(self, value):
+        if value not in ("cutadapt", "numba"):
+            raise IPyradError("trim_engine must be 'cutadapt' or 'numba'")
+        self._data["trim_engine"] = str(value)
+
+    @property
+    def write_clustS(self):
+        return self._data["write_clustS"]
+    @write_clustS.setter
+    def write_clustS(self, value):
+        self._data["write_clustS"] = bool(value)
    
 
 class Params(object):
@@ -77,6 +77,10 @@ class Sample(object):
 
               "s4": pd.Series(index=["hetero_est",
                                      "error_est",
+                                     "unique_stacks",
+                                     "optim_converged",
+                                     "optim_iterations",
+                                     "optim_loglik",
                                      ]).astype(np.object),
 
               "s5": pd.Series(index=["clusters_total",